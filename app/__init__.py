@@ -0,0 +1,3 @@
+from .factory import create_app, init_db
+
+__all__ = ["create_app", "init_db"]
@@ -0,0 +1,78 @@
+from flask import g
+from flask_login import current_user
+from sqlalchemy import and_, func, select
+
+from .models import db, Dataset, Team, TeamMember, Usage
+
+
+class Access:
+    """Team memberships of one user, loaded with a single query.
+
+    The teams the user belongs to and their dataset counters are fetched
+    together on first use, so permission checks and quota
+    displays cost no further queries no matter how many teams are involved.
+    Checks that the user passes as owner run no query at all.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._teams: list[Team] | None = None
+        self._counts: dict[int, int] = {}
+
+    def _load(self) -> None:
+        # teams without a usage row yet fall back to counting their datasets
+        counted = (
+            select(func.count(Dataset.id))
+            .where(Dataset.team_id == Team.id)
+            .correlate(Team)
+            .scalar_subquery()
+        )
+        rows = (
+            db.session.query(Team, func.coalesce(Usage.datasets, counted))
+            .join(TeamMember, TeamMember.team_id == Team.id)
+            .outerjoin(Usage, and_(Usage.scope == Usage.TEAM, Usage.owner_id == Team.id))
+            .filter(TeamMember.user_id == self.user_id)
+            .order_by(Team.id)
+            .all()
+        )
+        self._teams = [team for team, _ in rows]
+        self._counts = {team.id: count for team, count in rows}
+
+    @property
+    def teams(self) -> list[Team]:
+        if self._teams is None:
+            self._load()
+        return self._teams
+
+    @property
+    def team_counts(self) -> dict[int, int]:
+        if self._teams is None:
+            self._load()
+        return self._counts
+
+    @property
+    def team_ids(self) -> list[int]:
+        return list(self.team_counts)
+
+    def team(self, team_id: int) -> Team | None:
+        return next((t for t in self.teams if t.id == team_id), None)
+
+    def is_member(self, team_id: int | None) -> bool:
+        return team_id is not None and team_id in self.team_counts
+
+    def dataset_count(self, team_id: int) -> int:
+        return self.team_counts.get(team_id, 0)
+
+    def can_view(self, dataset: Dataset | None) -> bool:
+        """Owners and members of the dataset's team may read it."""
+        if dataset is None:
+            return False
+        return dataset.owner_id == self.user_id or self.is_member(dataset.team_id)
+
+
+def current_access() -> Access:
+    """Return the :class:`Access` of the logged in user for this request."""
+    access = g.get("access")
+    if access is None or access.user_id != current_user.id:
+        access = g.access = Access(current_user.id)
+    return access
@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Iterable, Sequence
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from .metrics import stage
+
+
+# formats that are already compressed; deflating them only costs CPU
+PRECOMPRESSED_EXTS = {"jpg", "jpeg", "png", "webp", "gif"}
+
+
+MANIFEST_FILE = "manifest.json"
+THUMBS_DIR = "thumbs"
+
+
+def _read_umask() -> int:
+    # the umask can only be read by replacing it, so this runs once at import
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# mode of a file created with open(), which mkstemp does not follow
+FILE_MODE = 0o666 & ~_read_umask()
+
+
+def meta_dir_for(preview_dir: Path) -> Path:
+    """Directory next to ``preview_dir`` holding thumbnails and the manifest."""
+    return preview_dir.with_name(preview_dir.name + ".meta")
+
+
+def load_manifest(meta_dir: Path) -> dict | None:
+    try:
+        with open(meta_dir / MANIFEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _etag(data) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def compression_for(filename: str) -> int:
+    ext = filename.rsplit(".", 1)[-1].lower()
+    return zipfile.ZIP_STORED if ext in PRECOMPRESSED_EXTS else zipfile.ZIP_DEFLATED
+
+
+def write_dataset(
+    variants: Iterable[Sequence],
+    archive_path: Path,
+    preview_dir: Path,
+    meta_dir: Path | None = None,
+    info: dict | None = None,
+) -> int:
+    """Write ``variants`` to the ZIP archive and preview directory in one pass.
+
+    Every buffer goes straight into an on-disk archive and its preview file
+    and is dropped before the next variant is consumed, so the dataset is
+    never copied in memory. The archive is written to a temporary file in
+    the same directory and renamed into place once complete. Variants are
+    ``(filename, buffer)`` pairs, optionally followed by a
+    ``(thumb_name, thumb_buffer)`` thumbnail (or ``None``) and a dict of
+    fields for the file's manifest entry. With ``meta_dir`` thumbnails
+    and a manifest with sizes and content ETags are stored there, so the
+    gallery never needs to list or hash the preview directory; ``info`` is
+    added to the manifest as it is. Returns the archive size in bytes.
+    """
+    preview_dir.mkdir(exist_ok=True)
+    if meta_dir is not None:
+        (meta_dir / THUMBS_DIR).mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(
+        dir=archive_path.parent, prefix=f".{archive_path.name}.", suffix=".part"
+    )
+    tmp_path = Path(tmp_name)
+    files = []
+    try:
+        # mkstemp creates 0600; a front proxy serving downloads must read it
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, "wb") as raw, zipfile.ZipFile(raw, "w") as zipf:
+            for variant in variants:
+                filename, buffer = variant[0], variant[1]
+                thumb = variant[2] if len(variant) > 2 else None
+                extra = variant[3] if len(variant) > 3 else None
+                with buffer.getbuffer() as data:
+                    with stage("zip"):
+                        zipf.writestr(filename, data, compress_type=compression_for(filename))
+                    with stage("write"), open(preview_dir / filename, "wb") as out:
+                        out.write(data)
+                    entry = {"name": filename, "size": data.nbytes, "etag": _etag(data)}
+                entry.update(extra or {})
+                if thumb is not None and meta_dir is not None:
+                    thumb_name, thumb_buffer = thumb
+                    with thumb_buffer.getbuffer() as data:
+                        with stage("write"), open(meta_dir / THUMBS_DIR / thumb_name, "wb") as out:
+                            out.write(data)
+                        entry["thumb"] = f"{THUMBS_DIR}/{thumb_name}"
+                        entry["thumb_etag"] = _etag(data)
+                files.append(entry)
+                del buffer, thumb, variant
+        os.replace(tmp_path, archive_path)
+        if meta_dir is not None:
+            with open(meta_dir / MANIFEST_FILE, "w") as f:
+                json.dump({**(info or {}), "files": files}, f)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        shutil.rmtree(preview_dir, ignore_errors=True)
+        if meta_dir is not None:
+            shutil.rmtree(meta_dir, ignore_errors=True)
+        raise
+    return archive_path.stat().st_size
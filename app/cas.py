@@ -0,0 +1,90 @@
+from pathlib import Path
+from typing import Callable
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+# bump whenever the generated outputs change so old entries are not reused
+PROCESSING_VERSION = "crop_and_flip-2"
+
+ARCHIVE_FILE = "archive.zip"
+PREVIEW_DIR = "preview"
+META_DIR = "meta"
+
+
+def content_key(path: Path, base_name: str, ext: str, plan: str = "") -> str:
+    """Hash the upload bytes together with everything that shapes the output.
+
+    The variant names inside the archive are derived from ``base_name`` and
+    ``ext``, so they are part of the key alongside the processing version
+    and the fingerprint of the augmentation ``plan``.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{PROCESSING_VERSION}\0{plan}\0{base_name}\0{ext}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src_dir: Path, dst_dir: Path) -> None:
+    """Recreate ``src_dir`` at ``dst_dir`` with hardlinks (copies across devices)."""
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    for src in src_dir.rglob("*"):
+        dst = dst_dir / src.relative_to(src_dir)
+        if src.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+        else:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(src, dst)
+
+
+class ContentStore:
+    """Generated datasets stored once per content key under ``root``.
+
+    Each entry holds the dataset archive, its preview files and the
+    thumbnail/manifest directory. Datasets
+    reference an entry through hardlinks, so a repeated upload costs no
+    processing and no extra disk space. Reference counts live in the
+    :class:`~app.models.Blob` table.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def lookup(self, key: str) -> Path | None:
+        entry = self.entry(key)
+        return entry if (entry / ARCHIVE_FILE).exists() else None
+
+    def build(self, key: str, produce: Callable[[Path, Path, Path], None]) -> Path:
+        """Create the entry for ``key`` by calling ``produce(archive, preview, meta)``.
+
+        The files are produced in a temporary directory and renamed into
+        place, so concurrent builds of the same key never expose a partial
+        entry; the loser of the race discards its copy.
+        """
+        entry = self.entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=entry.parent, prefix=f".{key}."))
+        try:
+            produce(tmp / ARCHIVE_FILE, tmp / PREVIEW_DIR, tmp / META_DIR)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                if self.lookup(key) is None:
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry
@@ -0,0 +1,278 @@
+from pathlib import Path
+from typing import Callable, NamedTuple
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from sqlalchemy import func
+
+from .models import db, Blob, Dataset, Job, Team, Usage, User
+from .storage import dataset_paths, owner_folder
+
+
+logger = logging.getLogger(__name__)
+
+TRASH_DIR = ".trash"
+INCOMING_DIR = ".incoming"
+CAS_DIR = ".cas"
+
+
+class Cleaner:
+    """Remove deleted archive files on a background thread.
+
+    :meth:`discard` renames paths into a ``.trash`` directory on the same
+    filesystem, which is a cheap metadata operation regardless of how many
+    files a dataset or team holds; the worker thread deletes the trash
+    afterwards. Removal that cannot be done by renaming, such as deleting
+    objects from a remote store, is handed over with :meth:`defer`. With ``reconcile`` and a positive ``interval`` the same
+    thread also runs the archive reconciler periodically. Like the job
+    queue, everything runs inline with ``JOBS_EAGER`` (the default while
+    testing).
+    """
+
+    def __init__(self, reconcile: Callable[[], None] | None = None, interval: int = 0):
+        self.reconcile = reconcile
+        self.interval = interval
+        self.app = None
+        self._trash_dirs: set[Path] = set()
+        self._deferred: list[tuple[Callable, tuple]] = []
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        self.app = app
+
+    @property
+    def eager(self) -> bool:
+        return bool(self.app.config.get("JOBS_EAGER", self.app.testing))
+
+    def start(self) -> None:
+        if self._thread is not None or self.eager:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._work, name="cleaner", daemon=True)
+            self._thread.start()
+
+    def discard(self, root: Path, *paths: Path) -> None:
+        """Move ``paths`` below ``root`` out of the way and schedule their removal.
+
+        Paths that cannot be renamed into the trash, for example because
+        they are on another filesystem, are removed where they are.
+        """
+        trash = root / TRASH_DIR
+        trash.mkdir(parents=True, exist_ok=True)
+        stuck = []
+        for path in paths:
+            try:
+                os.rename(path, trash / f"{uuid.uuid4().hex}-{path.name}")
+            except FileNotFoundError:
+                continue
+            except OSError:
+                stuck.append((remove_path, (path,)))
+        with self._lock:
+            self._trash_dirs.add(trash)
+            self._deferred.extend(stuck)
+        if self.eager:
+            self.purge()
+        else:
+            self.start()
+            self._wake.set()
+
+    def defer(self, func: Callable, *args) -> None:
+        """Run ``func(*args)`` on the cleaner thread."""
+        with self._lock:
+            self._deferred.append((func, args))
+        if self.eager:
+            self.purge()
+        else:
+            self.start()
+            self._wake.set()
+
+    def purge(self) -> None:
+        """Delete everything that has been discarded so far."""
+        with self._lock:
+            dirs = list(self._trash_dirs)
+            deferred, self._deferred = self._deferred, []
+        for trash in dirs:
+            purge_trash(trash)
+        for callback, args in deferred:
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("deferred cleanup %r failed", callback)
+
+    def _work(self) -> None:
+        last_reconcile = time.monotonic()
+        while True:
+            timeout = self.interval if self.reconcile and self.interval > 0 else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+            try:
+                self.purge()
+                if timeout and time.monotonic() - last_reconcile >= self.interval:
+                    last_reconcile = time.monotonic()
+                    with self.app.app_context():
+                        self.reconcile()
+            except Exception:
+                logger.exception("archive cleanup failed")
+
+
+def remove_path(path: Path) -> None:
+    """Delete the file or directory tree at ``path`` if it exists."""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def purge_trash(trash: Path) -> None:
+    if not trash.is_dir():
+        return
+    for entry in trash.iterdir():
+        remove_path(entry)
+
+
+class Report(NamedTuple):
+    """Result of :func:`reconcile`.
+
+    ``orphans`` are paths with no dataset, job or blob referring to them,
+    ``missing`` names datasets whose archive file is gone and ``drift``
+    lists usage counters as ``(scope, owner_id, stored, actual)`` where
+    the counts are ``(datasets, bytes)``.
+    """
+
+    orphans: list[Path]
+    missing: list[str]
+    drift: list[tuple[str, int, tuple[int, int], tuple[int, int]]]
+
+
+def _expected_usage() -> dict[tuple[str, int], tuple[int, int]]:
+    usage: dict[tuple[str, int], list[int]] = {}
+    rows = db.session.query(
+        Dataset.owner_id, Dataset.team_id, func.count(Dataset.id), func.sum(Dataset.size_bytes)
+    ).group_by(Dataset.owner_id, Dataset.team_id)
+    for owner_id, team_id, count, size in rows:
+        entry = usage.setdefault(Usage.scope_of(owner_id, team_id), [0, 0])
+        entry[0] += count
+        entry[1] += size or 0
+    pending = db.session.query(Job.owner_id, Job.team_id, func.count(Job.id)).filter(
+        Job.status.in_([Job.QUEUED, Job.RUNNING])
+    ).group_by(Job.owner_id, Job.team_id)
+    for owner_id, team_id, count in pending:
+        usage.setdefault(Usage.scope_of(owner_id, team_id), [0, 0])[0] += count
+    return {scope: (count, size) for scope, (count, size) in usage.items()}
+
+
+def _is_shard(path: Path) -> bool:
+    return len(path.name) == 2 and all(c in "0123456789abcdef" for c in path.name) and path.is_dir()
+
+
+def reconcile(
+    archive_dir: Path,
+    grace: float = 3600,
+    cleaner: Cleaner | None = None,
+    local_datasets: bool = True,
+) -> Report:
+    """Compare the ``archive_dir`` tree with the database in bulk.
+
+    Each table is read with a single query and the tree is listed once.
+    Owner folders may hold datasets in the legacy flat layout and in
+    ``<xx>/<yy>`` shard directories. With ``local_datasets`` false (remote
+    storage) only the content store, spooled uploads and counters are
+    checked.
+    Files younger than ``grace`` seconds are never reported, since uploads
+    write their files before the dataset row is committed. With a
+    ``cleaner`` the orphans are discarded and drifted usage counters are
+    corrected in place; otherwise the report is only returned.
+    """
+    cutoff = time.time() - grace
+    expected: dict[str, set[str]] = {}
+    missing = []
+    rows = db.session.query(Dataset.filename, Dataset.owner_id, Dataset.team_id)
+    for filename, owner_id, team_id in rows if local_datasets else []:
+        folder = owner_folder(owner_id, team_id)
+        names = expected.setdefault(folder, set())
+        sharded, legacy = dataset_paths(folder, filename), dataset_paths(folder, filename, False)
+        for paths in (sharded, legacy):
+            names.update(key[len(folder) + 1:] for key in paths)
+        if not any((archive_dir / p.archive).is_file() for p in (sharded, legacy)):
+            missing.append(f"{folder}/{filename}")
+    users = {i for (i,) in db.session.query(User.id)}
+    teams = {i for (i,) in db.session.query(Team.id)}
+
+    def stale(path: Path) -> bool:
+        try:
+            return path.lstat().st_mtime < cutoff
+        except FileNotFoundError:
+            return False
+
+    orphans = []
+    folders = sorted(archive_dir.iterdir()) if archive_dir.is_dir() and local_datasets else []
+    for folder in folders:
+        name = folder.name
+        if name.startswith(".") or not folder.is_dir():
+            continue
+        kind, _, ident = name.partition("_")
+        owner_exists = ident.isdigit() and (
+            (kind == "user" and int(ident) in users) or (kind == "team" and int(ident) in teams)
+        )
+        if not owner_exists:
+            if stale(folder) and name not in expected:
+                orphans.append(folder)
+            continue
+        names = expected.get(name, set())
+        for child in sorted(folder.iterdir()):
+            if not _is_shard(child):
+                if child.name not in names and stale(child):
+                    orphans.append(child)
+                continue
+            for shard in sorted(child.iterdir()):
+                for path in sorted(shard.iterdir()):
+                    if path.relative_to(folder).as_posix() not in names and stale(path):
+                        orphans.append(path)
+
+    blobs = {key for (key,) in db.session.query(Blob.key)}
+    cas = archive_dir / CAS_DIR
+    for shard in sorted(cas.iterdir()) if cas.is_dir() else []:
+        for entry in sorted(shard.iterdir()):
+            if entry.name not in blobs and stale(entry):
+                orphans.append(entry)
+
+    pending = {
+        job_id for (job_id,) in db.session.query(Job.id).filter(
+            Job.status.in_([Job.QUEUED, Job.RUNNING])
+        )
+    }
+    incoming = archive_dir / INCOMING_DIR
+    for spool in sorted(incoming.iterdir()) if incoming.is_dir() else []:
+        # uploads are named after their job, remote renders add ".entry"
+        if spool.name.partition(".")[0] not in pending and stale(spool):
+            orphans.append(spool)
+
+    # the counters are read before the tables they summarize, so a counter
+    # that changes in between no longer matches and is left alone; archives
+    # without a counter row yet are measured on first use
+    stored = db.session.query(Usage.scope, Usage.owner_id, Usage.datasets, Usage.bytes).order_by(
+        Usage.scope, Usage.owner_id
+    ).all()
+    actual = _expected_usage()
+    drift = []
+    for scope, owner_id, datasets, size in stored:
+        counts = actual.get((scope, owner_id), (0, 0))
+        if (datasets, size) != counts:
+            drift.append((scope, owner_id, (datasets, size), counts))
+
+    if cleaner is not None:
+        if orphans:
+            cleaner.discard(archive_dir, *orphans)
+        if drift:
+            for entry in drift:
+                Usage.correct(*entry)
+            db.session.commit()
+    return Report(orphans, missing, drift)
@@ -0,0 +1,16 @@
+import json
+from pathlib import Path
+
+
+CONFIG_PATH = Path(__file__).resolve().parent.parent / "config.json"
+
+
+def load_config() -> dict:
+    """Read ``config.json`` from the project root if available."""
+    if CONFIG_PATH.exists():
+        try:
+            with CONFIG_PATH.open() as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+
+DEFAULT_URL = "sqlite:///data.db"
+
+
+def _setting(config: dict, key: str, default: str) -> str:
+    return str(config.get(key, os.getenv(key.upper(), default)))
+
+
+def database_url(config: dict) -> str:
+    """Database URL from ``database_url`` in ``config.json`` or ``DATABASE_URL``."""
+    return _setting(config, "database_url", DEFAULT_URL)
+
+
+def _is_memory(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(url: str, config: dict) -> dict:
+    """Keyword arguments for ``create_engine`` derived from the configuration.
+
+    ``db_pool_size``, ``db_max_overflow``, ``db_pool_timeout`` (seconds) and
+    ``db_pool_recycle`` (seconds, ``-1`` disables it) size the connection
+    pool. In-memory SQLite keeps SQLAlchemy's single connection pool.
+    """
+    parsed = make_url(url)
+    options: dict = {"pool_pre_ping": parsed.get_backend_name() != "sqlite"}
+    if _is_memory(parsed):
+        return options
+    options.update(
+        pool_size=int(_setting(config, "db_pool_size", "10")),
+        max_overflow=int(_setting(config, "db_max_overflow", "20")),
+        pool_timeout=float(_setting(config, "db_pool_timeout", "30")),
+        pool_recycle=int(_setting(config, "db_pool_recycle", "-1")),
+    )
+    return options
+
+
+def sqlite_pragmas(config: dict) -> dict[str, str]:
+    """PRAGMA values applied to every SQLite connection.
+
+    WAL lets readers run next to the single writer, ``busy_timeout`` makes
+    a writer wait for the lock instead of failing with ``database is
+    locked`` and ``synchronous=NORMAL`` is durable in WAL mode while
+    avoiding an fsync per commit.
+    """
+    return {
+        "journal_mode": _setting(config, "db_journal_mode", "WAL"),
+        "busy_timeout": _setting(config, "db_busy_timeout_ms", "5000"),
+        "synchronous": _setting(config, "db_synchronous", "NORMAL"),
+    }
+
+
+def configure_engine(engine: Engine, config: dict) -> None:
+    """Install per-connection settings for ``engine``; no-op for server databases."""
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def _apply_pragmas(dbapi_connection, _record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
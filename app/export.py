@@ -0,0 +1,98 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+import tarfile
+import zipfile
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# (name inside the export, file on disk or a storage.StoredFile, modification time)
+ExportItem = tuple[str, Path, datetime]
+
+
+class _Pipe:
+    """Write-only file object whose contents are drained by a generator."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _read_chunks(path: Path) -> Iterator[bytes]:
+    with path.open("rb") as src:
+        while chunk := src.read(CHUNK_SIZE):
+            yield chunk
+
+
+def stream_zip(items: Iterable[ExportItem]) -> Iterator[bytes]:
+    """Yield a ZIP archive containing ``items`` without staging it anywhere.
+
+    Members are stored uncompressed (dataset archives are ZIPs already)
+    and written with data descriptors, so memory use stays at one chunk
+    regardless of the export size. Files that vanished are skipped.
+    """
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for name, path, modified in items:
+            if not path.is_file():
+                continue
+            info = zipfile.ZipInfo(name, date_time=modified.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            size = path.stat().st_size
+            with zipf.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT // 2) as dst:
+                for chunk in _read_chunks(path):
+                    dst.write(chunk)
+                    yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain()
+
+
+def stream_tar(items: Iterable[ExportItem]) -> Iterator[bytes]:
+    """Yield an uncompressed tar archive containing ``items``.
+
+    Headers are produced by :mod:`tarfile` while the file data is copied
+    chunk by chunk, so no member is ever held in memory as a whole.
+    """
+    written = 0
+    for name, path, modified in items:
+        if not path.is_file():
+            continue
+        info = tarfile.TarInfo(name)
+        info.size = path.stat().st_size
+        info.mtime = modified.timestamp()
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        yield header
+        copied = 0
+        for chunk in _read_chunks(path):
+            chunk = chunk[: info.size - copied]
+            copied += len(chunk)
+            yield chunk
+            if copied >= info.size:
+                break
+        if copied < info.size:
+            # the file shrank while streaming; keep the archive well formed
+            yield b"\0" * (info.size - copied)
+        padding = -info.size % tarfile.BLOCKSIZE
+        yield b"\0" * padding
+        written += len(header) + info.size + padding
+    end = b"\0" * (2 * tarfile.BLOCKSIZE)
+    written += len(end)
+    yield end + b"\0" * (-written % tarfile.RECORDSIZE)
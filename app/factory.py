@@ -0,0 +1,155 @@
+from pathlib import Path
+import os
+
+import click
+from flask import Flask
+from flask_login import LoginManager
+
+from . import metrics, profiling
+from .config import load_config
+from .database import database_url, engine_options, configure_engine
+from .models import db, Setting, User
+from .plans import PlanError, load_plans
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+def _flag(value) -> bool:
+    return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes", "on")
+
+
+# config.json keys read by the application, with their defaults and types;
+# each can also be set through the environment variable of the same name in
+# upper case and ends up in ``app.config`` under that name
+SETTINGS: dict[str, tuple[object, type]] = {
+    "archive_limit_user": (10, int),
+    "archive_limit_team": (50, int),
+    # 0 disables the size based limits
+    "archive_bytes_limit_user": (0, int),
+    "archive_bytes_limit_team": (0, int),
+    # how often the background reconciler runs (seconds, 0 disables it) and
+    # how old unreferenced files must be before it treats them as orphans
+    "reconcile_interval": (86400, int),
+    "reconcile_grace": (3600, int),
+    # "local" keeps datasets below ARCHIVE_DIR, "s3" in an object store
+    "storage_backend": ("local", str),
+    "page_size": (50, int),
+    "admin_page_size": (100, int),
+    "thumbnail_size": (256, int),
+    # "flask" streams archives itself, "x-accel-redirect" (nginx) and
+    # "x-sendfile" (Apache, lighttpd) hand the transfer to the front proxy
+    "download_mode": ("flask", str),
+    "download_accel_prefix": ("/protected-archives/", str),
+    "upload_workers": (2, int),
+    "upload_queue_size": (16, int),
+    # running jobs report every job_heartbeat seconds; jobs whose heartbeat
+    # is older than job_stale_after are taken back from their worker
+    "job_heartbeat": (30, int),
+    "job_stale_after": (120, int),
+    # how long a stopping job runner lets running jobs finish
+    "job_graceful_timeout": (25, int),
+    # processing threads yield the CPU to request handlers
+    "job_nice": (10, int),
+    "settings_ttl": (5.0, float),
+    # bearer token that lets a scraper read /admin/metrics without a session
+    "metrics_token": ("", str),
+    "log_upload_timings": (False, _flag),
+    # profiles kept for /admin/profiles and the percentage of uploads profiled
+    "profile_limit": (20, int),
+    "profile_upload_sample": (0.0, float),
+    # name of the plan used when an upload does not choose one
+    "augmentation_plan": ("default", str),
+}
+
+login_manager = LoginManager()
+login_manager.login_view = "auth.login"
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    return User.query.get(int(user_id))
+
+
+def _inject_settings():
+    return {"registration_enabled": Setting.get_bool("registration_enabled", True)}
+
+
+def create_app(config: dict | None = None) -> Flask:
+    """Build the application from ``config.json`` style settings.
+
+    ``config`` defaults to :func:`~app.config.load_config`. Keys in upper
+    case are copied into ``app.config`` as they are, after the settings
+    derived from the lower case keys, so callers can override either.
+    Creating an app does not touch the database, the archive directory or
+    the image libraries: the schema is created and migrated by
+    :func:`init_db` and Pillow is loaded by the first upload.
+    """
+    if config is None:
+        config = load_config()
+    app = Flask(
+        __name__,
+        template_folder=str(ROOT_DIR / "templates"),
+        static_folder=str(ROOT_DIR / "static"),
+    )
+    app.config["SECRET_KEY"] = "replace-me"
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url(config)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["ARCHIVE_DIR"] = Path(
+        config.get("archive_dir", os.getenv("ARCHIVE_DIR", ROOT_DIR / "archives"))
+    )
+    # shared by all processes of one server so /admin/metrics covers them all
+    metrics_dir = config.get("metrics_dir", os.getenv("METRICS_DIR"))
+    app.config["METRICS_DIR"] = Path(metrics_dir) if metrics_dir else None
+    for key, (default, kind) in SETTINGS.items():
+        app.config[key.upper()] = kind(config.get(key, os.getenv(key.upper(), default)))
+    # validated up front so a broken plan stops the server, not every upload
+    app.config["AUGMENTATION_PLANS"] = load_plans(config.get("augmentation_plans"))
+    app.config.update({key: value for key, value in config.items() if key.isupper()})
+    if app.config["AUGMENTATION_PLAN"] not in app.config["AUGMENTATION_PLANS"]:
+        raise PlanError(f"unknown augmentation_plan {app.config['AUGMENTATION_PLAN']!r}")
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["SQLALCHEMY_DATABASE_URI"], config)
+    )
+    # set by run.py when uploads are processed by a separate runner process
+    app.config.setdefault("JOBS_EXTERNAL", os.getenv("JOBS_EXTERNAL") == "1")
+
+    Setting.cache_ttl = app.config["SETTINGS_TTL"]
+    Setting.invalidate_cache()
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, config)
+        metrics.init_app(app, db.engine)
+    login_manager.init_app(app)
+    app.context_processor(_inject_settings)
+
+    from .services import Services
+    from .views import admin, auth, datasets, teams
+
+    Services(app, config)
+    profiling.init_app(app)
+    for blueprint in (auth.bp, datasets.bp, teams.bp, admin.bp):
+        app.register_blueprint(blueprint)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create missing database tables and apply migrations."""
+        init_db(app)
+        click.echo("database ready")
+
+    return app
+
+
+def init_db(app: Flask) -> None:
+    """Create the archive directory and bring the database of ``app`` up to date.
+
+    Missing tables are created and pending migrations from
+    :mod:`app.migrations` applied, so existing databases are upgraded on
+    startup. The pooled connections are closed afterwards so that server
+    processes forked later start without any.
+    """
+    from .migrations import migrate
+
+    app.config["ARCHIVE_DIR"].mkdir(parents=True, exist_ok=True)
+    with app.app_context():
+        migrate(db.engine, app.config["ARCHIVE_DIR"])
+        db.engine.dispose()
@@ -0,0 +1,397 @@
+from datetime import datetime, timedelta
+from typing import Callable
+import atexit
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+from .models import db, Job
+from .priority import lower_thread_priority
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when the job queue cannot accept more work."""
+
+
+class JobLost(Exception):
+    """Raised by a handler whose job was deleted or taken over while it ran."""
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # exists but belongs to another user
+    return True
+
+
+class JobQueue:
+    """Bounded in-process queue that runs :class:`Job` rows on worker threads.
+
+    ``handler`` receives the claimed job inside an application context and
+    returns the id of the created dataset. ``on_failure`` is called for
+    jobs that fail or are abandoned after a restart, before the failure is
+    committed, so resources held by the job can be released. Jobs are claimed with a
+    conditional update, so a job is only ever run once even if several
+    processes recover the same rows after a restart. With ``JOBS_EAGER``
+    (the default while testing) jobs run inline on submit.
+
+    A running job records the queue that claimed it in ``Job.worker`` and
+    that queue refreshes its ``updated_at`` every ``heartbeat`` seconds.
+    On start and after every heartbeat, running jobs whose process on this
+    host has exited or whose heartbeat is older than ``stale_after`` are
+    requeued, or failed once they were tried ``max_attempts`` times, and
+    queued jobs no worker holds are fed to the worker threads. :meth:`stop`
+    lets running jobs finish for up to ``graceful_timeout`` seconds and
+    requeues the rest, so a restart does not depend on recovery.
+
+    With ``JOBS_EXTERNAL`` the web process only records jobs and a separate
+    runner process (see :mod:`app.worker`) picks them up with :meth:`serve`,
+    so uploads never compete with request handling for the same
+    interpreter. Worker threads run with their nice value raised by
+    ``nice`` either way.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Job], int | None],
+        on_failure: Callable[[Job], None] | None = None,
+        workers: int = 2,
+        max_pending: int = 16,
+        stale_after: int = 120,
+        heartbeat: int = 30,
+        max_attempts: int = 2,
+        nice: int = 0,
+        poll_interval: float = 1.0,
+        graceful_timeout: float = 25,
+    ):
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        self.nice = nice
+        self.poll_interval = poll_interval
+        self.graceful_timeout = graceful_timeout
+        self.host = socket.gethostname()[:40]
+        self._token = uuid.uuid4().hex[:8]
+        # jobs in the local queue, and jobs this queue has claimed
+        self._in_flight: set[str] = set()
+        self._running: set[str] = set()
+        self._serving = False
+        self.app = None
+        self._queue: queue.Queue[str] = queue.Queue(maxsize=max_pending)
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def init_app(self, app) -> None:
+        self.app = app
+
+    @property
+    def eager(self) -> bool:
+        return bool(self.app.config.get("JOBS_EAGER", self.app.testing))
+
+    @property
+    def external(self) -> bool:
+        return bool(self.app.config.get("JOBS_EXTERNAL"))
+
+    @property
+    def worker_id(self) -> str:
+        # the pid is read on use, as gunicorn builds the app before forking
+        return f"{self.host}:{os.getpid()}:{self._token}"
+
+    def _spawn(self) -> bool:
+        with self._lock:
+            if self._threads:
+                return False
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"job-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            monitor = threading.Thread(target=self._monitor, name="job-monitor", daemon=True)
+            monitor.start()
+            self._threads.append(monitor)
+            return True
+
+    def start(self) -> None:
+        """Start the worker threads and pick up jobs left by a previous run."""
+        if self._threads or self.eager or self.external:
+            return
+        if self._spawn():
+            # web workers exit on their own; give their jobs back right away
+            atexit.register(self.stop, 0)
+            with self.app.app_context():
+                self._recover()
+                self._feed(self.max_pending)
+
+    def serve(self, stop: threading.Event | None = None) -> None:
+        """Run queued jobs from the database until ``stop`` is set.
+
+        Used by the dedicated runner process; jobs are handed to the worker
+        threads as they become free, oldest first. Database errors while
+        polling are logged and retried. Once ``stop`` is set the queue is
+        drained with :meth:`stop`.
+        """
+        stop = stop or threading.Event()
+        self._serving = True
+        self._spawn()
+        recovered = False
+        while not stop.is_set():
+            try:
+                with self.app.app_context():
+                    if not recovered:
+                        self._recover()
+                        recovered = True
+                    self._feed(self.workers * 2, settled=False)
+            except Exception:
+                logger.exception("polling for jobs failed, retrying")
+            stop.wait(self.poll_interval)
+        self.stop(self.graceful_timeout)
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stop taking jobs and wait up to ``timeout`` seconds for running ones.
+
+        Jobs still running afterwards are put back in the queue without
+        counting the attempt, for another process to pick up.
+        """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        workers = [t for t in self._threads if t.name.startswith("job-worker")]
+        with self._lock:
+            # jobs that were not started stay queued in the database
+            while True:
+                try:
+                    self._in_flight.discard(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                self._queue.task_done()
+        deadline = time.monotonic() + (self.graceful_timeout if timeout is None else timeout)
+        for thread in workers:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            running = list(self._running)
+        if not running:
+            return
+        try:
+            with self.app.app_context():
+                requeued = Job.query.filter(
+                    Job.id.in_(running), Job.status == Job.RUNNING, Job.worker == self.worker_id
+                ).update(
+                    {
+                        "status": Job.QUEUED,
+                        "worker": None,
+                        "attempts": Job.attempts - 1,
+                        "updated_at": datetime.utcnow(),
+                    },
+                    synchronize_session=False,
+                )
+                db.session.commit()
+        except Exception:
+            logger.exception("could not requeue %d running jobs", len(running))
+            return
+        logger.warning("requeued %d jobs that were still running", requeued)
+
+    def submit(self, job_id: str) -> None:
+        """Queue the committed job ``job_id``.
+
+        If the backlog is full the job row is deleted in the current session
+        and :class:`QueueFull` raised; the caller gives back what it reserved
+        for the job and commits. A job a runner process claimed in the
+        meantime is left to that process.
+        """
+        if self.eager:
+            self.run(job_id)
+            return
+        if self.external:
+            # the runner polls for the job; admit it if the jobs before it leave room
+            waiting = Job.query.filter(Job.status == Job.QUEUED, Job.id != job_id).count()
+            if waiting < self.max_pending:
+                return
+        else:
+            self.start()
+            if self._offer(job_id):
+                return
+        if Job.query.filter_by(id=job_id, status=Job.QUEUED).delete():
+            raise QueueFull(job_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _offer(self, job_id: str) -> bool:
+        """Put ``job_id`` on the local queue unless it is there already."""
+        with self._lock:
+            if job_id in self._in_flight:
+                return True
+            try:
+                self._queue.put_nowait(job_id)
+            except queue.Full:
+                return False
+            self._in_flight.add(job_id)
+            return True
+
+    def _feed(self, limit: int, settled: bool = True) -> None:
+        """Queue up to ``limit`` waiting jobs, oldest first.
+
+        With ``settled`` only jobs that have waited for a heartbeat are
+        taken, so web workers leave fresh uploads to the process that
+        accepted them.
+        """
+        query = db.session.query(Job.id).filter(Job.status == Job.QUEUED)
+        if settled:
+            query = query.filter(
+                Job.updated_at < datetime.utcnow() - timedelta(seconds=self.heartbeat)
+            )
+        for (job_id,) in query.order_by(Job.created_at).limit(limit):
+            if not self._offer(job_id):
+                break  # the rest is picked up after the next heartbeat
+
+    def _beat(self) -> None:
+        with self._lock:
+            running = list(self._running)
+        if running:
+            Job.query.filter(Job.id.in_(running), Job.worker == self.worker_id).update(
+                {"updated_at": datetime.utcnow()}, synchronize_session=False
+            )
+            db.session.commit()
+
+    def _abandoned(self, job: Job, cutoff: datetime) -> bool:
+        if job.worker == self.worker_id:
+            with self._lock:
+                return job.id not in self._running
+        if job.updated_at is None or job.updated_at < cutoff:
+            return True
+        host, _, rest = (job.worker or "").partition(":")
+        pid = rest.split(":", 1)[0]
+        return host == self.host and pid.isdigit() and not _alive(int(pid))
+
+    def _recover(self) -> None:
+        """Requeue or fail the running jobs whose worker is gone."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        for job in Job.query.filter(Job.status == Job.RUNNING).all():
+            if not self._abandoned(job, cutoff):
+                continue
+            if job.attempts < self.max_attempts:
+                values = {"status": Job.QUEUED, "worker": None}
+            else:
+                values = {"status": Job.FAILED, "error": "Interrupted"}
+            # a heartbeat or another recovering process moves updated_at
+            taken = Job.query.filter(
+                Job.id == job.id, Job.status == Job.RUNNING, Job.updated_at == job.updated_at
+            ).update({**values, "updated_at": datetime.utcnow()}, synchronize_session=False)
+            if taken:
+                logger.warning(
+                    "job %s of %s was interrupted and is %s", job.id, job.worker, values["status"]
+                )
+                if values["status"] == Job.FAILED and self.on_failure is not None:
+                    self.on_failure(job)
+            db.session.commit()
+
+    def _monitor(self) -> None:
+        while not self._stopping.wait(self.heartbeat):
+            try:
+                with self.app.app_context():
+                    self._beat()
+                    self._recover()
+                    if not self._serving:
+                        self._feed(self.max_pending)
+            except Exception:
+                logger.exception("job monitor pass failed")
+
+    def _work(self) -> None:
+        lower_thread_priority(self.nice)
+        while not self._stopping.is_set():
+            try:
+                job_id = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if self._stopping.is_set():
+                # left queued in the database for the next process
+                with self._lock:
+                    self._in_flight.discard(job_id)
+                self._queue.task_done()
+                return
+            try:
+                with self.app.app_context():
+                    self.run(job_id)
+            except Exception:
+                logger.exception("job %s crashed", job_id)
+            finally:
+                with self._lock:
+                    self._in_flight.discard(job_id)
+                self._queue.task_done()
+
+    def run(self, job_id: str) -> None:
+        """Claim ``job_id`` and run the handler, recording the outcome."""
+        with self._lock:
+            self._running.add(job_id)
+        try:
+            self._run(job_id)
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def _run(self, job_id: str) -> None:
+        claimed = Job.query.filter_by(id=job_id, status=Job.QUEUED).update(
+            {
+                "status": Job.RUNNING,
+                "worker": self.worker_id,
+                "attempts": Job.attempts + 1,
+                "updated_at": datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(Job, job_id)
+        try:
+            dataset_id = self.handler(job)
+        except JobLost:
+            db.session.rollback()
+            logger.warning("job %s was cancelled or taken over while it ran", job_id)
+            return
+        except Exception as exc:
+            db.session.rollback()
+            logger.exception("job %s failed", job_id)
+            job = self._owned(job_id)
+            if job is None:
+                return
+            self._fail(job, str(exc) or exc.__class__.__name__)
+        else:
+            # handlers may finish the job in the transaction that stores its result
+            job = self._owned(job_id)
+            if job is None:
+                return
+            job.status = Job.DONE
+            job.dataset_id = dataset_id
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def _owned(self, job_id: str) -> Job | None:
+        """The row of ``job_id`` if it still exists and is running here."""
+        job = db.session.get(Job, job_id, populate_existing=True)
+        if job is None or job.status != Job.RUNNING or job.worker != self.worker_id:
+            return None
+        return job
+
+    def _fail(self, job: Job, error: str) -> None:
+        job.status = Job.FAILED
+        job.error = error
+        job.updated_at = datetime.utcnow()
+        if self.on_failure is not None:
+            self.on_failure(job)
@@ -0,0 +1,376 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+
+# seconds; stages of a small upload take milliseconds, huge sources minutes
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, math.inf)
+
+REQUEST_SECONDS = "oneshot_request_seconds"
+REQUEST_QUERIES = "oneshot_request_queries"
+REQUEST_QUERY_SECONDS = "oneshot_request_query_seconds"
+STAGE_SECONDS = "oneshot_stage_seconds"
+UPLOADS = "oneshot_uploads_total"
+
+AGGREGATE = "aggregate.json"
+
+
+class Histogram:
+    """Observation counts per bucket; ``buckets`` are upper bounds ending in ``inf``."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(str(v))}"' for k, v in pairs]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """Counters and histograms of this process, rendered in Prometheus text format.
+
+    With ``directory`` set, :meth:`flush` writes a snapshot of the process
+    there and :meth:`render` adds up the snapshots of every process sharing
+    the directory, so one endpoint reports all server workers and the job
+    runner. Snapshots are named after the pid and start time of their
+    process, so a reused pid never overwrites the counts of an exited one,
+    and :meth:`compact` folds those of exited processes into a single
+    ``aggregate.json``.
+    """
+
+    flush_interval = 1.0
+
+    def __init__(self):
+        self.directory: Path | None = None
+        self._kinds: dict[str, tuple[str, str, tuple[float, ...] | None]] = {}
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, Histogram] = {}
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        self._pid = 0
+        self._started = 0
+
+    def define(self, name: str, kind: str, help: str, buckets=None) -> None:
+        self._kinds[name] = (kind, help, tuple(buckets) if buckets else None)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._kinds[name][2])
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [[n, list(map(list, l)), v] for (n, l), v in self._counters.items()],
+                "histograms": [
+                    [n, list(map(list, l)), h.counts, h.sum, h.count]
+                    for (n, l), h in self._histograms.items()
+                ],
+            }
+
+    def flush(self, force: bool = False) -> None:
+        """Write this process' snapshot to ``directory``, at most once per interval."""
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed < self.flush_interval:
+            return
+        self._flushed = now
+        if self._pid != os.getpid():
+            # first flush of this process, or of a child forked after one
+            self._pid, self._started = os.getpid(), time.time_ns()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        _write_json(self.directory, f"{self._pid}-{self._started}.json", self.snapshot())
+
+    def compact(self, directory: Path | None = None) -> list[dict]:
+        """Fold the snapshots of exited processes in ``directory`` into ``aggregate.json``.
+
+        Runs under an exclusive lock on the directory and returns the
+        aggregate followed by the snapshots of live processes. The aggregate
+        lists the snapshots it already contains, so a compaction interrupted
+        before removing them does not count them twice.
+        """
+        import fcntl
+
+        directory = directory or self.directory
+        if directory is None or not directory.is_dir():
+            return []
+        with open(directory / "compact.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            aggregate = _read_json(directory / AGGREGATE) or {"counters": [], "histograms": []}
+            folded = set(aggregate.get("folded", []))
+            dead, live = [], []
+            for path in sorted(directory.glob("*-*.json")):
+                pid = path.name.partition("-")[0]
+                if pid.isdigit() and not _alive(int(pid)):
+                    dead.append(path)
+                elif path.name not in folded:
+                    snap = _read_json(path)
+                    if snap is not None:
+                        live.append(snap)
+            if dead:
+                snapshots = [aggregate]
+                for path in dead:
+                    snap = None if path.name in folded else _read_json(path)
+                    if snap is not None:
+                        snapshots.append(snap)
+                counters, histograms = self._merge(snapshots)
+                aggregate = {
+                    "counters": [[n, list(map(list, l)), v] for (n, l), v in counters.items()],
+                    "histograms": [
+                        [n, list(map(list, l)), h.counts, h.sum, h.count]
+                        for (n, l), h in histograms.items()
+                    ],
+                    "folded": [path.name for path in dead],
+                }
+                _write_json(directory, AGGREGATE, aggregate)
+                for path in dead:
+                    path.unlink(missing_ok=True)
+            return [aggregate, *live]
+
+    def _snapshots(self) -> list[dict]:
+        if self.directory is None:
+            return [self.snapshot()]
+        self.flush(force=True)
+        return self.compact()
+
+    def _merge(self, snapshots: list[dict]) -> tuple[dict[tuple, float], dict[tuple, Histogram]]:
+        counters: dict[tuple, float] = {}
+        histograms: dict[tuple, Histogram] = {}
+        for snap in snapshots:
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total, count in snap["histograms"]:
+                if name not in self._kinds:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                if merged is None:
+                    merged = histograms[key] = Histogram(self._kinds[name][2])
+                merged.counts = [a + b for a, b in zip(merged.counts, counts)]
+                merged.sum += total
+                merged.count += count
+        return counters, histograms
+
+    def render(self) -> str:
+        counters, histograms = self._merge(self._snapshots())
+        lines = []
+        for name, (kind, help, buckets) in self._kinds.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    le = f'le="{_number(bound)}"'
+                    lines.append(f"{name}_bucket{_labels(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {hist.sum!r}")
+                lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _write_json(directory: Path, name: str, data: dict) -> None:
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, directory / name)
+
+
+def _read_json(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+registry = Registry()
+registry.define(REQUEST_SECONDS, "histogram", "Request latency by route.", TIME_BUCKETS)
+registry.define(REQUEST_QUERIES, "histogram", "SQL statements per request by route.", COUNT_BUCKETS)
+registry.define(
+    REQUEST_QUERY_SECONDS, "histogram", "Time spent in SQL statements per request by route.", TIME_BUCKETS
+)
+registry.define(STAGE_SECONDS, "histogram", "Duration of upload and processing stages.", TIME_BUCKETS)
+registry.define(UPLOADS, "counter", "Processed uploads by outcome.")
+
+
+class Timings:
+    """Stage durations of one unit of work, summed per stage."""
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_ms(self) -> dict[str, float]:
+        with self._lock:
+            return {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()}
+
+
+_timings: ContextVar[Timings | None] = ContextVar("oneshot_timings", default=None)
+
+
+def current_timings() -> Timings | None:
+    """The :class:`Timings` of the enclosing :func:`collect`, for handing to other threads."""
+    return _timings.get()
+
+
+@contextmanager
+def collect():
+    """Gather the :func:`stage` timings recorded inside the block."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def stage(name: str, timings: Timings | None = None):
+    """Time the block as ``name`` in :data:`STAGE_SECONDS`.
+
+    The duration is also added to ``timings``, by default those of the
+    current :func:`collect`. Context variables do not follow work onto pool
+    threads, so code running there passes :func:`current_timings` along.
+    """
+    if timings is None:
+        timings = _timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe(STAGE_SECONDS, elapsed, stage=name)
+        if timings is not None:
+            timings.add(name, elapsed)
+
+
+class RequestStats:
+    __slots__ = ("start", "queries", "query_seconds", "status")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.status: int | None = None
+
+
+_request: ContextVar[RequestStats | None] = ContextVar("oneshot_request", default=None)
+
+
+def current_request() -> RequestStats | None:
+    """SQL statistics of the request being handled, if any."""
+    return _request.get()
+
+
+def init_app(app, engine) -> None:
+    """Record latency and SQL statistics for every request of ``app``."""
+    from flask import request
+    from sqlalchemy import event
+
+    registry.directory = app.config.get("METRICS_DIR")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.oneshot_query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stats = _request.get()
+        if stats is None:
+            return
+        stats.queries += 1
+        started = getattr(context, "oneshot_query_start", None)
+        if started is not None:
+            stats.query_seconds += time.perf_counter() - started
+
+    @app.before_request
+    def _start_request():
+        _request.set(RequestStats())
+
+    @app.after_request
+    def _note_status(response):
+        stats = _request.get()
+        if stats is not None:
+            stats.status = response.status_code
+        return response
+
+    # recorded on teardown so requests that raise are counted too
+    @app.teardown_request
+    def _record_request(exc):
+        stats = _request.get()
+        if stats is None:
+            return
+        _request.set(None)
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        registry.observe(
+            REQUEST_SECONDS,
+            time.perf_counter() - stats.start,
+            route=route,
+            method=request.method,
+            status=str(stats.status or 500),
+        )
+        registry.observe(REQUEST_QUERIES, stats.queries, route=route)
+        registry.observe(REQUEST_QUERY_SECONDS, stats.query_seconds, route=route)
+        registry.flush()
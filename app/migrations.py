@@ -0,0 +1,222 @@
+"""Versioned schema migrations for existing databases.
+
+Every migration runs once and is recorded in the ``schema_version`` table.
+Migrations are written to be idempotent because fresh databases are created
+with the current models before the runner starts, so a step may find its
+change already in place.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from .models import db
+from .storage import dataset_paths, owner_folder
+
+
+Migration = tuple[int, str, Callable[[Connection], None]]
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str):
+    """Register a migration step; versions must increase."""
+
+    def register(func: Callable[[Connection], None]):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+
+    return register
+
+
+def _columns(conn: Connection, table: str) -> list[str]:
+    return [c["name"] for c in inspect(conn).get_columns(table)]
+
+
+def _quote(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> bool:
+    """Add ``column`` unless it exists; returns whether it was added."""
+    if column in _columns(conn, table):
+        return False
+    conn.execute(text(f"ALTER TABLE {_quote(conn, table)} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def _archive_dir(conn: Connection) -> Path:
+    """Archive directory of the application the database belongs to."""
+    archive_dir = conn.info.get("archive_dir")
+    if archive_dir is None:
+        from .factory import create_app
+
+        archive_dir = create_app().config["ARCHIVE_DIR"]
+    return archive_dir
+
+
+def _create_index(
+    conn: Connection, name: str, table: str, columns: str, unique: bool = False
+) -> None:
+    # not every server supports CREATE INDEX IF NOT EXISTS
+    if name in {ix["name"] for ix in inspect(conn).get_indexes(table)}:
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    conn.execute(text(f"CREATE {kind} {name} ON {_quote(conn, table)} ({columns})"))
+
+
+@migration(1, "add dataset.team_id")
+def _dataset_team(conn: Connection) -> None:
+    _add_column(conn, "dataset", "team_id", "INTEGER")
+
+
+@migration(2, "add user.can_create_team")
+def _user_can_create_team(conn: Connection) -> None:
+    _add_column(conn, "user", "can_create_team", "BOOLEAN DEFAULT FALSE")
+
+
+@migration(3, "add dataset.blob_key")
+def _dataset_blob_key(conn: Connection) -> None:
+    _add_column(conn, "dataset", "blob_key", "VARCHAR(64)")
+
+
+@migration(4, "add lookup indexes and team member uniqueness")
+def _lookup_indexes(conn: Connection) -> None:
+    # drop duplicate memberships so the unique index can be built; the
+    # derived table keeps MySQL from rejecting the self-referencing delete
+    conn.execute(
+        text(
+            "DELETE FROM team_member WHERE id NOT IN (SELECT keep FROM "
+            "(SELECT MIN(id) AS keep FROM team_member GROUP BY team_id, user_id) AS keepers)"
+        )
+    )
+    indexes = [
+        ("uq_team_member_team_user", "team_member", "team_id, user_id", True),
+        ("ix_team_member_user_id", "team_member", "user_id", False),
+        ("ix_dataset_filename", "dataset", "filename", False),
+        ("ix_dataset_owner_team", "dataset", "owner_id, team_id", False),
+        ("ix_dataset_team_id", "dataset", "team_id", False),
+        ("ix_dataset_blob_key", "dataset", "blob_key", False),
+        ("ix_dataset_share_dataset_id", "dataset_share", "dataset_id", False),
+        ("ix_dataset_share_user_id", "dataset_share", "user_id", False),
+        ("ix_team_owner_id", "team", "owner_id", False),
+        ("ix_job_status", "job", "status", False),
+        ("ix_job_owner_status", "job", "owner_id, status", False),
+        ("ix_job_team_status", "job", "team_id, status", False),
+    ]
+    for name, table, columns, unique in indexes:
+        _create_index(conn, name, table, columns, unique)
+    if conn.dialect.name in ("sqlite", "postgresql"):
+        conn.execute(text("ANALYZE"))
+
+
+@migration(5, "add dataset.size_bytes and archive usage counters")
+def _usage_counters(conn: Connection) -> None:
+    if not _add_column(conn, "dataset", "size_bytes", "BIGINT NOT NULL DEFAULT 0"):
+        # created from the models, so the application keeps sizes and counters
+        return
+    archive_dir = _archive_dir(conn)
+    rows = conn.execute(text("SELECT id, filename, owner_id, team_id FROM dataset")).fetchall()
+    for dataset_id, filename, owner_id, team_id in rows:
+        folder = owner_folder(owner_id, team_id)
+        for paths in (dataset_paths(folder, filename), dataset_paths(folder, filename, False)):
+            path = archive_dir / paths.archive
+            if path.is_file():
+                conn.execute(
+                    text("UPDATE dataset SET size_bytes = :size WHERE id = :id"),
+                    {"size": path.stat().st_size, "id": dataset_id},
+                )
+                break
+    conn.execute(text("DELETE FROM archive_usage"))
+    conn.execute(
+        text(
+            "INSERT INTO archive_usage (scope, owner_id, datasets, bytes) "
+            "SELECT 'user', owner_id, COUNT(*), SUM(size_bytes) FROM dataset "
+            "WHERE team_id IS NULL GROUP BY owner_id"
+        )
+    )
+    conn.execute(
+        text(
+            "INSERT INTO archive_usage (scope, owner_id, datasets, bytes) "
+            "SELECT 'team', team_id, COUNT(*), SUM(size_bytes) FROM dataset "
+            "WHERE team_id IS NOT NULL GROUP BY team_id"
+        )
+    )
+
+
+@migration(6, "add archive listing indexes")
+def _listing_indexes(conn: Connection) -> None:
+    # listings page on (timestamp, id), which must not be NULL
+    conn.execute(
+        text("UPDATE dataset SET timestamp = :epoch WHERE timestamp IS NULL"),
+        {"epoch": datetime(1970, 1, 1)},
+    )
+    _create_index(conn, "ix_dataset_owner_timestamp", "dataset", "owner_id, team_id, timestamp, id")
+    _create_index(conn, "ix_dataset_team_timestamp", "dataset", "team_id, timestamp, id")
+
+
+@migration(7, "add job.plan")
+def _job_plan(conn: Connection) -> None:
+    _add_column(conn, "job", "plan", "VARCHAR(64)")
+
+
+@migration(8, "add job.worker and job.attempts")
+def _job_worker(conn: Connection) -> None:
+    _add_column(conn, "job", "worker", "VARCHAR(64)")
+    _add_column(conn, "job", "attempts", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(9, "add lease table")
+def _lease(conn: Connection) -> None:
+    db.metadata.tables["lease"].create(conn, checkfirst=True)
+
+
+@migration(10, "add job.memory_peak and job.memory_limit")
+def _job_memory(conn: Connection) -> None:
+    _add_column(conn, "job", "memory_peak", "BIGINT")
+    _add_column(conn, "job", "memory_limit", "BIGINT")
+
+
+def _ensure_version_table(conn: Connection) -> None:
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(200) NOT NULL, "
+            "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        )
+    )
+
+
+def applied_versions(engine: Engine) -> set[int]:
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+
+def migrate(engine: Engine, archive_dir: Path | None = None) -> list[int]:
+    """Bring the database behind ``engine`` up to date in place.
+
+    Tables that do not exist yet are created from the models first; each
+    pending migration then runs in its own transaction together with its
+    ``schema_version`` row. Steps that look at dataset files find them in
+    ``archive_dir``, by default that of :func:`~app.create_app`. Returns
+    the versions that were applied.
+    """
+    db.metadata.create_all(engine)
+    done = applied_versions(engine)
+    applied = []
+    for version, description, func in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            conn.info["archive_dir"] = archive_dir
+            func(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:v, :d)"),
+                {"v": version, "d": description},
+            )
+        applied.append(version)
+    return applied
@@ -1,6 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import ClassVar
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
 
 
 db = SQLAlchemy()
@@ -17,47 +21,99 @@ class User(db.Model, UserMixin):
 class Team(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     owner = db.relationship("User", backref="owned_teams")
 
 
 class TeamMember(db.Model):
+    __table_args__ = (
+        db.Index("uq_team_member_team_user", "team_id", "user_id", unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     team_id = db.Column(db.Integer, db.ForeignKey("team.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
 
 
 class Dataset(db.Model):
+    __table_args__ = (
+        db.Index("ix_dataset_owner_team", "owner_id", "team_id"),
+        # keyset pagination of the archive listings
+        db.Index("ix_dataset_owner_timestamp", "owner_id", "team_id", "timestamp", "id"),
+        db.Index("ix_dataset_team_timestamp", "team_id", "timestamp", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(120), nullable=False)
+    filename = db.Column(db.String(120), nullable=False, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     owner = db.relationship("User", backref="datasets")
-    team_id = db.Column(db.Integer, db.ForeignKey("team.id"))
+    team_id = db.Column(db.Integer, db.ForeignKey("team.id"), index=True)
     team = db.relationship("Team", backref="datasets")
+    blob_key = db.Column(db.String(64), index=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False, default=0)
 
 
 class DatasetShare(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    dataset_id = db.Column(db.Integer, db.ForeignKey("dataset.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    dataset_id = db.Column(db.Integer, db.ForeignKey("dataset.id"), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+
+
+class SettingsVersion(db.Model):
+    """Single-row counter bumped whenever a :class:`Setting` changes."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
 
 
 class Setting(db.Model):
-    """Key/value store for simple configuration flags."""
+    """Key/value store for simple configuration flags.
+
+    Reads are served from an in-process cache of all keys. It is dropped
+    locally by :meth:`set_bool`; other processes notice changes through
+    :class:`SettingsVersion`, which is checked at most once per
+    ``cache_ttl`` seconds, so most page renders run no settings query.
+    """
 
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(80), unique=True, nullable=False)
     bool_value = db.Column(db.Boolean, default=True)
 
+    cache_ttl = 5.0
+    _cache: ClassVar[dict[str, bool] | None] = None
+    _cache_version: ClassVar[int | None] = None
+    _cache_checked = 0.0
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def _version(cls) -> int:
+        return db.session.query(SettingsVersion.version).filter_by(id=1).scalar() or 0
+
+    @classmethod
+    def _values(cls) -> dict[str, bool]:
+        now = time.monotonic()
+        with cls._cache_lock:
+            if cls._cache is not None and now - cls._cache_checked < cls.cache_ttl:
+                return cls._cache
+            version = cls._version()
+            if cls._cache is None or version != cls._cache_version:
+                cls._cache = {
+                    key: bool(value)
+                    for key, value in db.session.query(cls.key, cls.bool_value)
+                }
+                cls._cache_version = version
+            cls._cache_checked = now
+            return cls._cache
+
+    @classmethod
+    def invalidate_cache(cls) -> None:
+        with cls._cache_lock:
+            cls._cache = None
+
     @classmethod
     def get_bool(cls, key: str, default: bool = True) -> bool:
-        setting = cls.query.filter_by(key=key).first()
-        if setting is None:
-            setting = cls(key=key, bool_value=default)
-            db.session.add(setting)
-            db.session.commit()
-        return bool(setting.bool_value)
+        return cls._values().get(key, default)
 
     @classmethod
     def set_bool(cls, key: str, value: bool) -> None:
@@ -67,5 +123,224 @@ class Setting(db.Model):
             db.session.add(setting)
         else:
             setting.bool_value = value
+        if not SettingsVersion.query.filter_by(id=1).update(
+            {"version": SettingsVersion.version + 1}
+        ):
+            db.session.add(SettingsVersion(id=1, version=1))
         db.session.commit()
+        cls.invalidate_cache()
+
+
+class Lease(db.Model):
+    """Named lock held by one process at a time until it expires.
+
+    Used for periodic work that must not run in every web worker at once.
+    """
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def acquire(cls, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew the lease ``name`` for ``ttl`` seconds and commit."""
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=ttl)
+        taken = cls.query.filter(
+            cls.name == name, db.or_(cls.holder == holder, cls.expires_at < now)
+        ).update({"holder": holder, "expires_at": expires}, synchronize_session=False)
+        if not taken:
+            if db.session.get(cls, name) is not None:
+                db.session.commit()
+                return False
+            db.session.add(cls(name=name, holder=holder, expires_at=expires))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False  # created concurrently
+        return True
+
+
+class Job(db.Model):
+    """Background upload processing job."""
+
+    __table_args__ = (
+        db.Index("ix_job_owner_status", "owner_id", "status"),
+        db.Index("ix_job_team_status", "team_id", "status"),
+    )
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    owner = db.relationship("User", backref="jobs")
+    team_id = db.Column(db.Integer, db.ForeignKey("team.id"))
+    filename = db.Column(db.String(255), nullable=False)
+    # augmentation plan chosen for the upload; None for the configured default
+    plan = db.Column(db.String(64))
+    dataset_id = db.Column(db.Integer, db.ForeignKey("dataset.id"))
+    error = db.Column(db.Text)
+    # ``host:pid:token`` of the queue running the job; updated_at is its heartbeat
+    worker = db.Column(db.String(64))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # bytes held at most and allowed, for uploads that took the bounded path
+    memory_peak = db.Column(db.BigInteger)
+    memory_limit = db.Column(db.BigInteger)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Blob(db.Model):
+    """Reference count for a content-addressed dataset in the store."""
+
+    key = db.Column(db.String(64), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def acquire(cls, key: str) -> None:
+        """Add a reference to ``key``, creating the row if needed."""
+        for _ in range(2):
+            if cls.query.filter_by(key=key).update({"refcount": cls.refcount + 1}):
+                db.session.commit()
+                return
+            db.session.add(cls(key=key, refcount=1))
+            try:
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+        raise RuntimeError(f"could not reference blob {key}")
+
+    @classmethod
+    def release(cls, key: str) -> bool:
+        """Drop a reference and return ``True`` if it was the last one.
+
+        Does not commit, so callers can release inside their own
+        transaction; the stored files should only be removed after it has
+        been committed.
+        """
+        cls.query.filter_by(key=key).update({"refcount": cls.refcount - 1})
+        return bool(cls.query.filter(cls.key == key, cls.refcount <= 0).delete())
+
+
+class Usage(db.Model):
+    """Dataset count and archive bytes per personal or team archive.
+
+    ``datasets`` includes reservations held by uploads that are still
+    processing, so a quota check is a single conditional ``UPDATE`` that
+    stays correct when uploads race each other.
+    """
+
+    __tablename__ = "archive_usage"
+    __table_args__ = (
+        db.Index("uq_archive_usage_scope_owner", "scope", "owner_id", unique=True),
+    )
+
+    USER = "user"
+    TEAM = "team"
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(8), nullable=False)
+    owner_id = db.Column(db.Integer, nullable=False)
+    datasets = db.Column(db.Integer, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @staticmethod
+    def scope_of(owner_id: int, team_id: int | None) -> tuple[str, int]:
+        return (Usage.TEAM, team_id) if team_id else (Usage.USER, owner_id)
+
+    @staticmethod
+    def _filters(scope: str, owner_id: int):
+        if scope == Usage.TEAM:
+            return [Dataset.team_id == owner_id], [Job.team_id == owner_id]
+        return (
+            [Dataset.owner_id == owner_id, Dataset.team_id.is_(None)],
+            [Job.owner_id == owner_id, Job.team_id.is_(None)],
+        )
+
+    @classmethod
+    def _measure(cls, scope: str, owner_id: int) -> tuple[int, int]:
+        """Count datasets, pending jobs and bytes from the source tables."""
+        dataset_filter, job_filter = cls._filters(scope, owner_id)
+        count, size = db.session.query(
+            db.func.count(Dataset.id), db.func.coalesce(db.func.sum(Dataset.size_bytes), 0)
+        ).filter(*dataset_filter).one()
+        pending = Job.query.filter(
+            *job_filter, Job.status.in_([Job.QUEUED, Job.RUNNING])
+        ).count()
+        return count + pending, size
+
+    @classmethod
+    def _ensure(cls, scope: str, owner_id: int) -> None:
+        if cls.query.filter_by(scope=scope, owner_id=owner_id).first() is not None:
+            return
+        datasets, size = cls._measure(scope, owner_id)
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(scope=scope, owner_id=owner_id, datasets=datasets, bytes=size))
+        except IntegrityError:
+            pass  # created concurrently
+
+    @classmethod
+    def reserve(
+        cls, scope: str, owner_id: int, max_datasets: int, max_bytes: int = 0, commit: bool = True
+    ) -> bool:
+        """Atomically take one dataset slot if the archive is below its limits.
+
+        ``max_bytes`` of 0 disables the size limit. The reservation is
+        committed immediately unless ``commit`` is false, in which case the
+        caller commits it together with the job holding it. It must be
+        released with :meth:`release` if the upload does not produce a
+        dataset.
+        """
+        cls._ensure(scope, owner_id)
+        query = cls.query.filter(
+            cls.scope == scope, cls.owner_id == owner_id, cls.datasets < max_datasets
+        )
+        if max_bytes:
+            query = query.filter(cls.bytes < max_bytes)
+        reserved = query.update({"datasets": cls.datasets + 1}, synchronize_session=False)
+        if commit:
+            db.session.commit()
+        return bool(reserved)
+
+    @classmethod
+    def release(cls, scope: str, owner_id: int, datasets: int = 1, size: int = 0) -> None:
+        """Give back dataset slots and bytes; does not commit."""
+        cls.query.filter_by(scope=scope, owner_id=owner_id).update(
+            {"datasets": cls.datasets - datasets, "bytes": cls.bytes - size},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def add_bytes(cls, scope: str, owner_id: int, size: int) -> None:
+        """Account the size of a dataset created from a reservation; does not commit."""
+        cls.query.filter_by(scope=scope, owner_id=owner_id).update(
+            {"bytes": cls.bytes + size}, synchronize_session=False
+        )
+
+    @classmethod
+    def count(cls, scope: str, owner_id: int) -> int:
+        """Current number of datasets (including reservations), read only."""
+        value = db.session.query(cls.datasets).filter_by(scope=scope, owner_id=owner_id).scalar()
+        return value if value is not None else cls._measure(scope, owner_id)[0]
+
+    @classmethod
+    def correct(
+        cls, scope: str, owner_id: int, stored: tuple[int, int], actual: tuple[int, int]
+    ) -> bool:
+        """Set a drifted counter to ``actual`` if it still holds ``stored``; does not commit.
 
+        Reservations and releases that happened since ``stored`` was read
+        make this a no-op instead of being overwritten.
+        """
+        corrected = cls.query.filter_by(
+            scope=scope, owner_id=owner_id, datasets=stored[0], bytes=stored[1]
+        ).update({"datasets": actual[0], "bytes": actual[1]}, synchronize_session=False)
+        return bool(corrected)
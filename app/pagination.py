@@ -0,0 +1,108 @@
+import base64
+import json
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import and_, or_, select, union_all
+from sqlalchemy.orm import aliased
+
+
+# SQLite allows at most 500 terms in one compound SELECT
+UNION_PARTS = 100
+
+
+class Page(NamedTuple):
+    """One page of rows and the cursor for the next one (``None`` at the end)."""
+
+    items: list
+    next_cursor: str | None
+
+
+def encode_cursor(values: list) -> str:
+    """Pack the sort key of the last row into an opaque URL-safe token."""
+    plain = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(plain, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns) -> list:
+    """Unpack a token from :func:`encode_cursor`; raises ``ValueError`` if invalid."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception as exc:
+        raise ValueError("invalid cursor") from exc
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("invalid cursor")
+    decoded = []
+    for column, value in zip(columns, values):
+        if column.type.python_type is datetime:
+            if not isinstance(value, str):
+                raise ValueError("invalid cursor")
+            value = datetime.fromisoformat(value)  # raises ValueError itself
+        elif isinstance(value, bool) or not isinstance(value, column.type.python_type):
+            raise ValueError("invalid cursor")
+        decoded.append(value)
+    return decoded
+
+
+def _after(columns, values, descending: bool):
+    """Rows that sort strictly after ``values``, spelled out so indexes apply."""
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, step))
+    return or_(*clauses)
+
+
+def _union(parts, columns, descending: bool, limit: int) -> list:
+    # SQLite only accepts ORDER BY and LIMIT in compound members inside a subquery
+    model = parts[0].column_descriptions[0]["entity"]
+    union = union_all(*(select(*part.subquery().c) for part in parts)).subquery()
+    entity = aliased(model, union, adapt_on_names=True)
+    sort = [getattr(entity, c.key) for c in columns]
+    order = [c.desc() if descending else c.asc() for c in sort]
+    return parts[0].session.query(entity).order_by(*order).limit(limit).all()
+
+
+def keyset_page(query, columns, cursor: str | None, size: int, descending: bool = True) -> Page:
+    """Return the page of ``query`` that follows ``cursor``.
+
+    ``columns`` is the unique sort key, e.g. ``(Dataset.timestamp,
+    Dataset.id)``. Instead of an ``OFFSET`` the query seeks past the last
+    row of the previous page, so with a matching index every page costs the
+    same no matter how deep into the listing it is.
+    """
+    return merged_page([query], columns, cursor, size, descending)
+
+
+def merged_page(
+    queries, columns, cursor: str | None, size: int, descending: bool = True
+) -> Page:
+    """Like :func:`keyset_page` for the rows of several disjoint ``queries``.
+
+    Every query takes its own page and one ``UNION ALL`` statement merges
+    them, so each part seeks along its own index; combining the filters
+    with ``OR`` would collect and sort all matching rows for every page.
+    """
+    values = decode_cursor(cursor, columns) if cursor else None
+    order = [c.desc() if descending else c.asc() for c in columns]
+    parts = []
+    for query in queries:
+        if values is not None:
+            query = query.filter(_after(columns, values, descending))
+        parts.append(query.order_by(*order).limit(size + 1))
+    rows = []
+    for start in range(0, len(parts), UNION_PARTS):
+        chunk = parts[start:start + UNION_PARTS]
+        if len(chunk) > 1:
+            rows.extend(_union(chunk, columns, descending, size + 1))
+        else:
+            rows.extend(chunk[0].all())
+    if len(parts) > UNION_PARTS:
+        rows.sort(key=lambda row: [getattr(row, c.key) for c in columns], reverse=descending)
+    if len(rows) <= size:
+        return Page(rows, None)
+    last = rows[size - 1]
+    return Page(rows[:size], encode_cursor([getattr(last, c.key) for c in columns]))
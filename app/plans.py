@@ -0,0 +1,443 @@
+"""Declarative augmentation plans compiled into transform graphs.
+
+A plan lists the outputs generated for every upload. Each output applies
+at most one transform to its source, which is the decoded upload or one of
+the plan's named ``bases``::
+
+    {
+        "bases": {"small": {"max_side": 1024}},
+        "outputs": [
+            {"name": "original"},
+            {"name": "top_half", "box": [0, 0, 1, 0.5]},
+            {"name": "center", "center": 0.8},
+            {"name": "tile", "grid": [3, 3], "source": "small"},
+            {"name": "square", "resize": [1024, 1024]}
+        ],
+        "mirror": true
+    }
+
+Transforms are ``box`` (fractions of the source), ``center`` (a fraction
+of each side or a ``[width, height]`` in pixels), ``resize`` (scale to
+cover ``[width, height]`` and crop the middle), ``max_side`` (shrink to
+fit), ``scale`` and, for outputs only, ``grid`` (``[columns, rows]``
+tiles named ``<name>_r<row>c<col>``). With ``mirror`` every output is
+followed, after all of them, by its horizontally flipped ``_flip``
+version; single outputs opt out with ``"mirror": false``.
+
+With ``buckets`` (for example ``[512, 768, 1024]``) every output is then
+resized to a training bucket: the listed long side nearest to its own and
+a short side that keeps the aspect ratio, rounded to a multiple of
+``bucket_step`` (64 by default). The output is scaled to cover the bucket
+and its middle is kept, like ``resize``.
+
+:meth:`Plan.compile` turns a plan into a :class:`Graph` for one image
+size. Equal steps are merged, so a downscaled base or a crop that is also
+mirrored is computed once however many outputs use it. Bucketed outputs
+cut from the same image at the same scale share one resampling pass over
+the area they cover, and mirrors flip the resampled pixels.
+"""
+from typing import NamedTuple
+import hashlib
+import json
+import math
+import re
+
+
+class PlanError(ValueError):
+    """Raised for an invalid or unknown augmentation plan."""
+
+
+DEFAULT_PLAN = "default"
+
+# the original recipe: the image, its halves and quarters, and their mirrors
+DEFAULT_SPEC = {
+    "outputs": [
+        {"name": "original"},
+        {"name": "top_half", "box": [0, 0, 1, 0.5]},
+        {"name": "bottom_half", "box": [0, 0.5, 1, 1]},
+        {"name": "top_left", "box": [0, 0, 0.5, 0.5]},
+        {"name": "top_right", "box": [0.5, 0, 1, 0.5]},
+        {"name": "bottom_left", "box": [0, 0.5, 0.5, 1]},
+        {"name": "bottom_right", "box": [0.5, 0.5, 1, 1]},
+    ],
+    "mirror": True,
+}
+
+MAX_OUTPUTS = 1000
+TRANSFORMS = ("box", "center", "resize", "max_side", "scale")
+_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+class Node(NamedTuple):
+    """One step of a :class:`Graph`.
+
+    ``op`` is ``source``, ``crop`` (``args`` is the box), ``resize``
+    (``args`` is the new size) or ``flip``; ``parent`` indexes the node
+    it reads from and ``size`` is the size it produces.
+    """
+
+    op: str
+    parent: int | None
+    args: tuple
+    size: tuple[int, int]
+
+
+class Graph(NamedTuple):
+    """Nodes in dependency order and ``(suffix, node)`` for every output.
+
+    ``buckets`` maps the suffixes of a bucketed plan to their bucket size.
+    """
+
+    nodes: list[Node]
+    outputs: list[tuple[str, int]]
+    buckets: dict[str, tuple[int, int]] | None = None
+
+    def consumers(self) -> list[int]:
+        """How often each node is read, by child nodes and by outputs."""
+        counts = [0] * len(self.nodes)
+        for node in self.nodes:
+            if node.parent is not None:
+                counts[node.parent] += 1
+        for _, index in self.outputs:
+            counts[index] += 1
+        return counts
+
+
+class _Builder:
+    def __init__(self, size: tuple[int, int]):
+        self.nodes = [Node("source", None, (), size)]
+        self._index: dict[tuple, int] = {}
+
+    def add(self, op: str, parent: int, args: tuple, size: tuple[int, int]) -> int:
+        key = (op, parent, args)
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = len(self.nodes)
+            self.nodes.append(Node(op, parent, args, size))
+        return index
+
+    def crop(self, parent: int, box: tuple[int, int, int, int]) -> int:
+        w, h = self.nodes[parent].size
+        box = (max(0, box[0]), max(0, box[1]), min(w, box[2]), min(h, box[3]))
+        if box == (0, 0, w, h):
+            return parent
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise PlanError(f"empty crop {box} of a {w}x{h} image")
+        return self.add("crop", parent, box, (box[2] - box[0], box[3] - box[1]))
+
+    def resize(self, parent: int, size: tuple[int, int]) -> int:
+        size = (max(1, size[0]), max(1, size[1]))
+        if size == self.nodes[parent].size:
+            return parent
+        return self.add("resize", parent, size, size)
+
+    def flip(self, parent: int) -> int:
+        return self.add("flip", parent, (), self.nodes[parent].size)
+
+    def region(self, index: int) -> tuple[int, tuple[int, int, int, int]]:
+        """The first node above ``index`` that is not a crop, and the box of
+        ``index`` within it."""
+        w, h = self.nodes[index].size
+        left, top = 0, 0
+        while self.nodes[index].op == "crop":
+            node = self.nodes[index]
+            left, top = left + node.args[0], top + node.args[1]
+            index = node.parent
+        return index, (left, top, left + w, top + h)
+
+    def graph(self, outputs: list[tuple[str, int]], buckets=None) -> Graph:
+        """The graph of ``outputs`` without the nodes none of them needs."""
+        used = set()
+        for _, index in outputs:
+            while index is not None and index not in used:
+                used.add(index)
+                index = self.nodes[index].parent
+        remap = {old: new for new, old in enumerate(sorted(used))}
+        nodes = [
+            node._replace(parent=None if node.parent is None else remap[node.parent])
+            for old, node in enumerate(self.nodes)
+            if old in used
+        ]
+        return Graph(nodes, [(name, remap[index]) for name, index in outputs], buckets)
+
+    def transform(self, parent: int, step: dict) -> int:
+        w, h = self.nodes[parent].size
+        if "box" in step:
+            x0, y0, x1, y1 = step["box"]
+            return self.crop(
+                parent, (math.floor(x0 * w), math.floor(y0 * h), math.floor(x1 * w), math.floor(y1 * h))
+            )
+        if "center" in step:
+            center = step["center"]
+            if isinstance(center, list):
+                cw, ch = min(w, center[0]), min(h, center[1])
+            else:
+                cw, ch = max(1, round(w * center)), max(1, round(h * center))
+            left, top = (w - cw) // 2, (h - ch) // 2
+            return self.crop(parent, (left, top, left + cw, top + ch))
+        if "resize" in step:
+            tw, th = step["resize"]
+            scale = max(tw / w, th / h)
+            scaled = self.resize(parent, (max(tw, round(w * scale)), max(th, round(h * scale))))
+            sw, sh = self.nodes[scaled].size
+            left, top = (sw - tw) // 2, (sh - th) // 2
+            return self.crop(scaled, (left, top, left + tw, top + th))
+        if "max_side" in step:
+            scale = step["max_side"] / max(w, h)
+            if scale >= 1:
+                return parent
+            return self.resize(parent, (round(w * scale), round(h * scale)))
+        if "scale" in step:
+            return self.resize(parent, (round(w * step["scale"]), round(h * step["scale"])))
+        return parent
+
+
+def bucket_size(size: tuple[int, int], sides, step: int = 64) -> tuple[int, int]:
+    """The training bucket for an image of ``size``.
+
+    The long side becomes the entry of ``sides`` nearest to it, the smaller
+    one on ties, and the short side keeps the aspect ratio rounded to a
+    multiple of ``step``.
+    """
+    w, h = size
+    long_side, short_side = max(w, h), min(w, h)
+    side = min(sides, key=lambda s: (abs(s - long_side), s))
+    other = min(side, max(step, round(side * short_side / long_side / step) * step))
+    return (side, other) if w >= h else (other, side)
+
+
+def _number(value, name: str, positive: bool = True) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise PlanError(f"{name} must be a number")
+    if positive and value <= 0:
+        raise PlanError(f"{name} must be positive")
+    return value
+
+
+def _pair(value, name: str) -> list[int]:
+    if not (isinstance(value, list) and len(value) == 2 and all(isinstance(v, int) for v in value)):
+        raise PlanError(f"{name} must be a list of two integers")
+    if min(value) < 1:
+        raise PlanError(f"{name} must be positive")
+    return list(value)
+
+
+def _step(spec, where: str, grid: bool) -> dict:
+    """Validate one base or output and return it with only the known keys."""
+    if not isinstance(spec, dict):
+        raise PlanError(f"{where} must be an object")
+    allowed = TRANSFORMS + ("grid",) if grid else TRANSFORMS
+    given = [key for key in allowed if key in spec]
+    if len(given) > 1:
+        raise PlanError(f"{where} combines {' and '.join(given)}; use a base for the first step")
+    step = {}
+    if "box" in spec:
+        box = spec["box"]
+        if not (isinstance(box, list) and len(box) == 4):
+            raise PlanError(f"{where}: box must be four fractions")
+        box = [_number(v, f"{where}: box", positive=False) for v in box]
+        if not (0 <= box[0] < box[2] <= 1 and 0 <= box[1] < box[3] <= 1):
+            raise PlanError(f"{where}: box must lie within [0, 1] and not be empty")
+        step["box"] = box
+    elif "center" in spec:
+        center = spec["center"]
+        if isinstance(center, list):
+            step["center"] = _pair(center, f"{where}: center")
+        elif not 0 < _number(center, f"{where}: center") <= 1:
+            raise PlanError(f"{where}: center must be a fraction up to 1 or a [width, height]")
+        else:
+            step["center"] = center
+    elif "resize" in spec:
+        step["resize"] = _pair(spec["resize"], f"{where}: resize")
+    elif "max_side" in spec:
+        step["max_side"] = int(_number(spec["max_side"], f"{where}: max_side"))
+    elif "scale" in spec:
+        step["scale"] = _number(spec["scale"], f"{where}: scale")
+    elif "grid" in spec:
+        step["grid"] = _pair(spec["grid"], f"{where}: grid")
+    if "source" in spec:
+        if not isinstance(spec["source"], str):
+            raise PlanError(f"{where}: source must be a base name")
+        step["source"] = spec["source"]
+    return step
+
+
+class Plan:
+    """A validated augmentation plan.
+
+    ``fingerprint`` identifies what the plan produces; through
+    :attr:`content_fingerprint` it is part of the content key of generated
+    datasets, so changing a plan never reuses outputs of its previous
+    version.
+    """
+
+    def __init__(self, name: str, spec: dict):
+        if not isinstance(spec, dict):
+            raise PlanError(f"plan {name!r} must be an object")
+        self.name = name
+        where = f"plan {name!r}"
+        bases_spec = spec.get("bases", {})
+        if not isinstance(bases_spec, dict):
+            raise PlanError(f"{where}: bases must be an object")
+        self.bases: dict[str, dict] = {}
+        # bases may only refer to bases defined before them, so they cannot loop
+        for base, base_spec in bases_spec.items():
+            self.bases[base] = self._sourced(_step(base_spec, f"{where}, base {base!r}", False), where)
+        outputs = spec.get("outputs")
+        if not isinstance(outputs, list) or not outputs:
+            raise PlanError(f"{where} needs a list of outputs")
+        self.mirror = bool(spec.get("mirror", False))
+        self.outputs = []
+        for i, out in enumerate(outputs):
+            step = self._sourced(_step(out, f"{where}, output {i}", True), where)
+            name = out.get("name")
+            if not isinstance(name, str) or not _NAME.match(name):
+                raise PlanError(f"{where}, output {i}: name must be letters, digits, _ or -")
+            step["name"] = name
+            step["mirror"] = bool(out.get("mirror", self.mirror))
+            self.outputs.append(step)
+        names = self.output_names()
+        if len(names) > MAX_OUTPUTS:
+            raise PlanError(f"{where} has {len(names)} outputs, at most {MAX_OUTPUTS} are allowed")
+        duplicates = sorted({n for n in names if names.count(n) > 1})
+        if duplicates:
+            raise PlanError(f"{where} names several outputs {', '.join(duplicates)}")
+        self.buckets: list[int] = []
+        self.bucket_step = 64
+        canonical = {"bases": self.bases, "outputs": self.outputs}
+        if spec.get("buckets") is not None:
+            buckets = spec["buckets"]
+            valid = isinstance(buckets, list) and all(type(b) is int and b > 0 for b in buckets)
+            if not (valid and buckets):
+                raise PlanError(f"{where}: buckets must be a list of positive integers")
+            step = spec.get("bucket_step", 64)
+            if type(step) is not int or step < 1:
+                raise PlanError(f"{where}: bucket_step must be a positive integer")
+            self.buckets, self.bucket_step = sorted(set(buckets)), step
+            # only part of the fingerprint when set, so plain plans keep theirs
+            canonical["buckets"] = {"sides": self.buckets, "step": step}
+        canonical = json.dumps(canonical, sort_keys=True)
+        self.fingerprint = hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+    @property
+    def content_fingerprint(self) -> str:
+        """What the plan adds to content keys and manifests.
+
+        Empty for plans producing the original recipe, so their datasets
+        keep the content keys and archives they had before plans existed.
+        """
+        return "" if self.fingerprint == default_plan().fingerprint else self.fingerprint
+
+    def _sourced(self, step: dict, where: str) -> dict:
+        source = step.get("source")
+        if source is not None and source not in self.bases:
+            raise PlanError(f"{where}: unknown base {source!r}")
+        return step
+
+    def _names(self, step: dict) -> list[str]:
+        if "grid" not in step:
+            return [step["name"]]
+        cols, rows = step["grid"]
+        return [f"{step['name']}_r{r}c{c}" for r in range(rows) for c in range(cols)]
+
+    def output_names(self) -> list[str]:
+        """Suffixes of all outputs in archive order."""
+        names = [name for step in self.outputs for name in self._names(step)]
+        names += [f"{name}_flip" for step in self.outputs if step["mirror"] for name in self._names(step)]
+        return names
+
+    def compile(self, size: tuple[int, int]) -> Graph:
+        """The transform graph of this plan for a ``size`` source image."""
+        builder = _Builder(size)
+        bases: dict[str, int] = {}
+
+        def source_of(step: dict) -> int:
+            return bases[step["source"]] if "source" in step else 0
+
+        for base, step in self.bases.items():
+            bases[base] = builder.transform(source_of(step), step)
+        plain: list[tuple[str, int, bool]] = []
+        for step in self.outputs:
+            parent = source_of(step)
+            if "grid" in step:
+                cols, rows = step["grid"]
+                w, h = builder.nodes[parent].size
+                for r in range(rows):
+                    for c in range(cols):
+                        box = (c * w // cols, r * h // rows, (c + 1) * w // cols, (r + 1) * h // rows)
+                        plain.append((f"{step['name']}_r{r}c{c}", builder.crop(parent, box), step["mirror"]))
+            else:
+                plain.append((step["name"], builder.transform(parent, step), step["mirror"]))
+        buckets = None
+        if self.buckets:
+            plain, buckets = self._bucketed(builder, plain)
+        outputs = [(name, index) for name, index, _ in plain]
+        outputs += [(f"{name}_flip", builder.flip(index)) for name, index, mirror in plain if mirror]
+        if buckets is not None:
+            buckets.update({f"{name}_flip": buckets[name] for name, _, mirror in plain if mirror})
+        return builder.graph(outputs, buckets)
+
+    def _bucketed(self, builder: _Builder, plain: list) -> tuple[list, dict]:
+        """Move every output to its bucket.
+
+        Outputs cut from the same node that need the same scale are
+        resampled together: the box covering all of them is scaled once
+        and each bucket is cut from the middle of its own area.
+        """
+        groups: dict[tuple[int, float], list[int]] = {}
+        regions = []
+        for i, (_, index, _) in enumerate(plain):
+            root, box = builder.region(index)
+            bw, bh = box[2] - box[0], box[3] - box[1]
+            target = bucket_size((bw, bh), self.buckets, self.bucket_step)
+            scale = max(target[0] / bw, target[1] / bh)
+            regions.append((box, target))
+            groups.setdefault((root, round(scale, 9)), []).append(i)
+        result = list(plain)
+        buckets = {}
+        for (root, scale), members in groups.items():
+            boxes = [regions[i][0] for i in members]
+            union = (
+                min(b[0] for b in boxes),
+                min(b[1] for b in boxes),
+                max(b[2] for b in boxes),
+                max(b[3] for b in boxes),
+            )
+            uw, uh = union[2] - union[0], union[3] - union[1]
+            scaled = builder.crop(root, union)
+            scaled = builder.resize(scaled, (round(uw * scale), round(uh * scale)))
+            sw, sh = builder.nodes[scaled].size
+            for i in members:
+                box, (tw, th) = regions[i]
+                cx = ((box[0] + box[2]) / 2 - union[0]) * sw / uw
+                cy = ((box[1] + box[3]) / 2 - union[1]) * sh / uh
+                left = min(max(0, round(cx - tw / 2)), sw - tw)
+                top = min(max(0, round(cy - th / 2)), sh - th)
+                name, _, mirror = plain[i]
+                result[i] = (name, builder.crop(scaled, (left, top, left + tw, top + th)), mirror)
+                buckets[name] = (tw, th)
+        return result, buckets
+
+
+def load_plans(specs: dict | None) -> dict[str, Plan]:
+    """The built-in ``default`` plan and the plans configured in ``specs``."""
+    if specs is None:
+        specs = {}
+    if not isinstance(specs, dict):
+        raise PlanError("augmentation_plans must map plan names to plans")
+    plans = {DEFAULT_PLAN: Plan(DEFAULT_PLAN, DEFAULT_SPEC)}
+    for name, spec in specs.items():
+        if not _NAME.match(name):
+            raise PlanError(f"invalid plan name {name!r}")
+        plans[name] = Plan(name, spec)
+    return plans
+
+
+_default: Plan | None = None
+
+
+def default_plan() -> Plan:
+    global _default
+    if _default is None:
+        _default = Plan(DEFAULT_PLAN, DEFAULT_SPEC)
+    return _default
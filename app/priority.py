@@ -0,0 +1,19 @@
+import os
+import threading
+
+
+def lower_thread_priority(increment: int) -> None:
+    """Raise the nice value of the calling thread by ``increment``.
+
+    On Linux the priority applies to the individual thread, so background
+    work such as image processing yields the CPU to request handlers in the
+    same process. A no-op where per-thread priorities are not available.
+    """
+    if increment <= 0 or not hasattr(os, "setpriority"):
+        return
+    try:
+        tid = threading.get_native_id()
+        current = os.getpriority(os.PRIO_PROCESS, tid)
+        os.setpriority(os.PRIO_PROCESS, tid, min(19, current + increment))
+    except OSError:
+        pass
@@ -1,52 +1,455 @@
 from PIL import Image
 from pathlib import Path
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, NamedTuple
+import itertools
+import math
+import os
+import threading
 
+from .config import load_config
+from .metrics import Timings, current_timings, stage
+from .plans import Graph, Plan, default_plan
+from .priority import lower_thread_priority
 
-def crop_and_flip(image: Image.Image, base_name: str, ext: str) -> list[tuple[str, BytesIO]]:
-    w, h = image.size
-    outputs: list[tuple[str, BytesIO]] = []
-
-    def add(img: Image.Image, suffix: str):
-        buffer = BytesIO()
-        filename = f"{base_name}_{suffix}.{ext}"
-        fmt = (image.format or ext).upper()
-        if fmt == "JPG":
-            fmt = "JPEG"
-        img.save(buffer, format=fmt)
-        buffer.seek(0)
-        outputs.append((filename, buffer))
-
-    # Original
-    add(image, "original")
-
-    # Crops
-    crops = {
-        "top_half": (0, 0, w, h // 2),
-        "bottom_half": (0, h // 2, w, h),
-        "top_left": (0, 0, w // 2, h // 2),
-        "top_right": (w // 2, 0, w, h // 2),
-        "bottom_left": (0, h // 2, w // 2, h),
-        "bottom_right": (w // 2, h // 2, w, h),
-    }
-
-    for name, box in crops.items():
-        cropped = image.crop(box)
-        add(cropped, name)
-
-    # Flip all existing
-    originals = outputs.copy()
-    for filename, buffer in originals:
-        img = Image.open(buffer)
-        flipped = img.transpose(Image.FLIP_LEFT_RIGHT)
-        flip_name = filename.replace(f".{ext}", f"_flip.{ext}")
-        flip_buffer = BytesIO()
-        fmt = (img.format or ext).upper()
-        if fmt == "JPG":
-            fmt = "JPEG"
-        flipped.save(flip_buffer, format=fmt)
-        flip_buffer.seek(0)
-        outputs.append((flip_name, flip_buffer))
-        buffer.seek(0)
-
-    return outputs
+
+_encode_pool: ThreadPoolExecutor | None = None
+_encode_workers: int | None = None
+_encode_nice = 0
+_pool_lock = threading.Lock()
+
+
+def encode_workers() -> int:
+    """Number of threads used to encode variants in parallel.
+
+    Read once from ``encode_workers`` in ``config.json`` (or the
+    ``ENCODE_WORKERS`` environment variable) and defaults to the CPU count.
+    """
+    global _encode_workers
+    if _encode_workers is None:
+        config = load_config()
+        workers = config.get("encode_workers", os.getenv("ENCODE_WORKERS"))
+        _encode_workers = max(1, int(workers or os.cpu_count() or 1))
+    return _encode_workers
+
+
+def set_encode_workers(workers: int) -> None:
+    """Resize the shared encode pool, e.g. from a command line flag."""
+    global _encode_pool, _encode_workers
+    with _pool_lock:
+        if _encode_pool is not None:
+            _encode_pool.shutdown(wait=True)
+            _encode_pool = None
+        _encode_workers = max(1, int(workers))
+
+
+def set_encode_priority(increment: int) -> None:
+    """Lower the priority of encode threads created from now on by ``increment``."""
+    global _encode_nice
+    _encode_nice = max(0, int(increment))
+
+
+def get_encode_pool() -> ThreadPoolExecutor:
+    """Return the process-wide thread pool used for encoding."""
+    global _encode_pool
+    with _pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(
+                max_workers=encode_workers(),
+                thread_name_prefix="encode",
+                initializer=lower_thread_priority,
+                initargs=(_encode_nice,),
+            )
+        return _encode_pool
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an image cannot be decoded within the memory limit."""
+
+
+class MemoryBudget:
+    """Account for the pixel and encoded bytes one job holds at a time.
+
+    Only buffers owned by the pipeline are tracked (decoded source, the
+    nodes being rendered or kept for later outputs and the encoded output),
+    which is what grows with the image size. ``peak`` is the high-water
+    mark for the job and ``needed`` what :func:`open_image` expected it to
+    be.
+    """
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.current = 0
+        self.peak = 0
+        self.source_size: tuple[int, int] | None = None
+        self.needed: int | None = None
+
+    def hold(self, nbytes: int) -> None:
+        """Account for ``nbytes`` more, raising :class:`ImageTooLarge` past the limit."""
+        if self.current + nbytes > self.limit:
+            raise ImageTooLarge(
+                f"Image too large: processing needs more than the {_megabytes(self.limit)} memory limit"
+            )
+        self.current += nbytes
+        self.peak = max(self.peak, self.current)
+
+    def release(self, nbytes: int) -> None:
+        self.current -= nbytes
+
+
+def memory_limit() -> int:
+    """Per-job memory limit in bytes from ``memory_limit_mb`` (default 1024)."""
+    config = load_config()
+    return int(config.get("memory_limit_mb", os.getenv("MEMORY_LIMIT_MB", "1024"))) * 1024 * 1024
+
+
+def large_image_pixels() -> int:
+    """Pixel count above which uploads use the bounded-memory path."""
+    config = load_config()
+    return int(config.get("large_image_pixels", os.getenv("LARGE_IMAGE_PIXELS", "40000000")))
+
+
+def _image_bytes(size: tuple[int, int], mode: str) -> int:
+    return size[0] * size[1] * Image.getmodebands(mode)
+
+
+def _megabytes(nbytes: int) -> str:
+    return f"{nbytes / (1024 * 1024):.1f} MB"
+
+
+def open_image(
+    stream: BinaryIO, budget: MemoryBudget | None = None, plan: Plan | None = None
+) -> Image.Image:
+    """Open ``stream`` and, with a ``budget``, decode it within its limit.
+
+    Before decoding, ``plan`` (the default recipe if omitted) is compiled
+    for the size in the image header and :func:`bounded_peak` tells how
+    much rendering it will hold. Sources that would exceed the limit raise
+    :class:`ImageTooLarge`; they are never processed at a reduced
+    resolution.
+    """
+    image = Image.open(stream)
+    if budget is None:
+        return image
+    budget.source_size = image.size
+    graph = (plan or default_plan()).compile(image.size)
+    needed = bounded_peak(graph, image.size, image.mode)
+    budget.needed = needed
+    if needed > budget.limit:
+        raise ImageTooLarge(
+            f"Image too large: {image.size[0]}x{image.size[1]} pixels need "
+            f"{_megabytes(needed)} to process, at most {_megabytes(budget.limit)} are allowed"
+        )
+    with stage("decode"):
+        image.load()
+    budget.hold(_image_bytes(image.size, image.mode))
+    return image
+
+
+def _resolve_format(image: Image.Image, ext: str) -> str:
+    fmt = (image.format or ext).upper()
+    if fmt == "JPG":
+        fmt = "JPEG"
+    return fmt
+
+
+class _Shape(NamedTuple):
+    """Size and mode of an image that :func:`bounded_peak` does not render."""
+
+    size: tuple[int, int]
+    mode: str
+
+
+class _Evaluator:
+    """Compute the nodes of a :class:`~app.plans.Graph` from the source pixels.
+
+    Nodes read more than once are kept until their last consumer has run,
+    so shared intermediates are computed a single time; everything else is
+    dropped as soon as it has been used. Safe to call from several threads.
+
+    With a ``budget`` every node is held from before it is computed until
+    it is dropped: kept nodes by the evaluator, and the ones :meth:`get`
+    returns without keeping by the caller, which passes them to
+    :meth:`release` once done. With ``dry`` no pixels are computed, only the
+    budget is accounted for.
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        image: Image.Image | _Shape,
+        budget: MemoryBudget | None = None,
+        dry: bool = False,
+    ):
+        self.graph = graph
+        self.budget = budget
+        self.dry = dry
+        self.remaining = graph.consumers()
+        self.cache: dict[int, Image.Image | _Shape] = {0: image}
+        self.locks = [threading.Lock() for _ in graph.nodes]
+
+    def get(self, index: int, timings: Timings | None = None) -> tuple[Image.Image, bool]:
+        """The pixels of node ``index`` and whether the caller has to release them."""
+        # a node only ever waits for its parents, so the locks cannot deadlock
+        with self.locks[index]:
+            img = self.cache.get(index)
+            cached = img is not None
+            if not cached:
+                node = self.graph.nodes[index]
+                parent, owned = self.get(node.parent, timings)
+                if self.budget is not None:
+                    self.budget.hold(_image_bytes(node.size, parent.mode))
+                img = self._compute(node, parent, timings)
+                if owned:
+                    self.release(parent)
+            self.remaining[index] -= 1
+            keep = self.remaining[index] > 0 or index == 0
+            if keep and not cached:
+                self.cache[index] = img
+            elif not keep and cached:
+                del self.cache[index]
+            return img, not keep
+
+    def _compute(self, node, parent, timings: Timings | None):
+        if self.dry:
+            return _Shape(node.size, parent.mode)
+        if node.op == "resize":
+            with stage("resize", timings):
+                return parent.resize(node.args, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        with stage("crop", timings):
+            if node.op == "crop":
+                return parent.crop(node.args)
+            return parent.transpose(Image.FLIP_LEFT_RIGHT)
+
+    def release(self, img) -> None:
+        if self.budget is not None:
+            self.budget.release(_image_bytes(img.size, img.mode))
+
+
+def _schedule(graph: Graph) -> list[tuple[str, int]]:
+    """The outputs of ``graph`` with every mirror moved right behind the output
+    it flips, so the unflipped pixels are not kept while other outputs render."""
+    first: dict[int, int] = {}
+    for position, (_, index) in enumerate(graph.outputs):
+        first.setdefault(index, position)
+
+    def order(position: int) -> tuple[int, int]:
+        node = graph.nodes[graph.outputs[position][1]]
+        if node.op == "flip" and node.parent in first:
+            return first[node.parent], 1
+        return position, 0
+
+    return [graph.outputs[i] for i in sorted(range(len(graph.outputs)), key=order)]
+
+
+def _bounded(evaluator: _Evaluator, graph: Graph, budget: MemoryBudget, encode) -> Iterator:
+    """Render and encode the outputs of ``graph`` one at a time.
+
+    Yields ``(suffix, encoded)`` where ``encoded`` is what ``encode`` made
+    of the pixels; its ``nbytes`` stay held until the caller resumes.
+    """
+    for suffix, index in _schedule(graph):
+        rendered, owned = evaluator.get(index)
+        encoded = encode(rendered)
+        budget.hold(encoded.nbytes)
+        if owned:
+            evaluator.release(rendered)
+        del rendered
+        yield suffix, encoded
+        budget.release(encoded.nbytes)
+
+
+class _Estimate(NamedTuple):
+    nbytes: int
+
+
+# room for format headers and the thumbnail of an encoded output; PNG filter
+# bytes and incompressible data are covered by the extra 64th
+ENCODE_OVERHEAD = 1024 * 1024
+
+
+def bounded_peak(graph: Graph, size: tuple[int, int], mode: str) -> int:
+    """Bytes the bounded pipeline holds at most for ``graph`` and a source of ``size``.
+
+    The pipeline is run without computing any pixels. Encoded outputs and
+    their thumbnails are assumed to take at most a 64th more than the
+    pixels plus :data:`ENCODE_OVERHEAD`.
+    """
+    budget = MemoryBudget(math.inf)
+    source = _Shape(size, mode)
+    budget.hold(_image_bytes(size, mode))
+    evaluator = _Evaluator(graph, source, budget, dry=True)
+    estimate = lambda img: _Estimate(_image_bytes(img.size, img.mode) * 65 // 64 + ENCODE_OVERHEAD)
+    for _ in _bounded(evaluator, graph, budget, estimate):
+        pass
+    return budget.peak
+
+
+class _Encoded(NamedTuple):
+    buffer: BytesIO
+    thumb: tuple[str, BytesIO] | None
+
+    @property
+    def nbytes(self) -> int:
+        thumb = self.thumb[1].getbuffer().nbytes if self.thumb else 0
+        return self.buffer.getbuffer().nbytes + thumb
+
+
+class Variant(NamedTuple):
+    """One generated image, its gallery thumbnail if requested and the
+    manifest fields it adds, such as its training bucket."""
+
+    filename: str
+    buffer: BytesIO
+    thumbnail: tuple[str, BytesIO] | None = None
+    info: dict | None = None
+
+
+def _thumbnail(img: Image.Image, size: int, timings: Timings | None = None) -> tuple[str, BytesIO]:
+    """Downscale ``img`` to fit ``size`` and encode it as JPEG or PNG."""
+    w, h = img.size
+    scale = min(1.0, size / max(w, h))
+    buffer = BytesIO()
+    with stage("thumbnail", timings):
+        thumb = img.resize(
+            (max(1, round(w * scale)), max(1, round(h * scale))),
+            Image.Resampling.BILINEAR,
+            reducing_gap=2.0,
+        )
+        if thumb.mode in ("RGB", "L"):
+            thumb.save(buffer, format="JPEG", quality=80)
+            ext = "jpg"
+        else:
+            thumb.convert("RGBA").save(buffer, format="PNG")
+            ext = "png"
+    buffer.seek(0)
+    return ext, buffer
+
+
+def _encode_image(
+    rendered: Image.Image, fmt: str, thumb_size: int | None = None, timings: Timings | None = None
+) -> tuple[BytesIO, tuple[str, BytesIO] | None]:
+    buffer = BytesIO()
+    with stage("encode", timings):
+        rendered.save(buffer, format=fmt)
+    buffer.seek(0)
+    thumb = _thumbnail(rendered, thumb_size, timings) if thumb_size else None
+    return buffer, thumb
+
+
+def _encode(
+    evaluator: _Evaluator,
+    index: int,
+    fmt: str,
+    thumb_size: int | None = None,
+    timings: Timings | None = None,
+) -> tuple[BytesIO, tuple[str, BytesIO] | None]:
+    rendered, _ = evaluator.get(index, timings)
+    return _encode_image(rendered, fmt, thumb_size, timings)
+
+
+def _ordered_map(pool: ThreadPoolExecutor, func, items, window: int) -> Iterator:
+    """Like ``pool.map`` but with at most ``window`` results pending at a time."""
+    pending: deque = deque()
+    items = iter(items)
+    for item in itertools.islice(items, window):
+        pending.append(pool.submit(func, item))
+    while pending:
+        result = pending.popleft().result()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.submit(func, item))
+        yield result
+
+
+def _variant(
+    base_name: str, suffix: str, ext: str, buffer: BytesIO, thumb, graph: Graph
+) -> Variant:
+    filename = f"{base_name}_{suffix}.{ext}"
+    info = {"bucket": list(graph.buckets[suffix])} if graph.buckets else None
+    if thumb is not None:
+        thumb_ext, thumb_buffer = thumb
+        thumb = (f"{base_name}_{suffix}.{thumb_ext}", thumb_buffer)
+    return Variant(filename, buffer, thumb, info)
+
+
+def iter_variants(
+    image: Image.Image,
+    base_name: str,
+    ext: str,
+    parallel: bool | None = None,
+    budget: MemoryBudget | None = None,
+    thumb_size: int | None = None,
+    plan: Plan | None = None,
+) -> Iterator[Variant]:
+    """Yield the dataset images of ``plan`` for ``image``.
+
+    ``plan`` defaults to the original 14 image recipe. Images come in plan
+    order, except that with a ``budget`` every mirror follows the output it
+    flips: the variants are then rendered and encoded one at a time and the
+    caller is expected to drop each buffer once it has been written, so at
+    most :func:`bounded_peak` bytes are held. With ``thumb_size`` every
+    variant carries a thumbnail rendered from the same in-memory pixels,
+    and with a bucketed plan its bucket size is part of ``info``.
+    """
+    fmt = _resolve_format(image, ext)
+    with stage("decode"):
+        image.load()
+    graph = (plan or default_plan()).compile(image.size)
+    evaluator = _Evaluator(graph, image, budget)
+    if budget is not None:
+        encode = lambda rendered: _Encoded(*_encode_image(rendered, fmt, thumb_size))
+        for suffix, encoded in _bounded(evaluator, graph, budget, encode):
+            yield _variant(base_name, suffix, ext, encoded.buffer, encoded.thumb, graph)
+            del encoded
+        return
+    if parallel is None:
+        parallel = encode_workers() > 1
+    if parallel:
+        timings = current_timings()
+        results = _ordered_map(
+            get_encode_pool(),
+            lambda entry: _encode(evaluator, entry[1], fmt, thumb_size, timings),
+            graph.outputs,
+            # keeps every worker busy without holding all outputs of a large plan
+            max(16, 2 * encode_workers()),
+        )
+    else:
+        results = (_encode(evaluator, index, fmt, thumb_size) for _, index in graph.outputs)
+    for (suffix, _), (buffer, thumb) in zip(graph.outputs, results):
+        yield _variant(base_name, suffix, ext, buffer, thumb, graph)
+
+
+def iter_crop_and_flip(
+    image: Image.Image,
+    base_name: str,
+    ext: str,
+    parallel: bool | None = None,
+    budget: MemoryBudget | None = None,
+    plan: Plan | None = None,
+) -> Iterator[tuple[str, BytesIO]]:
+    """Yield ``(filename, buffer)`` pairs for ``image`` in plan order."""
+    for variant in iter_variants(image, base_name, ext, parallel, budget, plan=plan):
+        yield variant.filename, variant.buffer
+
+
+def crop_and_flip(
+    image: Image.Image,
+    base_name: str,
+    ext: str,
+    parallel: bool | None = None,
+    plan: Plan | None = None,
+) -> list[tuple[str, BytesIO]]:
+    """Generate the dataset images of ``plan`` for ``image``.
+
+    Without a plan these are the 14 images of the default recipe. The
+    source is decoded once and every output is derived from the in-memory
+    pixels, so each output is encoded exactly once and never decoded
+    again. With ``parallel`` (the default when more than one encode worker
+    is configured) the variants are rendered and encoded on the shared
+    pool; Pillow releases the GIL while encoding, so the call takes
+    roughly as long as the slowest single encode. Results are always
+    returned in plan order.
+    """
+    return list(iter_crop_and_flip(image, base_name, ext, parallel, plan=plan))
@@ -0,0 +1,277 @@
+"""cProfile captures of single requests and upload jobs for admins.
+
+A request is profiled when an admin adds ``?profile=1`` or an
+``X-Profile: 1`` header, and a ``profile_upload_sample`` percentage of
+``/upload`` calls is profiled for everyone. When such an upload is queued
+its job is profiled as well, in whichever thread or runner process picks
+it up. Encoding work handed to the encode pool runs on other threads and
+shows up as waiting time in the profile.
+
+Profiles are files below ``ARCHIVE_DIR/.profiles``, so all server workers
+and the job runner share one buffer of the last ``profile_limit`` entries.
+With profiling off a request costs a few dictionary lookups and a job one
+``unlink`` of a marker that does not exist.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = ".profiles"
+_ID = re.compile(r"^[0-9a-f]{24}$")
+_active: ContextVar[bool] = ContextVar("oneshot_profiling", default=False)
+
+
+def function_seconds(stats: pstats.Stats, name: str) -> float:
+    """Cumulative time of the functions called ``name``."""
+    return sum(ct for (_, _, func), (_, _, _, ct, _) in stats.stats.items() if func == name)
+
+
+def package_seconds(stats: pstats.Stats, package: str) -> float:
+    """Time spent in the code of ``package``, including C functions it called."""
+    fragment = f"{os.sep}{package}{os.sep}"
+    total = 0.0
+    for (filename, _, _), (_, _, tt, _, callers) in stats.stats.items():
+        if fragment in filename:
+            total += tt
+        elif filename == "~":
+            total += sum(c[2] for (caller, _, _), c in callers.items() if fragment in caller)
+    return total
+
+
+def summarize(profile: cProfile.Profile) -> dict:
+    stats = pstats.Stats(profile)
+    return {
+        "profiled_seconds": stats.total_tt,
+        # iter_variants is the generator behind crop_and_flip
+        "processing_seconds": function_seconds(stats, "iter_variants"),
+        "sqlalchemy_seconds": package_seconds(stats, "sqlalchemy"),
+    }
+
+
+class ProfileStore:
+    """The last ``limit`` profiles with their metadata, kept as files."""
+
+    def __init__(self, directory: Path, limit: int):
+        self.directory = directory
+        self.limit = limit
+
+    def _marker(self, job_id: str) -> Path:
+        return self.directory / "jobs" / job_id
+
+    def follow_job(self, job_id: str) -> None:
+        """Profile the job ``job_id`` when it runs."""
+        marker = self._marker(job_id)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+
+    def take_job(self, job_id: str) -> bool:
+        """Whether ``job_id`` should be profiled; only answers ``True`` once."""
+        try:
+            self._marker(job_id).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self, profile: cProfile.Profile, meta: dict) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # ids sort by creation time
+        profile_id = f"{time.time_ns():016x}{uuid.uuid4().hex[:8]}"
+        profile.dump_stats(self.directory / f"{profile_id}.prof")
+        meta = {"id": profile_id, "created": datetime.utcnow().isoformat(), **meta, **summarize(profile)}
+        tmp = self.directory / f"{profile_id}.json.tmp"
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self.directory / f"{profile_id}.json")
+        self._prune()
+        return profile_id
+
+    def _ids(self) -> list[str]:
+        if not self.directory.is_dir():
+            return []
+        return sorted(p.stem for p in self.directory.glob("*.json"))
+
+    def _prune(self) -> None:
+        ids = self._ids()
+        for profile_id in ids[: max(len(ids) - self.limit, 0)]:
+            (self.directory / f"{profile_id}.json").unlink(missing_ok=True)
+            (self.directory / f"{profile_id}.prof").unlink(missing_ok=True)
+
+    def list(self) -> list[dict]:
+        """Metadata of the stored profiles, newest first."""
+        found = []
+        for profile_id in reversed(self._ids()):
+            meta = self.get(profile_id)
+            if meta is not None:
+                found.append(meta)
+        return found
+
+    def get(self, profile_id: str) -> dict | None:
+        if not _ID.match(profile_id):
+            return None
+        try:
+            return json.loads((self.directory / f"{profile_id}.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def stats_path(self, profile_id: str) -> Path | None:
+        """The ``.prof`` file of ``profile_id``, readable with :mod:`pstats`."""
+        if not _ID.match(profile_id):
+            return None
+        path = self.directory / f"{profile_id}.prof"
+        return path if path.is_file() else None
+
+    def report(self, profile_id: str, sort: str = "cumulative", limit: int = 60) -> str | None:
+        path = self.stats_path(profile_id)
+        if path is None:
+            return None
+        out = StringIO()
+        pstats.Stats(str(path), stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+def _start() -> cProfile.Profile | None:
+    if _active.get():
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler (or a concurrent capture on Python 3.12+) is active
+        logger.debug("profiler busy, capture skipped")
+        return None
+    _active.set(True)
+    return profile
+
+
+def _stop(profile: cProfile.Profile) -> None:
+    profile.disable()
+    _active.set(False)
+
+
+def _store():
+    from .services import services
+
+    return services().profiles
+
+
+def follow_job(job_id: str) -> None:
+    """Also profile ``job_id`` if the current request is being profiled.
+
+    Jobs that run inline are part of the request profile already.
+    """
+    from .services import services
+
+    if g.get("profile") is not None and not services().job_queue.eager:
+        services().profiles.follow_job(job_id)
+
+
+@contextmanager
+def profile_job(job):
+    """Profile the body if the upload that queued ``job`` was profiled."""
+    if not _store().take_job(job.id):
+        yield
+        return
+    profile = _start()
+    if profile is None:
+        yield
+        return
+    # read up front, the job row may be gone by the time the body ends
+    label, owner_id = f"job {job.id} ({job.filename})", job.owner_id
+    start = time.perf_counter()
+    outcome = "failed"
+    try:
+        yield
+        outcome = "done"
+    finally:
+        _stop(profile)
+        timings = metrics.current_timings()
+        meta = {
+            "kind": "job",
+            "label": label,
+            "user_id": owner_id,
+            "status": outcome,
+            "seconds": time.perf_counter() - start,
+            "stages_ms": timings.as_ms() if timings is not None else {},
+        }
+        try:
+            _store().save(profile, meta)
+        except OSError:
+            logger.exception("could not store the profile of %s", label)
+
+
+def _wanted() -> bool:
+    sample = current_app.config["PROFILE_UPLOAD_SAMPLE"]
+    if sample > 0 and request.endpoint == "datasets.upload" and random.random() * 100 < sample:
+        return True
+    if not (request.args.get("profile") or request.headers.get("X-Profile")):
+        return False
+    return current_user.is_authenticated and current_user.is_admin
+
+
+def _finish(status: int) -> str | None:
+    profile = g.pop("profile", None)
+    if profile is None:
+        return None
+    _stop(profile)
+    stats = metrics.current_request()
+    meta = {
+        "kind": "request",
+        "label": f"{request.method} {request.full_path.rstrip('?')}",
+        "endpoint": request.endpoint,
+        "user_id": current_user.get_id(),
+        "status": status,
+        "seconds": time.perf_counter() - g.pop("profile_start"),
+        "queries": stats.queries if stats is not None else None,
+        "query_seconds": stats.query_seconds if stats is not None else None,
+    }
+    try:
+        return _store().save(profile, meta)
+    except OSError:
+        logger.exception("could not store the profile of %s", meta["label"])
+        return None
+
+
+def init_app(app) -> None:
+    """Profile the requests of ``app`` that ask for it.
+
+    Must be called after :func:`metrics.init_app`, so the query counts of a
+    request are still available when its profile is stored.
+    """
+
+    @app.before_request
+    def _start_profile():
+        if _wanted():
+            profile = _start()
+            if profile is not None:
+                g.profile = profile
+                g.profile_start = time.perf_counter()
+
+    @app.after_request
+    def _store_profile(response):
+        profile_id = _finish(response.status_code)
+        if profile_id is not None:
+            response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    @app.teardown_request
+    def _abort_profile(exc):
+        # after_request is skipped when the view raised
+        _finish(500)
@@ -0,0 +1,411 @@
+from datetime import datetime
+from pathlib import Path
+import json
+import random
+import shutil
+import threading
+import time
+
+from flask import Flask, current_app
+
+from .cas import ContentStore, content_key, ARCHIVE_FILE, META_DIR, PREVIEW_DIR
+from .cleanup import Cleaner, reconcile
+from .jobs import JobLost, JobQueue
+from .metrics import UPLOADS, collect, registry, stage
+from .models import db, Blob, Dataset, Job, Lease, Team, Usage, User
+from .plans import Plan, PlanError
+from .profiling import PROFILE_DIR, ProfileStore, profile_job
+from .storage import DatasetPaths, Storage, dataset_paths, owner_folder, storage_from_config
+
+
+class Services:
+    """Background workers and storage of one application.
+
+    Kept in ``app.extensions["oneshot"]`` and reached through
+    :func:`services`. The storage backend is built on first use, so the
+    client library of a remote store is only imported when it is needed.
+    """
+
+    def __init__(self, app: Flask, config: dict):
+        self.app = app
+        self.archive_dir: Path = app.config["ARCHIVE_DIR"]
+        self._storage_config = {**config, "storage_backend": app.config["STORAGE_BACKEND"]}
+        self._storage: Storage | None = None
+        self._lock = threading.Lock()
+        self.job_queue = JobQueue(
+            process_upload,
+            on_failure=release_reservation,
+            workers=app.config["UPLOAD_WORKERS"],
+            max_pending=app.config["UPLOAD_QUEUE_SIZE"],
+            stale_after=app.config["JOB_STALE_AFTER"],
+            heartbeat=app.config["JOB_HEARTBEAT"],
+            graceful_timeout=app.config["JOB_GRACEFUL_TIMEOUT"],
+            nice=app.config["JOB_NICE"],
+        )
+        self.job_queue.init_app(app)
+        self.cleaner = Cleaner(reconcile=periodic_reconcile, interval=app.config["RECONCILE_INTERVAL"])
+        self.cleaner.init_app(app)
+        self.profiles = ProfileStore(self.archive_dir / PROFILE_DIR, app.config["PROFILE_LIMIT"])
+        app.extensions["oneshot"] = self
+        app.before_request(self.start)
+
+    @property
+    def storage(self) -> Storage:
+        """Backend holding dataset archives, previews and thumbnails."""
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    self._storage = storage_from_config(self._storage_config, self.archive_dir)
+        return self._storage
+
+    @storage.setter
+    def storage(self, storage: Storage) -> None:
+        self._storage = storage
+
+    def content_store(self) -> ContentStore:
+        return ContentStore(self.archive_dir / ".cas")
+
+    def incoming_dir(self) -> Path:
+        """Directory holding uploads that wait for processing."""
+        path = self.archive_dir / ".incoming"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def start(self) -> None:
+        self.job_queue.start()
+        self.cleaner.start()
+
+
+def services() -> Services:
+    return current_app.extensions["oneshot"]
+
+
+def resolve_plan(name: str | None) -> Plan:
+    """The augmentation plan called ``name``, or the configured default."""
+    config = current_app.config
+    name = name or config["AUGMENTATION_PLAN"]
+    try:
+        return config["AUGMENTATION_PLANS"][name]
+    except KeyError:
+        raise PlanError(f"unknown augmentation plan {name!r}") from None
+
+
+def render_dataset(
+    source: Path,
+    base_name: str,
+    ext: str,
+    archive_path: Path,
+    preview_dir: Path,
+    meta_dir: Path,
+    plan: Plan | None = None,
+    memory: dict | None = None,
+) -> None:
+    """Process the image at ``source`` into an archive, previews and thumbnails.
+
+    Large sources go through the bounded path; their memory ``peak`` and
+    ``limit`` are then put into ``memory``, also when the job fails.
+    """
+    from PIL import Image
+    from . import processing
+    from .archive import write_dataset
+
+    processing.set_encode_priority(current_app.config["JOB_NICE"])
+    budget = None
+    try:
+        with open(source, "rb") as stream:
+            img = Image.open(stream)
+            if img.width * img.height > processing.large_image_pixels():
+                # very large sources are streamed out one variant at a time and
+                # fail the job if they cannot be processed within the memory limit
+                budget = processing.MemoryBudget(processing.memory_limit())
+                stream.seek(0)
+                img = processing.open_image(stream, budget, plan)
+            variants = processing.iter_variants(
+                img,
+                base_name,
+                ext,
+                budget=budget,
+                thumb_size=current_app.config["THUMBNAIL_SIZE"],
+                plan=plan,
+            )
+            info = None
+            if plan is not None and plan.content_fingerprint:
+                info = {"plan": {"name": plan.name, "fingerprint": plan.fingerprint}}
+                if plan.buckets:
+                    info["plan"]["buckets"] = plan.buckets
+            write_dataset(variants, archive_path, preview_dir, meta_dir, info)
+            img.close()
+    finally:
+        if budget is not None:
+            # rejected before decoding, the peak is the one that was expected
+            peak = budget.peak or budget.needed or 0
+            if memory is not None:
+                memory.update(peak=peak, limit=budget.limit)
+            current_app.logger.info(
+                "large image %s: %sx%s, peak %d of %d bytes",
+                source.name,
+                *budget.source_size,
+                peak,
+                budget.limit,
+            )
+
+
+def process_upload(job: Job) -> int:
+    """Turn the spooled upload of ``job`` into a dataset and return its id.
+
+    Outputs are cached by content key, so re-uploading the same image only
+    hardlinks (or, for remote storage, uploads) the stored archive and
+    previews. With ``LOG_UPLOAD_TIMINGS`` a JSON line with the duration of
+    every stage is logged per upload.
+    """
+    start = time.perf_counter()
+    with collect() as timings, profile_job(job):
+        try:
+            dataset, cached = _create_dataset(job)
+        except BaseException:
+            registry.inc(UPLOADS, outcome="failed")
+            registry.flush()
+            raise
+    registry.inc(UPLOADS, outcome="cached" if cached else "processed")
+    registry.flush()
+    if current_app.config["LOG_UPLOAD_TIMINGS"]:
+        current_app.logger.info(
+            "upload %s",
+            json.dumps(
+                {
+                    "job": job.id,
+                    "dataset": dataset.id,
+                    "bytes": dataset.size_bytes,
+                    "cached": cached,
+                    "total_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "stages_ms": timings.as_ms(),
+                }
+            ),
+        )
+    return dataset.id
+
+
+def _still_wanted(job_id: str, worker: str, owner_id: int, team_id: int | None) -> bool:
+    """Whether the job still runs here and its owner and team still exist.
+
+    Touches the job row, so it stays locked until the caller commits.
+    """
+    touched = Job.query.filter_by(id=job_id, status=Job.RUNNING, worker=worker).update(
+        {"updated_at": datetime.utcnow()}, synchronize_session=False
+    )
+    if not touched or db.session.get(User, owner_id) is None:
+        return False
+    return team_id is None or db.session.get(Team, team_id) is not None
+
+
+def _store_entry(
+    storage: Storage, store: ContentStore, key: str, paths: DatasetPaths, render, scratch: Path
+) -> tuple[int, bool]:
+    """Put the dataset with content ``key`` at ``paths``; return its size and whether it was cached.
+
+    Local storage hardlinks the entry of the content store. Remote backends
+    keep their own copy of every dataset, so a repeated upload is copied
+    within the backend instead, and new content is rendered into ``scratch``
+    and removed once it is uploaded; the local content store does not grow
+    with a remote archive.
+    """
+    if storage.local_path(paths.archive) is not None:
+        entry = store.lookup(key)
+        cached = entry is not None
+        if entry is None:
+            with stage("job.render"):
+                entry = store.build(key, render)
+        with stage("job.import"):
+            storage.import_entry(entry, paths)
+        return (entry / ARCHIVE_FILE).stat().st_size, cached
+    with stage("job.import"):
+        size = _copy_stored(storage, key, paths)
+    if size is not None:
+        return size, True
+    try:
+        with stage("job.render"):
+            scratch.mkdir(parents=True, exist_ok=True)
+            render(scratch / ARCHIVE_FILE, scratch / PREVIEW_DIR, scratch / META_DIR)
+        with stage("job.import"):
+            storage.import_entry(scratch, paths)
+        return (scratch / ARCHIVE_FILE).stat().st_size, False
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _copy_stored(storage: Storage, key: str, paths: DatasetPaths) -> int | None:
+    """Copy a stored dataset with content ``key`` to ``paths`` and return its size.
+
+    Returns ``None`` if there is no such dataset or it went away meanwhile.
+    """
+    source = Dataset.query.filter_by(blob_key=key).order_by(Dataset.id.desc()).first()
+    if source is None:
+        return None
+    src = storage.locate(owner_folder(source.owner_id, source.team_id), source.filename)
+    try:
+        # the archive comes last; its presence marks the copy as complete
+        storage.copy(src.preview, paths.preview)
+        storage.copy(src.meta, paths.meta)
+        storage.copy(src.archive, paths.archive)
+    except Exception:
+        current_app.logger.warning("copying dataset %s failed, rendering instead", source.id, exc_info=True)
+        return None
+    return source.size_bytes if storage.exists(paths.archive) else None
+
+
+def _record_memory(job_id: str, memory: dict) -> None:
+    """Store the memory peak and limit of a large upload on its job; does not commit."""
+    Job.query.filter_by(id=job_id).update(
+        {"memory_peak": memory["peak"], "memory_limit": memory["limit"]},
+        synchronize_session=False,
+    )
+
+
+def _create_dataset(job: Job) -> tuple[Dataset, bool]:
+    owner = job.owner
+    if owner is None:
+        raise JobLost(job.id)
+    # the row may be deleted while the job runs, so nothing reads it later
+    job_id, worker, owner_id, team_id = job.id, job.worker, job.owner_id, job.team_id
+    svc = services()
+    storage = svc.storage
+    spool_path = svc.incoming_dir() / job.id
+    base_name = Path(job.filename).stem
+    ext = job.filename.split(".")[-1]
+
+    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    random_part = random.randint(0, 99999)
+    archive_name = f"{owner.username}_{timestamp}_{random_part:05}.zip"
+    paths = dataset_paths(owner_folder(job.owner_id, job.team_id), archive_name)
+
+    store = svc.content_store()
+    scratch = svc.incoming_dir() / f"{job_id}.entry"
+    memory: dict = {}
+    try:
+        plan = resolve_plan(job.plan)
+        with stage("job.hash"):
+            key = content_key(spool_path, base_name, ext, plan.content_fingerprint)
+        Blob.acquire(key)
+        try:
+            size, cached = _store_entry(
+                storage,
+                store,
+                key,
+                paths,
+                lambda archive, preview, meta: render_dataset(
+                    spool_path, base_name, ext, archive, preview, meta, plan, memory
+                ),
+                scratch,
+            )
+        except BaseException:
+            storage.remove(paths, svc.cleaner)
+            db.session.rollback()
+            freed = release_blobs([key])
+            if memory:
+                _record_memory(job_id, memory)
+            db.session.commit()
+            discard_blobs(freed)
+            raise
+    finally:
+        spool_path.unlink(missing_ok=True)
+
+    dataset = Dataset(
+        filename=archive_name,
+        owner_id=owner_id,
+        team_id=team_id,
+        blob_key=key,
+        size_bytes=size,
+    )
+    with stage("job.commit"):
+        if not _still_wanted(job_id, worker, owner_id, team_id):
+            # cancelled meanwhile; the reservation went with the job
+            db.session.rollback()
+            storage.remove(paths, svc.cleaner)
+            freed = release_blobs([key])
+            db.session.commit()
+            discard_blobs(freed)
+            raise JobLost(job_id)
+        db.session.add(dataset)
+        db.session.flush()
+        # the job stops counting as pending in the same transaction that adds
+        # its dataset, so the usage counters never see both or neither
+        Job.query.filter_by(id=job_id).update(
+            {"status": Job.DONE, "dataset_id": dataset.id}, synchronize_session=False
+        )
+        if memory:
+            _record_memory(job_id, memory)
+        # the dataset slot was reserved when the upload was accepted
+        Usage.add_bytes(*Usage.scope_of(owner_id, team_id), size)
+        db.session.commit()
+    return dataset, cached
+
+
+def release_reservation(job: Job) -> None:
+    """Return the quota slot of an upload that did not produce a dataset."""
+    Usage.release(*Usage.scope_of(job.owner_id, job.team_id))
+
+
+def cancel_jobs(query) -> None:
+    """Delete the jobs matched by ``query``; does not commit.
+
+    Jobs that are still pending give their quota slot back first and the
+    uploads of queued ones are removed. Running jobs notice that their row
+    is gone before they store anything.
+    """
+    incoming = services().incoming_dir()
+    for job in query.filter(Job.status.in_([Job.QUEUED, Job.RUNNING])):
+        release_reservation(job)
+        if job.status == Job.QUEUED:
+            (incoming / job.id).unlink(missing_ok=True)
+    query.delete(synchronize_session=False)
+
+
+def release_blobs(keys) -> list[str]:
+    """Drop dataset references to stored blobs; does not commit.
+
+    Returns the keys that lost their last reference, for
+    :func:`discard_blobs` once the caller has committed.
+    """
+    return [key for key in keys if key and Blob.release(key)]
+
+
+def discard_blobs(keys) -> None:
+    """Remove the content store entries of blobs freed by :func:`release_blobs`."""
+    if keys:
+        svc = services()
+        store = svc.content_store()
+        svc.cleaner.discard(svc.archive_dir, *(store.entry(key) for key in keys))
+
+
+def periodic_reconcile() -> None:
+    """Run :func:`reconcile_archives` unless another process holds the reconcile lease.
+
+    Every process runs a cleaner, but only the holder of the lease
+    reconciles. It renews the lease on each run and another process takes
+    over once it has not been renewed for two intervals.
+    """
+    svc = services()
+    interval = current_app.config["RECONCILE_INTERVAL"]
+    if Lease.acquire("reconcile", svc.job_queue.worker_id, 2 * interval):
+        reconcile_archives()
+
+
+def reconcile_archives(fix: bool = True):
+    """Compare the archive tree with the database and log the differences."""
+    svc = services()
+    config = current_app.config
+    report = reconcile(
+        svc.archive_dir,
+        config["RECONCILE_GRACE"],
+        svc.cleaner if fix else None,
+        config["STORAGE_BACKEND"] == "local",
+    )
+    if report.orphans or report.missing or report.drift:
+        current_app.logger.warning(
+            "archive reconcile: %d orphaned paths%s, %d missing archives, %d drifted counters",
+            len(report.orphans),
+            " removed" if fix else "",
+            len(report.missing),
+            len(report.drift),
+        )
+    return report
@@ -0,0 +1,329 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+import hashlib
+import json
+import mimetypes
+import os
+
+from werkzeug.security import safe_join
+
+from .archive import MANIFEST_FILE, load_manifest
+from .cas import ARCHIVE_FILE, META_DIR, PREVIEW_DIR, link_or_copy, link_tree
+
+
+class DatasetPaths(NamedTuple):
+    """Storage keys of one dataset: its archive and the preview and meta trees."""
+
+    archive: str
+    preview: str
+    meta: str
+
+
+def owner_folder(owner_id: int, team_id: int | None) -> str:
+    return f"team_{team_id}" if team_id else f"user_{owner_id}"
+
+
+def shard_of(filename: str) -> str:
+    """Two directory levels derived from the dataset name, e.g. ``3f/a2``."""
+    digest = hashlib.sha256(filename.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+
+def dataset_paths(folder: str, filename: str, sharded: bool = True) -> DatasetPaths:
+    """Keys for ``filename`` in ``folder``, sharded or in the legacy flat layout.
+
+    Sharding spreads the datasets of one owner over 65536 directories, so
+    no directory grows with the size of the archive.
+    """
+    prefix = f"{folder}/{shard_of(filename)}" if sharded else folder
+    base = filename[:-4]
+    return DatasetPaths(f"{prefix}/{filename}", f"{prefix}/{base}", f"{prefix}/{base}.meta")
+
+
+class StoredStat(NamedTuple):
+    st_size: int
+
+
+class StoredFile:
+    """Read-only handle on a stored object with the parts of ``Path`` export uses."""
+
+    def __init__(self, storage: "Storage", key: str):
+        self.storage = storage
+        self.key = key
+
+    def is_file(self) -> bool:
+        return self.storage.exists(self.key)
+
+    def stat(self) -> StoredStat:
+        return StoredStat(self.storage.size(self.key))
+
+    def open(self, mode: str = "rb") -> BinaryIO:
+        return self.storage.open(self.key)
+
+
+class Storage(ABC):
+    """Where dataset archives, previews and thumbnails are kept.
+
+    Keys are ``/`` separated paths such as those from :func:`dataset_paths`.
+    A dataset counts as present once its archive key exists, so backends
+    write the archive last and :meth:`locate` can fall back to the legacy
+    flat layout while :mod:`migrate_storage` moves datasets over.
+    """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def list(self, prefix: str) -> list[str]:
+        """Names of the files directly below ``prefix``."""
+
+    def local_path(self, key: str) -> Path | None:
+        """Filesystem path of ``key`` if the backend keeps files on local disk."""
+        return None
+
+    def url(self, key: str, download_name: str | None = None) -> str | None:
+        """Temporary URL clients can fetch ``key`` from directly, if supported."""
+        return None
+
+    @abstractmethod
+    def import_entry(self, entry: Path, paths: DatasetPaths) -> None:
+        """Store a generated dataset from a :class:`~app.cas.ContentStore` entry."""
+
+    @abstractmethod
+    def copy(self, src: str, dst: str) -> None:
+        """Copy the file or tree at ``src`` to ``dst``."""
+
+    @abstractmethod
+    def remove(self, keys, cleaner) -> None:
+        """Schedule the files or trees at ``keys`` for removal through ``cleaner``."""
+
+    def read_manifest(self, meta: str) -> dict | None:
+        try:
+            with self.open(f"{meta}/{MANIFEST_FILE}") as f:
+                return json.load(f)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def locate(self, folder: str, filename: str) -> DatasetPaths:
+        """Keys of an existing dataset, preferring the sharded layout."""
+        paths = dataset_paths(folder, filename)
+        if self.exists(paths.archive):
+            return paths
+        legacy = dataset_paths(folder, filename, sharded=False)
+        return legacy if self.exists(legacy.archive) else paths
+
+
+class LocalStorage(Storage):
+    """Files below ``root`` on the local filesystem."""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        joined = safe_join(str(self.root), key)
+        if joined is None:
+            raise ValueError(f"invalid storage key {key!r}")
+        return Path(joined)
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).is_file()
+
+    def size(self, key: str) -> int:
+        return self.path(key).stat().st_size
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self.path(key), "rb")
+
+    def list(self, prefix: str) -> list[str]:
+        folder = self.path(prefix)
+        if not folder.is_dir():
+            return []
+        return sorted(p.name for p in folder.iterdir() if p.is_file())
+
+    def local_path(self, key: str) -> Path:
+        return self.path(key)
+
+    def import_entry(self, entry: Path, paths: DatasetPaths) -> None:
+        link_tree(entry / PREVIEW_DIR, self.path(paths.preview))
+        link_tree(entry / META_DIR, self.path(paths.meta))
+        # the archive comes last; its presence marks the dataset as complete
+        archive = self.path(paths.archive)
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(entry / ARCHIVE_FILE, archive)
+
+    def copy(self, src: str, dst: str) -> None:
+        source, target = self.path(src), self.path(dst)
+        if source.is_dir():
+            link_tree(source, target)
+        elif source.is_file():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(source, target)
+
+    def remove(self, keys, cleaner) -> None:
+        cleaner.discard(self.root, *(self.path(key) for key in keys))
+
+    def read_manifest(self, meta: str) -> dict | None:
+        return load_manifest(self.path(meta))
+
+
+class S3Storage(Storage):
+    """Objects in an S3 compatible bucket, optionally below ``prefix``.
+
+    Requires ``boto3``. Downloads and preview images are served through
+    presigned URLs, so the object store answers range and conditional
+    requests itself. Removal of whole trees runs on the cleaner thread.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str | None = None,
+        region: str | None = None,
+        url_expiry: int = 3600,
+        client=None,
+    ):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("the s3 storage backend requires boto3") from None
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.url_expiry = url_expiry
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _head(self, key: str) -> dict | None:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def _keys_below(self, prefix: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix) + "/"):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):]
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str) -> int:
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head["ContentLength"]
+
+    def open(self, key: str) -> BinaryIO:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+        except ClientError as exc:
+            raise FileNotFoundError(key) from exc
+
+    def list(self, prefix: str) -> list[str]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        names = []
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self._key(prefix) + "/", Delimiter="/"
+        ):
+            names.extend(obj["Key"].rsplit("/", 1)[-1] for obj in page.get("Contents", []))
+        return sorted(names)
+
+    def url(self, key: str, download_name: str | None = None) -> str:
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if download_name:
+            params["ResponseContentDisposition"] = f'attachment; filename="{download_name}"'
+        return self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=self.url_expiry
+        )
+
+    def _upload(self, path: Path, key: str) -> None:
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.client.upload_file(
+            str(path), self.bucket, self._key(key), ExtraArgs={"ContentType": content_type}
+        )
+
+    def import_entry(self, entry: Path, paths: DatasetPaths) -> None:
+        for src_dir, prefix in ((entry / PREVIEW_DIR, paths.preview), (entry / META_DIR, paths.meta)):
+            for src in sorted(src_dir.rglob("*")):
+                if src.is_file():
+                    self._upload(src, f"{prefix}/{src.relative_to(src_dir).as_posix()}")
+        self._upload(entry / ARCHIVE_FILE, paths.archive)
+
+    def copy(self, src: str, dst: str) -> None:
+        pairs = [(key, dst + key[len(src):]) for key in self._keys_below(src)]
+        if self.exists(src):
+            pairs.append((src, dst))
+        for old, new in pairs:
+            self.client.copy(
+                {"Bucket": self.bucket, "Key": self._key(old)}, self.bucket, self._key(new)
+            )
+
+    def _delete(self, keys) -> None:
+        targets = []
+        for key in keys:
+            targets.append(self._key(key))
+            targets.extend(self._key(k) for k in self._keys_below(key))
+        for start in range(0, len(targets), 1000):
+            batch = [{"Key": k} for k in targets[start:start + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+
+    def remove(self, keys, cleaner) -> None:
+        cleaner.defer(self._delete, list(keys))
+
+
+def move_to_sharded(storage: Storage, folder: str, filename: str, cleaner) -> bool:
+    """Move one dataset from the legacy flat layout into its shard.
+
+    The previews and metadata are copied first and the archive last, so
+    :meth:`Storage.locate` switches to the new location only once it is
+    complete; readers see either the old or the new copy throughout. The
+    legacy files are then handed to ``cleaner``. Returns ``True`` if
+    anything was moved.
+    """
+    legacy = dataset_paths(folder, filename, sharded=False)
+    sharded = dataset_paths(folder, filename)
+    if not storage.exists(legacy.archive):
+        return False
+    if not storage.exists(sharded.archive):
+        storage.copy(legacy.preview, sharded.preview)
+        storage.copy(legacy.meta, sharded.meta)
+        storage.copy(legacy.archive, sharded.archive)
+    storage.remove(legacy, cleaner)
+    return True
+
+
+def storage_from_config(config: dict, archive_dir: Path) -> Storage:
+    """Build the backend selected by ``storage_backend`` (``local`` or ``s3``)."""
+    backend = config.get("storage_backend", os.getenv("STORAGE_BACKEND", "local"))
+    if backend == "local":
+        return LocalStorage(archive_dir)
+    if backend == "s3":
+        return S3Storage(
+            bucket=config.get("s3_bucket", os.getenv("S3_BUCKET", "")),
+            prefix=config.get("s3_prefix", os.getenv("S3_PREFIX", "")),
+            endpoint_url=config.get("s3_endpoint_url", os.getenv("S3_ENDPOINT_URL")) or None,
+            region=config.get("s3_region", os.getenv("S3_REGION")) or None,
+            url_expiry=int(config.get("s3_url_expiry", os.getenv("S3_URL_EXPIRY", "3600"))),
+        )
+    raise ValueError(f"unknown storage_backend {backend!r}")
@@ -0,0 +1,18 @@
+from flask import make_response, render_template, request, url_for
+
+
+def page_response(template: str | None, fragment: str, page, **context):
+    """Render a paginated listing, or only its next rows for "load more".
+
+    With ``?fragment=1`` just the rows are returned and the link to the
+    following page travels in the ``X-Next-Page`` header.
+    """
+    next_url = None
+    if page.next_cursor:
+        next_url = url_for(request.endpoint, cursor=page.next_cursor, **request.view_args)
+    if template is None or request.args.get("fragment"):
+        response = make_response(render_template(fragment, **context))
+        if next_url:
+            response.headers["X-Next-Page"] = next_url
+        return response
+    return render_template(template, next_url=next_url, **context)
@@ -0,0 +1,174 @@
+import hmac
+
+from flask import Blueprint, Response, current_app, redirect, render_template, request, send_file, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import and_, func, or_
+from werkzeug.security import generate_password_hash
+
+from ..metrics import registry
+from ..models import db, Dataset, DatasetShare, Job, Setting, Team, TeamMember, Usage, User
+from ..pagination import keyset_page
+from ..services import cancel_jobs, discard_blobs, release_blobs, services
+from ..storage import owner_folder
+from . import page_response
+
+
+bp = Blueprint("admin", __name__)
+
+
+@bp.route("/admin/users", methods=["GET", "POST"])
+@login_required
+def users():
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "create_user":
+            username = request.form.get("username")
+            password = request.form.get("password")
+            if not username or not password:
+                return "Invalid", 400
+            if User.query.filter_by(username=username).first():
+                return "User exists", 400
+            user = User(username=username, password_hash=generate_password_hash(password))
+            db.session.add(user)
+            db.session.commit()
+            return redirect(url_for("admin.users"))
+        elif action == "toggle_registration":
+            enabled = request.form.get("registration_enabled") == "on"
+            Setting.set_bool("registration_enabled", enabled)
+            return redirect(url_for("admin.users"))
+        elif action == "update_perms":
+            user_id = int(request.form.get("user_id", 0))
+            allow = request.form.get("can_create_team") == "on"
+            user = User.query.get(user_id)
+            if user:
+                user.can_create_team = allow
+                db.session.commit()
+            return redirect(url_for("admin.users"))
+    try:
+        page = keyset_page(
+            User.query,
+            (User.id,),
+            request.args.get("cursor"),
+            current_app.config["ADMIN_PAGE_SIZE"],
+            descending=False,
+        )
+    except ValueError:
+        return "Invalid cursor", 400
+    if request.args.get("fragment"):
+        return page_response(None, "_user_rows.html", page, users=page.items)
+    reg_enabled = Setting.get_bool("registration_enabled", True)
+    return page_response(
+        "admin_users.html",
+        "_user_rows.html",
+        page,
+        users=page.items,
+        registration_enabled=reg_enabled,
+    )
+
+
+@bp.route("/admin/users/<int:user_id>/delete", methods=["POST"])
+@login_required
+def delete_user(user_id: int):
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    user = User.query.get(user_id)
+    if user:
+        DatasetShare.query.filter_by(user_id=user.id).delete()
+        owned = db.session.query(Dataset.blob_key, Dataset.filename, Dataset.team_id).filter_by(
+            owner_id=user.id
+        )
+        svc = services()
+        storage = svc.storage
+        blob_keys = []
+        keys = [owner_folder(user.id, None)]
+        for key, filename, team_id in owned:
+            blob_keys.append(key)
+            if team_id:
+                # uploads to other teams live in those teams' folders
+                keys.extend(storage.locate(owner_folder(user.id, team_id), filename))
+        team_usage = (
+            db.session.query(Dataset.team_id, func.count(Dataset.id), func.sum(Dataset.size_bytes))
+            .filter(Dataset.owner_id == user.id, Dataset.team_id.isnot(None))
+            .group_by(Dataset.team_id)
+        )
+        for team_id, count, size in team_usage:
+            Usage.release(Usage.TEAM, team_id, count, size or 0)
+        owned_teams = [t for (t,) in db.session.query(Team.id).filter_by(owner_id=user.id)]
+        cancel_jobs(Job.query.filter(or_(Job.owner_id == user.id, Job.team_id.in_(owned_teams))))
+        shared = {
+            t
+            for (t,) in db.session.query(Dataset.team_id)
+            .filter(Dataset.team_id.in_(owned_teams), Dataset.owner_id != user.id)
+            .distinct()
+        }
+        # folders still holding other members' datasets are left to the reconciler
+        keys += [owner_folder(None, t) for t in owned_teams if t not in shared]
+        Usage.query.filter(
+            or_(
+                and_(Usage.scope == Usage.USER, Usage.owner_id == user.id),
+                and_(Usage.scope == Usage.TEAM, Usage.owner_id.in_(owned_teams)),
+            )
+        ).delete(synchronize_session=False)
+        Dataset.query.filter_by(owner_id=user.id).delete()
+        TeamMember.query.filter_by(user_id=user.id).delete()
+        Team.query.filter_by(owner_id=user.id).delete()
+        db.session.delete(user)
+        freed = release_blobs(blob_keys)
+        db.session.commit()
+        discard_blobs(freed)
+        storage.remove(keys, svc.cleaner)
+    return redirect(url_for("admin.users"))
+
+
+@bp.route("/admin/metrics")
+def metrics():
+    """Request, SQL and processing metrics in Prometheus text format.
+
+    Open to admins, or to scrapers sending ``Authorization: Bearer`` with
+    the configured ``metrics_token``.
+    """
+    token = current_app.config["METRICS_TOKEN"]
+    header = request.headers.get("Authorization", "")
+    if not (token and hmac.compare_digest(header, f"Bearer {token}")):
+        if not (current_user.is_authenticated and current_user.is_admin):
+            return "Forbidden", 403
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@bp.route("/admin/profiles")
+@login_required
+def profiles():
+    """Recently captured request and job profiles, newest first."""
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    return render_template("admin_profiles.html", profiles=services().profiles.list())
+
+
+@bp.route("/admin/profiles/<profile_id>")
+@login_required
+def profile(profile_id: str):
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    store = services().profiles
+    meta = store.get(profile_id)
+    sort = request.args.get("sort", "cumulative")
+    if sort not in ("cumulative", "tottime", "ncalls"):
+        return "Invalid sort", 400
+    report = store.report(profile_id, sort)
+    if meta is None or report is None:
+        return "Not found", 404
+    return render_template("admin_profiles.html", profile=meta, report=report, sort=sort)
+
+
+@bp.route("/admin/profiles/<profile_id>/download")
+@login_required
+def download_profile(profile_id: str):
+    """The raw cProfile data, for ``pstats``, snakeviz and similar viewers."""
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    path = services().profiles.stats_path(profile_id)
+    if path is None:
+        return "Not found", 404
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}.prof")
@@ -0,0 +1,317 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import quote
+import os
+import uuid
+
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    send_from_directory,
+    url_for,
+)
+from flask_login import current_user, login_required
+from sqlalchemy import or_
+
+from ..access import current_access
+from ..jobs import QueueFull
+from ..metrics import stage
+from ..models import db, Dataset, DatasetShare, Job, Usage
+from ..pagination import merged_page
+from ..profiling import follow_job
+from ..services import discard_blobs, release_blobs, services
+from ..storage import owner_folder
+from . import page_response
+
+
+bp = Blueprint("datasets", __name__)
+
+# newest first; the id breaks ties between datasets created in the same second
+DATASET_ORDER = (Dataset.timestamp, Dataset.id)
+# generated files never change once written
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+@bp.route("/", methods=["GET"])
+@login_required
+def index():
+    """Render upload form page with archive list."""
+    config = current_app.config
+    access = current_access()
+    # one query per archive, each paged along its own index
+    queries = [Dataset.query.filter_by(owner_id=current_user.id, team_id=None)]
+    queries += [Dataset.query.filter_by(team_id=team_id) for team_id in access.team_ids]
+    try:
+        page = merged_page(
+            queries,
+            DATASET_ORDER,
+            request.args.get("cursor"),
+            config["PAGE_SIZE"],
+        )
+    except ValueError:
+        return "Invalid cursor", 400
+    if request.args.get("fragment"):
+        return page_response(None, "_dataset_rows.html", page, datasets=page.items)
+    teams = access.teams
+    personal_count = Usage.count(Usage.USER, current_user.id)
+    team_data = [(t, access.dataset_count(t.id)) for t in teams]
+    jobs = (
+        Job.query.filter_by(owner_id=current_user.id)
+        .filter(
+            or_(
+                Job.status.in_([Job.QUEUED, Job.RUNNING]),
+                Job.updated_at >= datetime.utcnow() - timedelta(hours=1),
+            )
+        )
+        .filter(Job.status != Job.DONE)
+        .order_by(Job.created_at.desc())
+        .all()
+    )
+    return page_response(
+        "index.html",
+        "_dataset_rows.html",
+        page,
+        datasets=page.items,
+        teams=teams,
+        jobs=jobs,
+        personal_count=personal_count,
+        team_data=team_data,
+        personal_limit=config["ARCHIVE_LIMIT_USER"],
+        team_limit=config["ARCHIVE_LIMIT_TEAM"],
+        plans=sorted(config["AUGMENTATION_PLANS"]),
+        default_plan=config["AUGMENTATION_PLAN"],
+    )
+
+
+def _wants_json() -> bool:
+    return request.accept_mimetypes.best == "application/json"
+
+
+@bp.route("/upload", methods=["POST"])
+@login_required
+def upload():
+    """Receive an image via form-data and queue it for processing."""
+    from PIL import Image, UnidentifiedImageError
+
+    config = current_app.config
+    file = request.files.get("image")
+    if not file or file.filename == "":
+        return "No file provided", 400
+
+    team_id_raw = request.form.get("team_id")
+    team_id = int(team_id_raw) if team_id_raw else None
+    if team_id and not current_access().is_member(team_id):
+        return "Forbidden", 403
+    plan = request.form.get("plan") or None
+    if plan and plan not in config["AUGMENTATION_PLANS"]:
+        return "Unknown augmentation plan", 400
+
+    try:
+        with stage("upload.validate"):
+            Image.open(file.stream)
+    except UnidentifiedImageError:
+        return "Unsupported image", 400
+    file.stream.seek(0)
+
+    scope = Usage.scope_of(current_user.id, team_id)
+    if team_id:
+        limits = config["ARCHIVE_LIMIT_TEAM"], config["ARCHIVE_BYTES_LIMIT_TEAM"]
+        refusal = "Team quota reached"
+    else:
+        limits = config["ARCHIVE_LIMIT_USER"], config["ARCHIVE_BYTES_LIMIT_USER"]
+        refusal = "Personal quota reached"
+    job = Job(
+        id=uuid.uuid4().hex,
+        owner_id=current_user.id,
+        team_id=team_id,
+        filename=Path(file.filename).name,
+        plan=plan,
+    )
+    svc = services()
+    spool_path = svc.incoming_dir() / job.id
+    try:
+        with stage("upload.spool"):
+            file.save(spool_path)
+        with stage("upload.reserve"):
+            reserved = Usage.reserve(*scope, *limits, commit=False)
+        if not reserved:
+            db.session.rollback()
+            spool_path.unlink(missing_ok=True)
+            return refusal, 400
+        # the slot and the job that holds it are committed together, so the
+        # reconciler never sees a reservation without its pending job
+        with stage("upload.commit"):
+            db.session.add(job)
+            db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        spool_path.unlink(missing_ok=True)
+        raise
+    follow_job(job.id)
+    try:
+        with stage("upload.submit"):
+            svc.job_queue.submit(job.id)
+    except QueueFull:
+        # submit has withdrawn the job
+        Usage.release(*scope)
+        db.session.commit()
+        spool_path.unlink(missing_ok=True)
+        return "Too many uploads in progress, try again shortly", 429, {"Retry-After": "5"}
+
+    if _wants_json():
+        db.session.refresh(job)
+        return jsonify(_job_status(job)), 202
+    return redirect(url_for("datasets.index", job=job.id))
+
+
+def _job_status(job: Job) -> dict:
+    status = {
+        "id": job.id,
+        "status": job.status,
+        "error": job.error,
+        "dataset_id": job.dataset_id,
+        "url": url_for("datasets.job_status", job_id=job.id),
+    }
+    if job.memory_limit is not None:
+        status["memory"] = {"peak": job.memory_peak, "limit": job.memory_limit}
+    return status
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id: str):
+    """Report the state of an upload job owned by the current user."""
+    job = db.session.get(Job, job_id)
+    if not job or job.owner_id != current_user.id:
+        return "Not found", 404
+    return jsonify(_job_status(job))
+
+
+def _send_archive(dataset: Dataset):
+    """Send a dataset archive according to ``DOWNLOAD_MODE``.
+
+    In proxy modes the response only carries the internal location and the
+    front proxy streams the file, freeing the worker immediately. The
+    built-in mode answers ``Range``, ``If-None-Match`` and
+    ``If-Modified-Since`` so interrupted downloads can resume. Remote
+    storage redirects to a temporary URL of the object store instead.
+    """
+    config = current_app.config
+    storage = services().storage
+    key = storage.locate(owner_folder(dataset.owner_id, dataset.team_id), dataset.filename).archive
+    local = storage.local_path(key)
+    if local is None:
+        if not storage.exists(key):
+            return "Not found", 404
+        return redirect(storage.url(key, download_name=dataset.filename))
+    path = str(local)
+    if not os.path.isfile(path):
+        return "Not found", 404
+    mode = config["DOWNLOAD_MODE"]
+    if mode == "flask":
+        return send_file(path, as_attachment=True, conditional=True, etag=True)
+    response = Response(mimetype="application/zip")
+    response.headers.set("Content-Disposition", "attachment", filename=Path(path).name)
+    if mode == "x-accel-redirect":
+        relative = Path(path).relative_to(config["ARCHIVE_DIR"]).as_posix()
+        prefix = config["DOWNLOAD_ACCEL_PREFIX"].rstrip("/")
+        response.headers["X-Accel-Redirect"] = prefix + "/" + quote(relative)
+    elif mode == "x-sendfile":
+        response.headers["X-Sendfile"] = path
+    else:
+        raise ValueError(f"unknown download_mode {mode!r}")
+    return response
+
+
+@bp.route("/download/<path:filename>", methods=["GET"])
+@login_required
+def download(filename: str):
+    """Download a dataset from the archive if permitted."""
+    dataset = Dataset.query.filter_by(filename=filename).first()
+    if not current_access().can_view(dataset):
+        return "Forbidden", 403
+    return _send_archive(dataset)
+
+
+@bp.route("/d/<int:filecode>", methods=["GET"])
+@login_required
+def download_by_code(filecode: int):
+    """Download a dataset by ID using a short code."""
+    dataset = Dataset.query.get_or_404(filecode)
+    if not current_access().can_view(dataset):
+        return "Forbidden", 403
+    return _send_archive(dataset)
+
+
+@bp.route("/preview/<int:dataset_id>")
+@login_required
+def preview(dataset_id: int):
+    """Show a gallery of preview images or serve a specific preview image."""
+    dataset = Dataset.query.get_or_404(dataset_id)
+    if not current_access().can_view(dataset):
+        return "Forbidden", 403
+
+    storage = services().storage
+    paths = storage.locate(owner_folder(dataset.owner_id, dataset.team_id), dataset.filename)
+    manifest = storage.read_manifest(paths.meta)
+    filename = request.args.get("file")
+    if filename:
+        if manifest is None:
+            preview_dir = storage.local_path(paths.preview)
+            if preview_dir is None:
+                return "Not found", 404
+            return send_from_directory(preview_dir, filename)
+        entry = next((f for f in manifest["files"] if f["name"] == filename), None)
+        if entry is None:
+            return "Not found", 404
+        if request.args.get("thumb") and entry.get("thumb"):
+            key, etag = f"{paths.meta}/{entry['thumb']}", entry["thumb_etag"]
+        else:
+            key, etag = f"{paths.preview}/{entry['name']}", entry["etag"]
+        path = storage.local_path(key)
+        if path is None:
+            return redirect(storage.url(key))
+        # ids and names come back after a delete, so only URLs carrying the
+        # ETag of the content they point to may be cached for good
+        response = send_file(path, etag=etag, conditional=True)
+        response.cache_control.private = True
+        if request.args.get("v") == etag:
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    if manifest is None:
+        # datasets created before manifests were written
+        files = [{"name": name} for name in storage.list(paths.preview)]
+    else:
+        files = manifest["files"]
+    return render_template("preview.html", files=files, dataset=dataset)
+
+
+@bp.route("/delete/<int:dataset_id>", methods=["POST"])
+@login_required
+def delete_dataset(dataset_id: int):
+    """Remove a dataset if the current user is the owner."""
+    dataset = Dataset.query.get(dataset_id)
+    if not dataset or dataset.owner_id != current_user.id:
+        return "Forbidden", 403
+
+    svc = services()
+    paths = svc.storage.locate(owner_folder(dataset.owner_id, dataset.team_id), dataset.filename)
+    DatasetShare.query.filter_by(dataset_id=dataset_id).delete()
+    db.session.delete(dataset)
+    Usage.release(*Usage.scope_of(dataset.owner_id, dataset.team_id), size=dataset.size_bytes)
+    freed = release_blobs([dataset.blob_key])
+    db.session.commit()
+    discard_blobs(freed)
+    svc.storage.remove(paths, svc.cleaner)
+    return redirect(url_for("datasets.index"))
@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta
+
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
+from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+
+from ..access import current_access
+from ..export import stream_tar, stream_zip
+from ..models import db, Dataset, DatasetShare, Job, Team, TeamMember, Usage, User
+from ..pagination import keyset_page
+from ..services import cancel_jobs, discard_blobs, release_blobs, services
+from ..storage import StoredFile, owner_folder
+from . import page_response
+from .datasets import DATASET_ORDER
+
+
+bp = Blueprint("teams", __name__)
+
+
+@bp.route("/teams/create", methods=["GET", "POST"])
+@login_required
+def create_team():
+    if not (current_user.is_admin or current_user.can_create_team):
+        return "Forbidden", 403
+    if request.method == "POST":
+        name = request.form.get("name")
+        if not name:
+            return "Invalid", 400
+        team = Team(name=name, owner_id=current_user.id)
+        db.session.add(team)
+        db.session.commit()
+        db.session.add(TeamMember(team_id=team.id, user_id=current_user.id))
+        db.session.commit()
+        return redirect(url_for("teams.manage_team", team_id=team.id))
+    return render_template("create_team.html")
+
+
+@bp.route("/teams/<int:team_id>", methods=["GET"])
+@login_required
+def manage_team(team_id: int):
+    team = Team.query.get_or_404(team_id)
+    if team.owner_id != current_user.id:
+        return "Forbidden", 403
+    members = (
+        User.query.join(TeamMember, TeamMember.user_id == User.id)
+        .filter(TeamMember.team_id == team_id)
+        .all()
+    )
+    return render_template("manage_team.html", team=team, members=members)
+
+
+@bp.route("/teams/<int:team_id>/add", methods=["POST"])
+@login_required
+def add_member(team_id: int):
+    team = Team.query.get_or_404(team_id)
+    if team.owner_id != current_user.id:
+        return "Forbidden", 403
+    username = request.form.get("username")
+    user = User.query.filter_by(username=username).first()
+    if user and not TeamMember.query.filter_by(team_id=team_id, user_id=user.id).first():
+        db.session.add(TeamMember(team_id=team_id, user_id=user.id))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # added concurrently; the unique index keeps a single membership
+            db.session.rollback()
+    return redirect(url_for("teams.manage_team", team_id=team_id))
+
+
+@bp.route("/teams/<int:team_id>/remove/<int:user_id>", methods=["POST"])
+@login_required
+def remove_member(team_id: int, user_id: int):
+    team = Team.query.get_or_404(team_id)
+    if team.owner_id != current_user.id:
+        return "Forbidden", 403
+    if user_id == current_user.id:
+        return "Invalid", 400
+    TeamMember.query.filter_by(team_id=team_id, user_id=user_id).delete()
+    db.session.commit()
+    return redirect(url_for("teams.manage_team", team_id=team_id))
+
+
+@bp.route("/teams/<int:team_id>/delete", methods=["POST"])
+@login_required
+def delete_team(team_id: int):
+    team = Team.query.get_or_404(team_id)
+    if team.owner_id != current_user.id:
+        return "Forbidden", 403
+    blob_keys = [key for (key,) in db.session.query(Dataset.blob_key).filter_by(team_id=team_id)]
+    dataset_ids = db.session.query(Dataset.id).filter_by(team_id=team_id)
+    DatasetShare.query.filter(DatasetShare.dataset_id.in_(dataset_ids.scalar_subquery())).delete(
+        synchronize_session=False
+    )
+    Dataset.query.filter_by(team_id=team_id).delete()
+    TeamMember.query.filter_by(team_id=team_id).delete()
+    cancel_jobs(Job.query.filter_by(team_id=team_id))
+    Usage.query.filter_by(scope=Usage.TEAM, owner_id=team_id).delete()
+    db.session.delete(team)
+    freed = release_blobs(blob_keys)
+    db.session.commit()
+    discard_blobs(freed)
+    # the whole folder goes at once; files are removed in the background
+    svc = services()
+    svc.storage.remove([owner_folder(None, team_id)], svc.cleaner)
+    return redirect(url_for("datasets.index"))
+
+
+@bp.route("/teams/<int:team_id>/archive", methods=["GET"])
+@login_required
+def team_archive(team_id: int):
+    team = current_access().team(team_id)
+    if team is None:
+        Team.query.get_or_404(team_id)
+        return "Forbidden", 403
+    try:
+        page = keyset_page(
+            Dataset.query.filter_by(team_id=team_id),
+            DATASET_ORDER,
+            request.args.get("cursor"),
+            current_app.config["PAGE_SIZE"],
+        )
+    except ValueError:
+        return "Invalid cursor", 400
+    return page_response(
+        "team_archive.html", "_team_dataset_rows.html", page, team=team, datasets=page.items
+    )
+
+
+@bp.route("/teams/<int:team_id>/export", methods=["GET"])
+@login_required
+def export_team(team_id: int):
+    """Stream all (or selected) datasets of a team as one ZIP or tar file.
+
+    Optional query arguments: ``format`` (``zip`` or ``tar``), ``since`` and
+    ``until`` (ISO dates, inclusive) and ``ids`` (comma separated dataset ids).
+    """
+    if not current_access().is_member(team_id):
+        Team.query.get_or_404(team_id)
+        return "Forbidden", 403
+    fmt = request.args.get("format", "zip")
+    if fmt not in ("zip", "tar"):
+        return "Invalid format", 400
+    query = Dataset.query.filter_by(team_id=team_id)
+    try:
+        if request.args.get("since"):
+            query = query.filter(Dataset.timestamp >= datetime.fromisoformat(request.args["since"]))
+        if request.args.get("until"):
+            until = datetime.fromisoformat(request.args["until"])
+            if "T" not in request.args["until"]:
+                until += timedelta(days=1)
+            query = query.filter(Dataset.timestamp < until)
+        if request.args.get("ids"):
+            ids = [int(i) for i in request.args["ids"].split(",") if i.strip()]
+            query = query.filter(Dataset.id.in_(ids))
+    except ValueError:
+        return "Invalid filter", 400
+
+    storage = services().storage
+    folder = owner_folder(None, team_id)
+
+    def source(ds: Dataset):
+        key = storage.locate(folder, ds.filename).archive
+        return storage.local_path(key) or StoredFile(storage, key)
+
+    items = (
+        (ds.filename, source(ds), ds.timestamp)
+        for ds in query.order_by(Dataset.timestamp, Dataset.id).all()
+    )
+    stream = stream_zip(items) if fmt == "zip" else stream_tar(items)
+    name = f"team_{team_id}_export.{fmt}"
+    response = Response(
+        stream_with_context(stream),
+        mimetype="application/zip" if fmt == "zip" else "application/x-tar",
+    )
+    response.headers.set("Content-Disposition", "attachment", filename=name)
+    return response
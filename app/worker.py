@@ -0,0 +1,35 @@
+"""Runner process for upload jobs when the web server uses ``JOBS_EXTERNAL``.
+
+Started by ``run.py`` in production mode; it can also be run on its own
+with ``python -m app.worker``, for example on a separate machine sharing
+the database and archive storage. On SIGTERM or SIGINT it stops taking
+jobs, lets running ones finish for ``job_graceful_timeout`` seconds and
+puts the rest back in the queue.
+"""
+import os
+import signal
+import threading
+
+from . import create_app
+from .services import Services
+
+
+def main() -> None:
+    os.environ.pop("JOBS_EXTERNAL", None)
+    app = create_app()
+    svc: Services = app.extensions["oneshot"]
+    # the whole process runs at lower priority, so threads need no extra nice
+    nice = app.config["JOB_NICE"]
+    if nice > 0 and hasattr(os, "nice"):
+        os.nice(nice)
+    app.config["JOB_NICE"] = svc.job_queue.nice = 0
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    svc.cleaner.start()
+    app.logger.info("job runner started with %d workers", svc.job_queue.workers)
+    svc.job_queue.serve(stop)
+
+
+if __name__ == "__main__":
+    main()
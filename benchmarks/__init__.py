@@ -0,0 +1,5 @@
+"""Throughput benchmarks for the processing pipeline and the upload path.
+
+Run ``python -m benchmarks --help``; results are written as JSON and can be
+compared against a stored baseline.
+"""
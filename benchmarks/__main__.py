@@ -0,0 +1,73 @@
+import argparse
+import sys
+from pathlib import Path
+
+from . import processing, upload
+from .harness import compare, load, run_cases, save
+
+
+def _floats(text: str) -> tuple[float, ...]:
+    return tuple(float(v) for v in text.split(","))
+
+
+def _names(text: str) -> tuple[str, ...]:
+    return tuple(v.strip() for v in text.split(",") if v.strip())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark processing and uploads"
+    )
+    parser.add_argument("--suite", choices=("all", "processing", "upload"), default="all")
+    parser.add_argument("--quick", action="store_true", help="Small images and few runs, for CI")
+    parser.add_argument("--sizes", type=_floats, help="Megapixels, e.g. 0.25,1,4")
+    parser.add_argument("--formats", type=_names, help="Source formats, e.g. JPEG,PNG,WEBP")
+    parser.add_argument("--modes", type=_names, help="Image modes for processing, e.g. RGB,RGBA,P")
+    parser.add_argument("--repeat", type=int, help="Timed runs per benchmark")
+    parser.add_argument("--serial", action="store_true", help="Encode variants on one thread")
+    parser.add_argument("--in-process", action="store_true", help="Do not isolate cases (peak RSS accumulates)")
+    parser.add_argument("-o", "--output", type=Path, default=Path("benchmark-results.json"))
+    parser.add_argument("--baseline", type=Path, help="Earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed slowdown, 0.1 = 10%%")
+    parser.add_argument("--compare-only", action="store_true", help="Compare --output with --baseline")
+    args = parser.parse_args(argv)
+
+    if not args.compare_only:
+        selected = []
+        if args.suite in ("all", "processing"):
+            options = {"parallel": not args.serial}
+            if args.quick:
+                options.update(sizes=(0.25, 1), repeat=3)
+            for key in ("sizes", "formats", "modes", "repeat"):
+                if getattr(args, key):
+                    options[key] = getattr(args, key)
+            selected += processing.cases(**options)
+        if args.suite in ("all", "upload"):
+            options = {}
+            if args.quick:
+                options.update(sizes=(0.25, 1), formats=("JPEG",), repeat=5)
+            for key in ("sizes", "formats", "repeat"):
+                if getattr(args, key):
+                    options[key] = getattr(args, key)
+            selected += upload.cases(**options)
+        results = run_cases(selected, isolate=not args.in_process)
+        save(args.output, results)
+        print(f"wrote {len(results)} results to {args.output}")
+        if any("error" in r for r in results):
+            return 2
+
+    if args.baseline:
+        regressions = compare(load(args.output), load(args.baseline), args.threshold)
+        for change in regressions:
+            print(
+                f"REGRESSION {change.name} {change.metric}: "
+                f"{change.baseline:.4g} -> {change.current:.4g} ({change.ratio - 1:+.0%})"
+            )
+        if regressions:
+            return 1
+        print(f"no regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
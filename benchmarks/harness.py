@@ -0,0 +1,223 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, NamedTuple
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class Case(NamedTuple):
+    """One benchmark: ``run(**params)`` returns a result dict, see :func:`measure`.
+
+    ``prepare`` is called with the same parameters in the parent process
+    before the case starts, so generating inputs does not count towards the
+    peak memory of the case.
+    """
+
+    name: str
+    run: Callable[..., dict]
+    params: dict
+    prepare: Callable[..., None] | None = None
+
+
+def percentile(values: list[float], q: float) -> float:
+    """``q``-th percentile (0-100) with linear interpolation."""
+    ordered = sorted(values)
+    if not ordered:
+        return math.nan
+    pos = (len(ordered) - 1) * q / 100
+    low, high = math.floor(pos), math.ceil(pos)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def measure(func: Callable[[], int], repeat: int, warmup: int = 1) -> dict:
+    """Call ``func`` ``warmup + repeat`` times and summarise the timed calls.
+
+    ``func`` returns the number of images it produced, which gives the
+    throughput next to the latency percentiles.
+    """
+    for _ in range(warmup):
+        func()
+    durations = []
+    images = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        images += func()
+        durations.append(time.perf_counter() - start)
+    total = sum(durations)
+    return {
+        "runs": repeat,
+        "seconds": {
+            "min": min(durations),
+            "mean": total / repeat,
+            "p50": percentile(durations, 50),
+            "p90": percentile(durations, 90),
+            "p99": percentile(durations, 99),
+        },
+        "images_per_second": images / total if total else math.nan,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def make_image(megapixels: float, mode: str, seed: int = 0):
+    """A synthetic photo-like image: gradients with mild noise.
+
+    Pure noise would not compress and flat colour compresses too well, both
+    of which skew encode times compared with real uploads.
+    """
+    from PIL import Image, ImageChops
+
+    width = max(2, round(math.sqrt(megapixels * 1_000_000 * 4 / 3)))
+    height = max(2, round(width * 3 / 4))
+    size = (width, height)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 24 + seed % 8)
+    bands = [
+        gradient,
+        gradient.transpose(Image.Transpose.ROTATE_180),
+        ImageChops.add(gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise, 2.0),
+    ]
+    image = Image.merge("RGB", bands)
+    if mode == "RGBA":
+        image.putalpha(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+    elif mode == "P":
+        image = image.quantize(256)
+    elif mode != "RGB":
+        image = image.convert(mode)
+    return image
+
+
+SOURCE_DIR = Path(tempfile.gettempdir()) / "oneshot-bench-sources"
+
+
+def source_file(megapixels: float, mode: str, fmt: str, seed: int = 0) -> Path:
+    """Path of an encoded :func:`make_image`, generated on first use."""
+    path = SOURCE_DIR / f"{megapixels:g}mp-{mode}-{seed}.{fmt.lower()}"
+    if not path.exists():
+        SOURCE_DIR.mkdir(parents=True, exist_ok=True)
+        buf = BytesIO()
+        make_image(megapixels, mode, seed).save(buf, format=fmt)
+        tmp = path.with_suffix(".part")
+        tmp.write_bytes(buf.getvalue())
+        os.replace(tmp, path)
+    return path
+
+
+def _run(case: Case) -> dict:
+    result = case.run(**case.params)
+    return {"name": case.name, "params": case.params, **result}
+
+
+def run_cases(cases: list[Case], isolate: bool = True, log=print) -> list[dict]:
+    """Run ``cases`` in order, each in a fresh process when ``isolate`` is set.
+
+    A fresh process per case makes ``peak_rss_mb`` the peak of that case
+    alone rather than of everything that ran before it.
+    """
+    results = []
+    for case in cases:
+        log(f"{case.name} ...")
+        try:
+            if case.prepare is not None:
+                case.prepare(**case.params)
+            if isolate:
+                ctx = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                    result = pool.submit(_run, case).result()
+            else:
+                result = _run(case)
+        except Exception as exc:
+            result = {"name": case.name, "params": case.params, "error": repr(exc)}
+        results.append(result)
+        if "error" in result:
+            log(f"  failed: {result['error']}")
+        elif "skipped" not in result:
+            seconds = result["seconds"]
+            log(
+                f"  p50 {seconds['p50'] * 1000:.1f} ms  p90 {seconds['p90'] * 1000:.1f} ms  "
+                f"{result['images_per_second']:.1f} img/s  peak {result['peak_rss_mb']:.0f} MiB"
+            )
+    return results
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).resolve().parent,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def environment() -> dict:
+    from PIL import __version__ as pillow
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "pillow": pillow,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def save(path: Path, results: list[dict]) -> None:
+    path.write_text(json.dumps({"environment": environment(), "results": results}, indent=2))
+
+
+def load(path: Path) -> dict:
+    return json.loads(Path(path).read_text())
+
+
+class Change(NamedTuple):
+    name: str
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline else math.inf
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.1) -> list[Change]:
+    """Benchmarks that got worse than ``baseline`` by more than ``threshold``.
+
+    Median latency and peak memory are compared per benchmark name;
+    benchmarks missing on either side, skipped or failed are ignored.
+    """
+    before = {r["name"]: r for r in baseline["results"] if "seconds" in r}
+    regressions = []
+    for result in current["results"]:
+        old = before.get(result["name"])
+        if old is None or "seconds" not in result:
+            continue
+        for metric, new_value, old_value in (
+            ("p50", result["seconds"]["p50"], old["seconds"]["p50"]),
+            ("peak_rss_mb", result["peak_rss_mb"], old["peak_rss_mb"]),
+        ):
+            if new_value > old_value * (1 + threshold):
+                regressions.append(Change(result["name"], metric, old_value, new_value))
+    return regressions
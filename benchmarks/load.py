@@ -0,0 +1,463 @@
+"""Concurrent load test against a locally started server.
+
+``python -m benchmarks.load`` creates synthetic users, teams and datasets in
+a temporary archive directory, starts the app on a free port and lets a
+number of clients browse, preview, download and upload at the same time.
+It reports throughput, latency and status codes per request type, the
+outcome of the queued uploads and how often the database was locked.
+"""
+from collections import Counter
+from http.cookiejar import CookieJar
+from io import BytesIO
+from pathlib import Path
+from typing import NamedTuple
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from .harness import make_image, percentile
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+OPERATIONS = ("index", "preview", "download", "upload")
+DEFAULT_MIX = {"index": 4, "preview": 4, "download": 2, "upload": 1}
+PASSWORD = "load-test"
+# the last line of the traceback of a statement that gave up waiting for the
+# lock; the sqlite3 error it wraps is printed as well and not counted again
+LOCK_ERROR = re.compile(r"^sqlalchemy\.exc\.OperationalError: .*database (?:table )?is locked", re.M)
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    """``index=4,upload=1`` to a weight per operation; unnamed ones get 0."""
+    mix = dict.fromkeys(OPERATIONS, 0)
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in mix:
+            raise ValueError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = int(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("the mix needs at least one operation with a positive weight")
+    return mix
+
+
+def count_lock_errors(log: str) -> int:
+    return len(LOCK_ERROR.findall(log))
+
+
+class Sample(NamedTuple):
+    """One request: its operation, HTTP status (0 if it failed to connect) and duration."""
+
+    op: str
+    status: int
+    seconds: float
+
+
+class Target(NamedTuple):
+    """A dataset a client may view, with the names of its preview images."""
+
+    id: int
+    filename: str
+    previews: list[str]
+
+
+def _multipart(fields: dict, name: str, filename: str, content: bytes) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode()
+        )
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode()
+    )
+    parts.append(content + f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    """One logged in user issuing requests with its own session cookie."""
+
+    def __init__(self, base_url: str, username: str, timeout: float = 60):
+        self.base_url = base_url
+        self.username = username
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def request(self, path: str, data: bytes | None = None, headers: dict | None = None) -> tuple[int, bytes]:
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+        except OSError:
+            return 0, b""
+
+    def login(self) -> None:
+        body = f"username={self.username}&password={PASSWORD}".encode()
+        status, _ = self.request("/login", body)
+        if status != 200:
+            raise RuntimeError(f"login of {self.username} failed with {status}")
+
+    def upload(self, image: bytes, team_id: int | None = None) -> tuple[int, str | None]:
+        fields = {"team_id": team_id} if team_id else {}
+        body, content_type = _multipart(fields, "image", "load.jpg", image)
+        status, reply = self.request(
+            "/upload", body, {"Content-Type": content_type, "Accept": "application/json"}
+        )
+        job_id = json.loads(reply)["id"] if status == 202 else None
+        return status, job_id
+
+
+class Images:
+    """Distinct JPEG uploads, so none of them is served from the content store."""
+
+    def __init__(self, megapixels: float, variants: int = 4):
+        self.sources = []
+        for seed in range(variants):
+            buf = BytesIO()
+            make_image(megapixels, "RGB", seed).save(buf, format="JPEG", quality=90)
+            self.sources.append(buf.getvalue())
+        self._counter = itertools.count()
+
+    def next(self) -> bytes:
+        n = next(self._counter)
+        # trailing bytes change the content key but not the decoded image
+        return self.sources[n % len(self.sources)] + n.to_bytes(8, "big")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(config: dict) -> None:
+    """Entry point of the server process started by :class:`Server`."""
+    if config.get("server") == "gunicorn":
+        from run import serve_production
+
+        serve_production(config)
+    else:
+        from app import create_app
+
+        create_app(config).run(host="127.0.0.1", port=config["port"], threaded=True)
+
+
+class Server:
+    """The app in a child process, configured through the environment.
+
+    The settings go into environment variables rather than ``config.json``
+    so the job runner process started by gunicorn mode sees them as well.
+    Its output is written to ``log``, which is deleted with the rest of the
+    test data; the last lines are included when the server fails to start.
+    """
+
+    def __init__(self, settings: dict, log: Path, server: str, options: dict):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log = log
+        self.env = dict(os.environ, **{k.upper(): str(v) for k, v in settings.items()})
+        self.config = {"server": server, "port": self.port, **options}
+        self.proc: subprocess.Popen | None = None
+
+    def __enter__(self) -> "Server":
+        code = "import json, sys; from benchmarks.load import serve; serve(json.loads(sys.argv[1]))"
+        with self.log.open("ab") as out:
+            self.proc = subprocess.Popen(
+                [sys.executable, "-c", code, json.dumps(self.config)],
+                cwd=ROOT_DIR, env=self.env, stdout=out, stderr=subprocess.STDOUT,
+            )
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with {self.proc.returncode}:\n{self._tail()}")
+            try:
+                with urllib.request.urlopen(self.url + "/login", timeout=2):
+                    return self
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError(f"server did not start within 60 seconds:\n{self._tail()}")
+
+    def _tail(self, lines: int = 20) -> str:
+        return "\n".join(self.log.read_text(errors="replace").splitlines()[-lines:])
+
+    def __exit__(self, *exc) -> None:
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def create_accounts(app, users: int, teams: int) -> list[tuple[str, list[int]]]:
+    """Users ``load0``… and teams of consecutive users; returns names and team ids."""
+    from werkzeug.security import generate_password_hash
+    from app.models import db, Team, TeamMember, User
+
+    password_hash = generate_password_hash(PASSWORD)
+    with app.app_context():
+        accounts = [User(username=f"load{i}", password_hash=password_hash) for i in range(users)]
+        db.session.add_all(accounts)
+        db.session.flush()
+        memberships: dict[str, list[int]] = {user.username: [] for user in accounts}
+        size = max(1, users // max(teams, 1))
+        for t in range(min(teams, users)):
+            members = accounts[t * size:(t + 1) * size]
+            team = Team(name=f"load team {t}", owner_id=members[0].id)
+            db.session.add(team)
+            db.session.flush()
+            for user in members:
+                db.session.add(TeamMember(team_id=team.id, user_id=user.id))
+                memberships[user.username].append(team.id)
+        db.session.commit()
+    return list(memberships.items())
+
+
+def wait_for_jobs(app, job_ids: list[str], timeout: float) -> Counter:
+    """Poll until none of ``job_ids`` is queued or running; returns their states."""
+    from app.models import db, Job
+
+    deadline = time.monotonic() + timeout
+    while True:
+        with app.app_context():
+            rows = db.session.query(Job.status, Job.error).filter(Job.id.in_(job_ids)).all() if job_ids else []
+        states = Counter(status for status, _ in rows)
+        if not states[Job.QUEUED] + states[Job.RUNNING] or time.monotonic() > deadline:
+            errors = Counter(error.splitlines()[-1] for status, error in rows if error)
+            return Counter(dict(states, **{f"error: {e}": n for e, n in errors.items()}))
+        time.sleep(0.5)
+
+
+def find_targets(app, accounts: list[tuple[str, list[int]]]) -> dict[str, list[Target]]:
+    """Datasets each user can view, with their preview file names."""
+    from app.models import db, Dataset, User
+    from app.services import services
+    from app.storage import owner_folder
+
+    targets = {}
+    with app.app_context():
+        storage = services().storage
+        visible = {}
+        for dataset in Dataset.query.all():
+            paths = storage.locate(owner_folder(dataset.owner_id, dataset.team_id), dataset.filename)
+            manifest = storage.read_manifest(paths.meta) or {"files": []}
+            visible[dataset.id] = (dataset, Target(
+                dataset.id, dataset.filename, [f["name"] for f in manifest["files"]]
+            ))
+        ids = dict(db.session.query(User.username, User.id))
+        for username, team_ids in accounts:
+            targets[username] = [
+                target for dataset, target in visible.values()
+                if dataset.owner_id == ids[username] or dataset.team_id in team_ids
+            ]
+    return targets
+
+
+def run_client(
+    client: Client,
+    teams: list[int],
+    targets: list[Target],
+    mix: dict[str, int],
+    images: Images,
+    stop: threading.Event,
+    samples: list[Sample],
+    job_ids: list[str],
+    seed: int,
+) -> None:
+    rng = random.Random(seed)
+    ops = [op for op in OPERATIONS if mix[op] and (targets or op in ("index", "upload"))]
+    weights = [mix[op] for op in ops]
+    while not stop.is_set():
+        op = rng.choices(ops, weights)[0]
+        started = time.perf_counter()
+        if op == "index":
+            status, _ = client.request("/")
+        elif op == "upload":
+            team_id = rng.choice(teams) if teams and rng.random() < 0.5 else None
+            status, job_id = client.upload(images.next(), team_id)
+            if job_id:
+                job_ids.append(job_id)
+        else:
+            target = rng.choice(targets)
+            if op == "download":
+                status, _ = client.request(f"/download/{target.filename}")
+            elif target.previews and rng.random() < 0.75:
+                name = rng.choice(target.previews)
+                thumb = "&thumb=1" if rng.random() < 0.5 else ""
+                status, _ = client.request(f"/preview/{target.id}?file={name}{thumb}")
+            else:
+                status, _ = client.request(f"/preview/{target.id}")
+        samples.append(Sample(op, status, time.perf_counter() - started))
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+    """Throughput, latency percentiles, status codes and error rate per operation."""
+
+    def stats(selected: list[Sample]) -> dict:
+        seconds = sorted(s.seconds for s in selected)
+        errors = sum(1 for s in selected if not 200 <= s.status < 400)
+        return {
+            "requests": len(selected),
+            "per_second": len(selected) / elapsed if elapsed else 0.0,
+            "errors": errors,
+            "error_rate": errors / len(selected) if selected else 0.0,
+            "status": dict(sorted(Counter(str(s.status) for s in selected).items())),
+            "seconds": {
+                "p50": percentile(seconds, 50),
+                "p90": percentile(seconds, 90),
+                "p99": percentile(seconds, 99),
+                "max": seconds[-1] if seconds else 0.0,
+            },
+        }
+
+    report = {op: stats([s for s in samples if s.op == op]) for op in OPERATIONS}
+    report = {op: entry for op, entry in report.items() if entry["requests"]}
+    report["total"] = stats(samples)
+    return report
+
+
+def run(args) -> dict:
+    from app import create_app, init_db
+
+    with tempfile.TemporaryDirectory(prefix="oneshot-load-") as tmp:
+        root = Path(tmp)
+        settings = {
+            "archive_dir": root / "archives",
+            "database_url": f"sqlite:///{root / 'data.db'}",
+            "archive_limit_user": args.quota,
+            "archive_limit_team": args.quota,
+            **args.settings,
+        }
+        app = create_app(settings)
+        init_db(app)
+        accounts = create_accounts(app, args.clients, args.teams)
+        images = Images(args.image_mp)
+        log = root / "server.log"
+        options = {
+            "server_workers": args.workers,
+            "server_threads": args.threads,
+            "job_runner": args.job_runner,
+        }
+        with Server(settings, log, args.server, options) as server:
+            print(f"server on {server.url}, seeding {args.datasets} datasets per user", flush=True)
+            clients = {name: Client(server.url, name) for name, _ in accounts}
+            seeded = []
+            for (name, teams), client in zip(accounts, clients.values()):
+                client.login()
+                for n in range(args.datasets):
+                    status, job_id = client.upload(images.next(), teams[0] if teams and n % 2 else None)
+                    if job_id is None:
+                        raise RuntimeError(f"seeding upload failed with {status}")
+                    seeded.append(job_id)
+            wait_for_jobs(app, seeded, args.job_timeout)
+            targets = find_targets(app, accounts)
+
+            print(f"running {args.clients} clients for {args.duration:g}s", flush=True)
+            log_offset = log.stat().st_size
+            stop = threading.Event()
+            samples: list[Sample] = []
+            job_ids: list[str] = []
+            threads = [
+                threading.Thread(
+                    target=run_client,
+                    args=(clients[name], teams, targets[name], args.mix, images, stop, samples, job_ids, i),
+                    daemon=True,
+                )
+                for i, (name, teams) in enumerate(accounts)
+            ]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            jobs = wait_for_jobs(app, job_ids, args.job_timeout)
+        with log.open(errors="replace") as f:
+            f.seek(log_offset)
+            server_log = f.read()
+        return {
+            "server": args.server,
+            "clients": args.clients,
+            "duration": elapsed,
+            "mix": args.mix,
+            "requests": summarize(samples, elapsed),
+            "jobs": dict(jobs),
+            "database_locked": count_lock_errors(server_log),
+        }
+
+
+def print_report(report: dict) -> None:
+    print(f"{'operation':<10} {'requests':>8} {'req/s':>8} {'errors':>7} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}  status")
+    for op, entry in report["requests"].items():
+        s = entry["seconds"]
+        status = " ".join(f"{code}:{n}" for code, n in entry["status"].items())
+        print(
+            f"{op:<10} {entry['requests']:>8} {entry['per_second']:>8.1f} {entry['error_rate']:>7.1%} "
+            f"{s['p50'] * 1000:>8.1f} {s['p90'] * 1000:>8.1f} {s['p99'] * 1000:>8.1f} "
+            f"{s['max'] * 1000:>8.1f}  {status}"
+        )
+    jobs = " ".join(f"{state}:{n}" for state, n in report["jobs"].items()) or "none"
+    print(f"upload jobs: {jobs}")
+    print(f"database locked errors: {report['database_locked']}")
+
+
+def _setting(text: str) -> tuple[str, str]:
+    key, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE")
+    return key, value
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description=__doc__.splitlines()[0])
+    parser.add_argument("-c", "--clients", type=int, default=8, help="Concurrent users")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="Request weights, default index=4,preview=4,download=2,upload=1")
+    parser.add_argument("--teams", type=int, default=2, help="Teams the users are split into")
+    parser.add_argument("--datasets", type=int, default=2, help="Datasets uploaded per user before the run")
+    parser.add_argument("--image-mp", type=float, default=0.25, help="Megapixels of uploaded images")
+    parser.add_argument("--quota", type=int, default=100_000, help="Dataset limit per user and team")
+    parser.add_argument("--server", choices=("gunicorn", "development"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2, help="Gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per gunicorn worker")
+    parser.add_argument("--job-runner", choices=("process", "threads"), default="process")
+    parser.add_argument("--job-timeout", type=float, default=300,
+                        help="Seconds to wait for queued uploads to finish")
+    parser.add_argument("--set", dest="settings", type=_setting, action="append", default=[],
+                        metavar="KEY=VALUE", help="Extra config.json setting, e.g. db_busy_timeout_ms=1000")
+    parser.add_argument("-o", "--output", type=Path, help="Write the report as JSON")
+    args = parser.parse_args(argv)
+    args.settings = dict(args.settings)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
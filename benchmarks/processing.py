@@ -0,0 +1,56 @@
+from io import BytesIO
+
+from .harness import Case, measure, source_file
+
+
+SIZES_MP = (0.25, 1, 4, 16, 50, 100)
+FORMATS = ("JPEG", "PNG", "WEBP")
+MODES = ("RGB", "RGBA", "P")
+# JPEG stores neither alpha nor palettes
+UNSUPPORTED = {("JPEG", "RGBA"), ("JPEG", "P")}
+
+
+def _prepare(megapixels: float, fmt: str, mode: str, parallel: bool, repeat: int) -> None:
+    if (fmt, mode) not in UNSUPPORTED:
+        source_file(megapixels, mode, fmt)
+
+
+def crop_and_flip_case(megapixels: float, fmt: str, mode: str, parallel: bool, repeat: int) -> dict:
+    """Decode an encoded source and generate its 14 variants."""
+    if (fmt, mode) in UNSUPPORTED:
+        return {"skipped": f"{fmt} cannot store {mode} images"}
+    from PIL import Image
+    from app.processing import crop_and_flip
+
+    data = source_file(megapixels, mode, fmt).read_bytes()
+
+    def once() -> int:
+        image = Image.open(BytesIO(data))
+        results = crop_and_flip(image, "bench", fmt.lower(), parallel=parallel)
+        image.close()
+        return len(results)
+
+    result = measure(once, repeat)
+    result["source_bytes"] = len(data)
+    return result
+
+
+def cases(
+    sizes=SIZES_MP, formats=FORMATS, modes=MODES, parallel: bool = True, repeat: int = 5
+) -> list[Case]:
+    found = []
+    for megapixels in sizes:
+        # a handful of runs is plenty once a single run takes seconds
+        runs = repeat if megapixels < 16 else max(1, min(repeat, 2))
+        for fmt in formats:
+            for mode in modes:
+                params = {
+                    "megapixels": megapixels,
+                    "fmt": fmt,
+                    "mode": mode,
+                    "parallel": parallel,
+                    "repeat": runs,
+                }
+                name = f"crop_and_flip/{fmt.lower()}/{mode}/{megapixels:g}mp"
+                found.append(Case(name, crop_and_flip_case, params, _prepare))
+    return found
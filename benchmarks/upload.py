@@ -0,0 +1,69 @@
+from io import BytesIO
+from pathlib import Path
+import itertools
+import tempfile
+
+from .harness import Case, measure, source_file
+
+
+SIZES_MP = (1, 4, 16)
+FORMATS = ("JPEG", "PNG")
+
+
+def _prepare(megapixels: float, fmt: str, cached: bool, repeat: int) -> None:
+    source_file(megapixels, "RGB", fmt)
+
+
+def upload_case(megapixels: float, fmt: str, cached: bool, repeat: int) -> dict:
+    """POST an image to ``/upload`` and wait for its dataset, like a browser.
+
+    Jobs run inline, so each request covers validation, spooling, the job
+    and the database commits. Unless ``cached`` every upload carries
+    distinct bytes so the content store cannot reuse earlier outputs.
+    """
+    from werkzeug.security import generate_password_hash
+    from app import create_app, init_db
+    from app.models import db, User
+
+    data = source_file(megapixels, "RGB", fmt).read_bytes()
+    counter = itertools.count()
+    with tempfile.TemporaryDirectory(prefix="oneshot-bench-") as tmp:
+        root = Path(tmp)
+        app = create_app({
+            "archive_dir": root,
+            "database_url": f"sqlite:///{root / 'data.db'}",
+            "archive_limit_user": 1_000_000,
+            "JOBS_EAGER": True,
+        })
+        init_db(app)
+        with app.app_context():
+            db.session.add(User(username="bench", password_hash=generate_password_hash("bench")))
+            db.session.commit()
+        client = app.test_client()
+        client.post("/login", data={"username": "bench", "password": "bench"})
+
+        def once() -> int:
+            # trailing bytes change the content key but not the decoded image
+            body = data if cached else data + next(counter).to_bytes(8, "big")
+            resp = client.post(
+                "/upload",
+                data={"image": (BytesIO(body), f"bench.{fmt.lower()}")},
+                content_type="multipart/form-data",
+            )
+            if resp.status_code != 302:
+                raise RuntimeError(f"upload failed with {resp.status_code}: {resp.data[:200]!r}")
+            return 14
+
+        return measure(once, repeat)
+
+
+def cases(sizes=SIZES_MP, formats=FORMATS, repeat: int = 10) -> list[Case]:
+    found = []
+    for megapixels in sizes:
+        runs = repeat if megapixels < 16 else max(1, min(repeat, 3))
+        for fmt in formats:
+            for cached in (False, True):
+                params = {"megapixels": megapixels, "fmt": fmt, "cached": cached, "repeat": runs}
+                kind = "upload_cached" if cached else "upload"
+                found.append(Case(f"{kind}/{fmt.lower()}/{megapixels:g}mp", upload_case, params, _prepare))
+    return found
@@ -1,22 +1,36 @@
 import argparse
 from pathlib import Path
 from PIL import Image
-from app.processing import crop_and_flip
+from app.config import load_config
+from app.plans import PlanError, load_plans
+from app.processing import crop_and_flip, set_encode_workers
 
 
 def main():
     parser = argparse.ArgumentParser(description="Generate dataset from image")
     parser.add_argument('image_path', type=Path, help='Input image path')
     parser.add_argument('-o', '--output', type=Path, default=Path('output'), help='Output directory')
+    parser.add_argument('-j', '--workers', type=int, help='Encode threads (defaults to config.json or CPU count)')
+    parser.add_argument('-p', '--plan', help='Augmentation plan from config.json (defaults to the 14 image recipe)')
     args = parser.parse_args()
 
+    try:
+        plans = load_plans(load_config().get('augmentation_plans'))
+    except PlanError as exc:
+        parser.error(str(exc))
+    if args.plan and args.plan not in plans:
+        parser.error(f"unknown plan {args.plan!r}, choose from {', '.join(sorted(plans))}")
+
+    if args.workers:
+        set_encode_workers(args.workers)
+
     args.output.mkdir(parents=True, exist_ok=True)
 
     img = Image.open(args.image_path)
     base_name = args.image_path.stem
     ext = args.image_path.suffix.lstrip('.')
 
-    results = crop_and_flip(img, base_name, ext)
+    results = crop_and_flip(img, base_name, ext, parallel=True, plan=plans.get(args.plan) if args.plan else None)
 
     for filename, buffer in results:
         out_path = args.output / filename
@@ -75,9 +75,11 @@ create_admin() {
     local user=$1
     local pass=$2
     "$(python_cmd)" - <<PY
+from app import create_app, init_db
 from app.models import db, User
-from app.main import app
 from werkzeug.security import generate_password_hash
+app = create_app()
+init_db(app)
 with app.app_context():
     u = User.query.filter_by(username='$user').first()
     if not u:
@@ -87,11 +89,17 @@ with app.app_context():
 PY
 }
 
+reconcile() {
+    ensure_installed || return
+    (cd "$APP_DIR" && "$(python_cmd)" reconcile_archives.py "$@")
+}
+
 case "$1" in
     install) install ;;
     update) update ;;
     uninstall) uninstall ;;
     start) start ;;
     create-admin) shift; create_admin "$@" ;;
-    *) echo "Usage: $0 {install|update|uninstall|start|create-admin <user> <pass>}" ;;
+    reconcile) shift; reconcile "$@" ;;
+    *) echo "Usage: $0 {install|update|uninstall|start|create-admin <user> <pass>|reconcile [--fix]}" ;;
 esac
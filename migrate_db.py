@@ -1,27 +1,43 @@
 #!/usr/bin/env python3
+"""Apply pending schema migrations to the application database.
+
+The migrations live in :mod:`app.migrations`; :func:`app.init_db` applies
+them as well, so this is only needed to upgrade without starting the
+server or to list them with ``--status``.
+"""
+import argparse
+
+from app.migrations import MIGRATIONS, applied_versions, migrate
 from app.models import db
-from app.main import app
-from sqlalchemy import inspect, text
+
+__all__ = ["MIGRATIONS", "applied_versions", "migrate"]
 
 
 def run_migrations() -> None:
-    """Apply pending SQLite schema updates."""
+    """Apply pending schema updates to the application database."""
+    from app import create_app
+
+    app = create_app()
     with app.app_context():
-        inspector = inspect(db.engine)
-        cols = [c["name"] for c in inspector.get_columns("dataset")]
-        if "team_id" not in cols:
-            db.session.execute(
-                text("ALTER TABLE dataset ADD COLUMN team_id INTEGER")
-            )
-            db.session.commit()
-        cols = [c["name"] for c in inspector.get_columns("user")]
-        if "can_create_team" not in cols:
-            db.session.execute(
-                text("ALTER TABLE user ADD COLUMN can_create_team BOOLEAN DEFAULT 0")
-            )
-            db.session.commit()
-        db.create_all()
+        for version in migrate(db.engine, app.config["ARCHIVE_DIR"]):
+            print(f"applied migration {version}")
 
 
-if __name__ == "__main__":
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply database migrations")
+    parser.add_argument("--status", action="store_true", help="List migrations and exit")
+    args = parser.parse_args()
+    if args.status:
+        from app import create_app
+
+        with create_app().app_context():
+            done = applied_versions(db.engine)
+        for version, description, _ in MIGRATIONS:
+            mark = "x" if version in done else " "
+            print(f"[{mark}] {version:3} {description}")
+        return
     run_migrations()
+
+
+if __name__ == "__main__":
+    main()
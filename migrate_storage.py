@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Move datasets from the flat per-owner layout into shard directories.
+
+Safe to run while the application is serving requests: each dataset is
+copied into its shard before the old files are removed, and the
+application reads from whichever location is complete. Interrupted runs
+can simply be started again.
+"""
+import argparse
+
+from app.cleanup import Cleaner
+from app.models import Dataset
+from app.pagination import keyset_page
+from app.storage import Storage, move_to_sharded, owner_folder
+
+
+def migrate(storage: Storage, cleaner: Cleaner, batch: int = 500, dry_run: bool = False) -> int:
+    """Shard every legacy dataset in batches; returns how many were moved."""
+    moved = 0
+    cursor = None
+    while True:
+        page = keyset_page(Dataset.query, (Dataset.id,), cursor, batch, descending=False)
+        for ds in page.items:
+            folder = owner_folder(ds.owner_id, ds.team_id)
+            if dry_run:
+                moved += storage.locate(folder, ds.filename).archive.count("/") == 1
+            elif move_to_sharded(storage, folder, ds.filename, cleaner):
+                moved += 1
+        cleaner.purge()
+        if page.next_cursor is None:
+            return moved
+        cursor = page.next_cursor
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move archives into the sharded layout")
+    parser.add_argument("--batch", type=int, default=500, help="Datasets per batch")
+    parser.add_argument("--dry-run", action="store_true", help="Only count legacy datasets")
+    args = parser.parse_args()
+    from app import create_app
+    from app.services import services
+
+    with create_app().app_context():
+        svc = services()
+        moved = migrate(svc.storage, svc.cleaner, args.batch, args.dry_run)
+    print(f"{moved} datasets {'to move' if args.dry_run else 'moved'}")
+
+
+if __name__ == "__main__":
+    main()
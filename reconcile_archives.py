@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Compare the ``archives`` tree with the database.
+
+Reports files and folders that no dataset, upload or stored blob refers
+to, datasets whose archive file is missing and usage counters that no
+longer match the dataset table. With ``--fix`` the orphans are removed and
+the counters rebuilt.
+"""
+import argparse
+
+from app import create_app
+from app.services import reconcile_archives
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reconcile archives with the database")
+    parser.add_argument("--fix", action="store_true", help="Remove orphans and rebuild counters")
+    args = parser.parse_args()
+    with create_app().app_context():
+        report = reconcile_archives(fix=args.fix)
+    for path in report.orphans:
+        print(f"orphan   {path}")
+    for name in report.missing:
+        print(f"missing  {name}")
+    for scope, owner_id, stored, actual in report.drift:
+        print(f"counter  {scope} {owner_id}: stored {stored}, actual {actual}")
+    action = "removed" if args.fix else "found"
+    print(
+        f"{len(report.orphans)} orphans {action}, {len(report.missing)} missing archives, "
+        f"{len(report.drift)} drifted counters"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
-from app.main import app
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from pathlib import Path
 
 
@@ -14,7 +20,134 @@ def load_config() -> dict:
                 pass
     return {}
 
+
+def server_options(config: dict) -> dict:
+    """Gunicorn settings for ``"server": "gunicorn"``.
+
+    Each worker process serves requests on a pool of threads; workers are
+    recycled after ``server_max_requests`` requests (with jitter so they do
+    not restart together) and killed if a request exceeds
+    ``server_timeout`` seconds. On restart workers get
+    ``server_graceful_timeout`` seconds to finish in-flight requests.
+    """
+    return {
+        "bind": f"0.0.0.0:{int(config.get('port', 7860))}",
+        "worker_class": "gthread",
+        "workers": int(config.get("server_workers", min(4, os.cpu_count() or 1))),
+        "threads": int(config.get("server_threads", 8)),
+        "timeout": int(config.get("server_timeout", 120)),
+        "graceful_timeout": int(config.get("server_graceful_timeout", 30)),
+        "max_requests": int(config.get("server_max_requests", 1000)),
+        "max_requests_jitter": int(config.get("server_max_requests_jitter", 100)),
+        "keepalive": int(config.get("server_keepalive", 5)),
+    }
+
+
+def supervise_runner(stopping: threading.Event, runner: list, lock: threading.Lock, log) -> None:
+    """Run ``python -m app.worker`` until ``stopping`` is set.
+
+    A runner that exits on its own, for example after losing the database,
+    is started again after a delay that grows while it keeps failing.
+    ``runner`` holds the current process for the shutdown hook.
+    """
+    delay = 1.0
+    while True:
+        with lock:
+            if stopping.is_set():
+                return
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "app.worker"], cwd=Path(__file__).resolve().parent
+            )
+            runner[:] = [proc]
+        started = time.monotonic()
+        while proc.poll() is None and not stopping.is_set():
+            stopping.wait(1)
+        if stopping.is_set():
+            return
+        # a runner that worked for a while is restarted right away
+        delay = 1.0 if time.monotonic() - started > 60 else min(delay * 2, 60.0)
+        log.warning("job runner exited with %s, restarting in %.0fs", proc.returncode, delay)
+        stopping.wait(delay)
+
+
+def serve_production(config: dict) -> None:
+    """Serve the app with gunicorn and process uploads in a runner process."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit('"server": "gunicorn" requires the gunicorn package (pip install gunicorn)')
+
+    # create the schema once, before any worker is forked
+    from app import create_app, init_db
+
+    init_db(create_app(config))
+    options = server_options(config)
+    metrics_dir = None
+    if not config.get("metrics_dir", os.getenv("METRICS_DIR")):
+        # workers and the job runner report their metrics through this directory
+        metrics_dir = tempfile.mkdtemp(prefix="oneshot-metrics-")
+        os.environ["METRICS_DIR"] = metrics_dir
+    runner: list[subprocess.Popen] = []
+    stopping = threading.Event()
+    lock = threading.Lock()
+    if config.get("job_runner", "process") == "process":
+        # web workers only queue uploads; a separate process runs them
+        os.environ["JOBS_EXTERNAL"] = "1"
+
+        def start_runner(server):
+            threading.Thread(
+                target=supervise_runner,
+                args=(stopping, runner, lock, server.log),
+                name="runner-supervisor",
+                daemon=True,
+            ).start()
+
+        options["when_ready"] = start_runner
+    # the runner drains its jobs first, so it gets a little longer than that
+    runner_timeout = int(config.get("job_graceful_timeout", 25)) + 5
+
+    def on_exit(server):
+        with lock:
+            stopping.set()
+        for proc in runner:
+            proc.terminate()
+            try:
+                proc.wait(runner_timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    options["on_exit"] = on_exit
+
+    def child_exit(server, worker):
+        from app.metrics import registry
+
+        # keeps one snapshot per live process instead of one per worker ever started
+        registry.compact(Path(config.get("metrics_dir") or os.environ["METRICS_DIR"]))
+
+    options["child_exit"] = child_exit
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # built in each worker so no database connection crosses a fork
+            return create_app(config)
+
+    Server().run()
+
+
 if __name__ == '__main__':
     config = load_config()
-    port = int(config.get("port", 7860))
-    app.run(host="0.0.0.0", port=port)
+    if config.get("server", "development") == "gunicorn":
+        serve_production(config)
+    else:
+        from app import create_app, init_db
+
+        app = create_app(config)
+        init_db(app)
+        port = int(config.get("port", 7860))
+        app.run(host="0.0.0.0", port=port)
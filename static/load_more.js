@@ -0,0 +1,28 @@
+// Append the next page of a listing in place instead of navigating to it.
+document.addEventListener('click', e => {
+    const link = e.target.closest('a.load-more');
+    if (!link) {
+        return;
+    }
+    e.preventDefault();
+    const url = new URL(link.href, window.location.href);
+    url.searchParams.set('fragment', '1');
+    fetch(url, {credentials: 'same-origin'})
+        .then(r => {
+            if (!r.ok) {
+                throw new Error(r.statusText);
+            }
+            return r.text().then(html => [html, r.headers.get('X-Next-Page')]);
+        })
+        .then(([html, next]) => {
+            document.getElementById(link.dataset.target).insertAdjacentHTML('beforeend', html);
+            if (next) {
+                link.href = next;
+            } else {
+                link.remove();
+            }
+        })
+        .catch(() => {
+            window.location.href = link.href;
+        });
+});
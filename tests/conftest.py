@@ -0,0 +1,20 @@
+import pytest
+
+from app import create_app, init_db
+
+
+def make_app(path, **config):
+    """Build an application whose database and archives live below ``path``."""
+    app = create_app({
+        'archive_dir': path,
+        'database_url': f'sqlite:///{path / "data.db"}',
+        'TESTING': True,
+        **config,
+    })
+    init_db(app)
+    return app
+
+
+@pytest.fixture
+def app(tmp_path):
+    return make_app(tmp_path)
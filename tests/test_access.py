@@ -0,0 +1,63 @@
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.models import db, Dataset, Team, TeamMember, User
+from tests.conftest import make_app
+
+
+def setup_user(path, team_count):
+    path.mkdir(exist_ok=True)
+    app = make_app(path)
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+        for i in range(team_count):
+            team = Team(name=f't{i}', owner_id=user.id)
+            db.session.add(team)
+            db.session.commit()
+            db.session.add(TeamMember(team_id=team.id, user_id=user.id))
+            db.session.add(Dataset(filename=f'd{i}.zip', owner_id=user.id, team_id=team.id))
+            db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return app, client
+
+
+def count_queries(app, client, path):
+    client.get(path)  # warm the settings cache
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        resp = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert resp.status_code == 200
+    return len(statements), resp
+
+
+def test_index_queries_do_not_grow_with_teams(tmp_path):
+    few, _ = count_queries(*setup_user(tmp_path / 'few', 1), '/')
+    many, resp = count_queries(*setup_user(tmp_path / 'many', 6), '/')
+    assert few == many
+    assert b'Team t5: <span class="">1/' in resp.data
+
+
+def test_membership_checks_use_request_cache(tmp_path):
+    app, _ = setup_user(tmp_path, 2)
+    with app.test_request_context():
+        with app.app_context():
+            user = User.query.filter_by(username='u').first()
+            from flask_login import login_user
+            from app.access import current_access
+            login_user(user)
+            access = current_access()
+            assert access is current_access()
+            assert access.is_member(access.team_ids[0])
+            assert not access.is_member(999)
+            assert access.dataset_count(access.team_ids[1]) == 1
@@ -0,0 +1,30 @@
+import zipfile
+from io import BytesIO
+
+import pytest
+from app.archive import write_dataset
+
+
+def test_write_dataset_streams_archive_and_previews(tmp_path):
+    variants = [('a.png', BytesIO(b'png-bytes')), ('b.bmp', BytesIO(b'bmp' * 100))]
+    size = write_dataset(iter(variants), tmp_path / 'ds.zip', tmp_path / 'ds')
+    assert size == (tmp_path / 'ds.zip').stat().st_size
+    with zipfile.ZipFile(tmp_path / 'ds.zip') as zf:
+        assert zf.getinfo('a.png').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('b.bmp').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read('b.bmp') == b'bmp' * 100
+    assert (tmp_path / 'ds' / 'a.png').read_bytes() == b'png-bytes'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['ds', 'ds.zip']
+    # readable like every other file the app writes, not 0600 from mkstemp
+    mode = (tmp_path / 'ds.zip').stat().st_mode & 0o777
+    assert mode == (tmp_path / 'ds' / 'a.png').stat().st_mode & 0o777
+
+
+def test_write_dataset_cleans_up_on_failure(tmp_path):
+    def variants():
+        yield 'a.png', BytesIO(b'x')
+        raise RuntimeError('encode failed')
+
+    with pytest.raises(RuntimeError):
+        write_dataset(variants(), tmp_path / 'ds.zip', tmp_path / 'ds')
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,39 @@
+from benchmarks.harness import Case, compare, measure, percentile, run_cases
+from benchmarks.processing import crop_and_flip_case
+
+
+def result(name, p50, rss=100.0):
+    return {'name': name, 'seconds': {'p50': p50}, 'peak_rss_mb': rss}
+
+
+def test_percentile_interpolates():
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile([5.0], 99) == 5.0
+
+
+def test_measure_reports_rate():
+    stats = measure(lambda: 14, repeat=3)
+    assert stats['runs'] == 3
+    assert stats['images_per_second'] > 0
+    assert stats['seconds']['min'] <= stats['seconds']['p50'] <= stats['seconds']['p99']
+
+
+def test_compare_flags_slowdowns_beyond_threshold():
+    baseline = {'results': [result('a', 1.0), result('b', 1.0), result('c', 1.0, rss=100)]}
+    current = {'results': [
+        result('a', 1.05), result('b', 1.5), result('c', 1.0, rss=200),
+        result('new', 9.0), {'name': 'skipped', 'skipped': 'n/a'},
+    ]}
+    found = {(c.name, c.metric) for c in compare(current, baseline, threshold=0.1)}
+    assert found == {('b', 'p50'), ('c', 'peak_rss_mb')}
+
+
+def test_processing_case_runs_in_process():
+    params = {'megapixels': 0.01, 'fmt': 'PNG', 'mode': 'P', 'parallel': False, 'repeat': 1}
+    [ok, skipped] = run_cases(
+        [Case('png', crop_and_flip_case, params),
+         Case('jpeg', crop_and_flip_case, dict(params, fmt='JPEG', mode='RGBA'))],
+        isolate=False, log=lambda *a, **k: None,
+    )
+    assert ok['runs'] == 1 and ok['images_per_second'] > 0
+    assert 'skipped' in skipped
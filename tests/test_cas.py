@@ -0,0 +1,62 @@
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app import services
+from app.models import db, Blob, Dataset, User
+from app.storage import dataset_paths
+
+
+def setup_user(app):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+        uid = user.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client, uid
+
+
+def upload(client, color='red'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color=color).save(buf, format='PNG')
+    buf.seek(0)
+    resp = client.post('/upload', data={'image': (buf, 'a.png')}, content_type='multipart/form-data')
+    assert resp.status_code == 302
+
+
+def test_repeat_upload_reuses_cached_outputs(app, tmp_path, monkeypatch):
+    client, uid = setup_user(app)
+    calls = []
+    render = services.render_dataset
+    monkeypatch.setattr(services, 'render_dataset', lambda *a: calls.append(a) or render(*a))
+
+    upload(client)
+    upload(client)
+    assert len(calls) == 1
+    with app.app_context():
+        first, second = Dataset.query.filter_by(owner_id=uid).all()
+        assert first.blob_key == second.blob_key
+        assert db.session.get(Blob, first.blob_key).refcount == 2
+        ids, key = [first.id, second.id], first.blob_key
+        a = tmp_path / dataset_paths(f'user_{uid}', first.filename).archive
+        b = tmp_path / dataset_paths(f'user_{uid}', second.filename).archive
+    assert a.stat().st_ino == b.stat().st_ino
+    assert len(list((b.parent / b.name[:-4]).iterdir())) == 14
+
+    entry = app.extensions['oneshot'].content_store().entry(key)
+    client.post(f'/delete/{ids[0]}')
+    assert entry.exists()
+    client.post(f'/delete/{ids[1]}')
+    assert not entry.exists()
+    with app.app_context():
+        assert db.session.get(Blob, key) is None
+
+
+def test_different_content_is_processed_separately(app):
+    client, uid = setup_user(app)
+    upload(client, 'red')
+    upload(client, 'blue')
+    with app.app_context():
+        keys = {ds.blob_key for ds in Dataset.query.filter_by(owner_id=uid)}
+    assert len(keys) == 2
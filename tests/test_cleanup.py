@@ -0,0 +1,153 @@
+import errno
+import os
+import time
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app import cleanup
+from app.cleanup import Cleaner, reconcile
+from app.models import db, Dataset, User, Usage
+from app.services import reconcile_archives
+
+
+def setup(app):
+    with app.app_context():
+        for name, admin in (('admin', True), ('u', False)):
+            db.session.add(User(username=name, password_hash=generate_password_hash('a'), is_admin=admin))
+        db.session.commit()
+    client = app.test_client()
+    return client
+
+
+def login(client, name):
+    client.post('/login', data={'username': name, 'password': 'a'})
+
+
+def upload(client, name='a.png'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    client.post('/upload', data={'image': (buf, name)}, content_type='multipart/form-data')
+
+
+def age(path, seconds=7200):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_discard_moves_then_purges(app, tmp_path):
+    cleaner = Cleaner()
+    cleaner.init_app(app)
+    app.config['JOBS_EAGER'] = False
+    folder = tmp_path / 'team_1'
+    (folder / 'a').mkdir(parents=True)
+    (folder / 'a' / 'x.png').write_bytes(b'x')
+    cleaner.discard(tmp_path, folder)
+    assert not folder.exists()
+    deadline = time.time() + 5
+    while any((tmp_path / '.trash').iterdir()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert not any((tmp_path / '.trash').iterdir())
+
+
+def test_discard_removes_paths_it_cannot_move(app, tmp_path, monkeypatch):
+    cleaner = Cleaner()
+    cleaner.init_app(app)
+    folder = tmp_path / 'team_1'
+    (folder / 'a').mkdir(parents=True)
+    (folder / 'a' / 'x.png').write_bytes(b'x')
+    single = tmp_path / 'b.zip'
+    single.write_bytes(b'x')
+
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(cleanup.os, 'rename', cross_device)
+    cleaner.discard(tmp_path, folder, single)
+    assert not folder.exists()
+    assert not single.exists()
+
+
+def test_admin_delete_user_removes_files(app, tmp_path):
+    client = setup(app)
+    login(client, 'u')
+    upload(client)
+    user_dir = tmp_path / 'user_2'
+    assert any(user_dir.iterdir())
+    login(client, 'admin')
+    client.post('/admin/users/2/delete')
+    assert not user_dir.exists()
+    assert not any((tmp_path / '.trash').iterdir())
+    assert not any((tmp_path / '.cas').rglob('*.zip'))
+
+
+def test_reconcile_reports_and_removes_orphans(app, tmp_path):
+    client = setup(app)
+    login(client, 'u')
+    upload(client)
+    stray = tmp_path / 'user_2' / 'stray.zip'
+    stray.write_bytes(b'x')
+    fresh = tmp_path / 'user_2' / 'fresh.zip'
+    fresh.write_bytes(b'x')
+    gone = tmp_path / 'user_99'
+    gone.mkdir()
+    for path in (stray, gone):
+        age(path)
+    with app.app_context():
+        db.session.add(Dataset(filename='lost.zip', owner_id=2))
+        Usage.query.filter_by(scope=Usage.USER, owner_id=2).update({'datasets': 5})
+        db.session.commit()
+
+        report = reconcile(tmp_path)
+        assert set(report.orphans) == {stray, gone}
+        assert report.missing == ['user_2/lost.zip']
+        assert report.drift and report.drift[0][:2] == ('user', 2)
+        assert stray.exists()
+
+        reconcile_archives(fix=True)
+        assert not stray.exists() and not gone.exists()
+        assert fresh.exists()
+        assert reconcile(tmp_path).drift == []
+
+
+def test_reconcile_keeps_counters_that_change_meanwhile(app, tmp_path, monkeypatch):
+    from app import cleanup
+    client = setup(app)
+    login(client, 'u')
+    upload(client)
+    measure = cleanup._expected_usage
+
+    def reserve_while_measuring():
+        # another upload takes a slot after the counters were read
+        actual = measure()
+        Usage.reserve(Usage.USER, 2, 100)
+        return actual
+
+    with app.app_context():
+        Usage.query.filter_by(scope=Usage.USER, owner_id=2).update({'datasets': 5})
+        db.session.commit()
+        monkeypatch.setattr(cleanup, '_expected_usage', reserve_while_measuring)
+        assert reconcile_archives(fix=True).drift
+        assert Usage.count(Usage.USER, 2) == 6
+        monkeypatch.setattr(cleanup, '_expected_usage', measure)
+        reconcile_archives(fix=True)
+        assert Usage.count(Usage.USER, 2) == 1
+
+
+def test_periodic_reconcile_runs_in_one_process(app, monkeypatch):
+    from datetime import datetime, timedelta
+    from app import services as services_module
+    from app.models import Lease
+    runs = []
+    monkeypatch.setattr(services_module, 'reconcile_archives', lambda: runs.append(1))
+    with app.app_context():
+        queue = services_module.services().job_queue
+        services_module.periodic_reconcile()
+        assert Lease.acquire('reconcile', 'other', 60) is False
+        monkeypatch.setattr(queue, '_token', 'restarted')
+        services_module.periodic_reconcile()
+        assert len(runs) == 1
+        Lease.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        services_module.periodic_reconcile()
+        assert len(runs) == 2
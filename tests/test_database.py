@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app.database import configure_engine, engine_options
+from app.models import db
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import migrate_db
+
+
+def test_pool_options_for_server_url():
+    options = engine_options(
+        'postgresql://app@db/archives', {'db_pool_size': 4, 'db_pool_timeout': 2}
+    )
+    assert options['pool_size'] == 4
+    assert options['pool_timeout'] == 2
+    assert options['pool_pre_ping']
+    assert 'pool_size' not in engine_options('sqlite://', {})
+
+
+def test_sqlite_connections_use_wal(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "a.db"}')
+    configure_engine(engine, {'db_busy_timeout_ms': 2500})
+    with engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 2500
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1
+
+
+def test_concurrent_writers_wait_for_lock(tmp_path):
+    url = f'sqlite:///{tmp_path / "b.db"}'
+    engine = create_engine(url, **engine_options(url, {}))
+    configure_engine(engine, {})
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE t (id INTEGER PRIMARY KEY, n INTEGER)'))
+    errors = []
+
+    def write(n):
+        try:
+            for i in range(20):
+                with engine.begin() as conn:
+                    conn.execute(text('INSERT INTO t (n) VALUES (:n)'), {'n': n * 100 + i})
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT COUNT(*) FROM t')).scalar() == 160
+
+
+@pytest.mark.parametrize('dialect', [postgresql.dialect(), mysql.dialect()])
+def test_schema_compiles_for_server_databases(dialect):
+    for table in db.metadata.sorted_tables:
+        assert str(CreateTable(table).compile(dialect=dialect))
+        for index in table.indexes:
+            assert str(CreateIndex(index).compile(dialect=dialect))
+
+
+@pytest.mark.skipif(not os.getenv('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL not set')
+def test_migrations_on_server_database():
+    engine = create_engine(os.environ['TEST_DATABASE_URL'])
+    db.metadata.drop_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE IF EXISTS schema_version'))
+    assert migrate_db.migrate(engine) == [v for v, _, _ in migrate_db.MIGRATIONS]
+    assert migrate_db.migrate(engine) == []
@@ -0,0 +1,62 @@
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Dataset
+
+
+def setup_dataset(app, tmp_path):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+        ds = Dataset(filename='x.zip', owner_id=user.id)
+        db.session.add(ds)
+        db.session.commit()
+        user_dir = tmp_path / f'user_{user.id}'
+        ds_id = ds.id
+    user_dir.mkdir()
+    (user_dir / 'x.zip').write_bytes(bytes(range(256)) * 4)
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client, ds_id, user_dir
+
+
+def test_range_and_conditional_requests(app, tmp_path):
+    client, ds_id, _ = setup_dataset(app, tmp_path)
+    full = client.get(f'/d/{ds_id}')
+    assert full.status_code == 200
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    etag = full.headers['ETag']
+
+    part = client.get(f'/d/{ds_id}', headers={'Range': 'bytes=1000-'})
+    assert part.status_code == 206
+    assert part.data == full.data[1000:]
+    assert part.headers['Content-Range'] == 'bytes 1000-1023/1024'
+
+    assert client.get('/download/x.zip', headers={'If-None-Match': etag}).status_code == 304
+    since = full.headers['Last-Modified']
+    assert client.get(f'/d/{ds_id}', headers={'If-Modified-Since': since}).status_code == 304
+
+
+def test_proxy_offload_modes(app, tmp_path):
+    client, ds_id, user_dir = setup_dataset(app, tmp_path)
+    app.config['DOWNLOAD_MODE'] = 'x-accel-redirect'
+    resp = client.get(f'/d/{ds_id}')
+    assert resp.status_code == 200
+    assert resp.data == b''
+    assert resp.headers['X-Accel-Redirect'] == f'/protected-archives/{user_dir.name}/x.zip'
+    assert 'attachment' in resp.headers['Content-Disposition']
+
+    app.config['DOWNLOAD_MODE'] = 'x-sendfile'
+    resp = client.get('/download/x.zip')
+    assert resp.headers['X-Sendfile'] == str(user_dir / 'x.zip')
+
+
+def test_offloaded_download_keeps_permission_checks(app, tmp_path):
+    client, ds_id, _ = setup_dataset(app, tmp_path)
+    app.config['DOWNLOAD_MODE'] = 'x-accel-redirect'
+    with app.app_context():
+        other = User(username='v', password_hash=generate_password_hash('b'))
+        db.session.add(other)
+        db.session.commit()
+    client.post('/login', data={'username': 'v', 'password': 'b'})
+    assert client.get(f'/d/{ds_id}').status_code == 403
+    assert client.get('/download/x.zip').status_code == 403
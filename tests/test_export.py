@@ -0,0 +1,69 @@
+import io
+import tarfile
+import zipfile
+from datetime import datetime
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Dataset, Team, TeamMember
+from app.export import stream_tar, stream_zip
+
+
+def setup_team(app, tmp_path):
+    with app.app_context():
+        owner = User(username='o', password_hash=generate_password_hash('x'))
+        outsider = User(username='n', password_hash=generate_password_hash('y'))
+        db.session.add_all([owner, outsider])
+        db.session.commit()
+        team = Team(name='t', owner_id=owner.id)
+        db.session.add(team)
+        db.session.commit()
+        db.session.add(TeamMember(team_id=team.id, user_id=owner.id))
+        team_dir = tmp_path / f'team_{team.id}'
+        team_dir.mkdir()
+        ids = []
+        for day in (1, 2, 3):
+            ds = Dataset(
+                filename=f'd{day}.zip', owner_id=owner.id, team_id=team.id,
+                timestamp=datetime(2024, 1, day, 12),
+            )
+            db.session.add(ds)
+            (team_dir / ds.filename).write_bytes(bytes([day]) * 3000)
+            db.session.commit()
+            ids.append(ds.id)
+        team_id = team.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'o', 'password': 'x'})
+    return client, team_id, ids
+
+
+def test_export_zip_and_tar(app, tmp_path):
+    client, team_id, ids = setup_team(app, tmp_path)
+    resp = client.get(f'/teams/{team_id}/export')
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        assert zf.namelist() == ['d1.zip', 'd2.zip', 'd3.zip']
+        assert zf.read('d2.zip') == bytes([2]) * 3000
+
+    resp = client.get(f'/teams/{team_id}/export?format=tar&since=2024-01-02&until=2024-01-02')
+    with tarfile.open(fileobj=io.BytesIO(resp.data)) as tf:
+        assert tf.getnames() == ['d2.zip']
+
+    resp = client.get(f'/teams/{team_id}/export?ids={ids[0]},{ids[2]}')
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        assert zf.namelist() == ['d1.zip', 'd3.zip']
+    assert client.get(f'/teams/{team_id}/export?since=yesterday').status_code == 400
+
+
+def test_export_requires_membership(app, tmp_path):
+    client, team_id, _ = setup_team(app, tmp_path)
+    client.post('/login', data={'username': 'n', 'password': 'y'})
+    assert client.get(f'/teams/{team_id}/export').status_code == 403
+
+
+def test_stream_chunks_stay_small(app, tmp_path, monkeypatch):
+    monkeypatch.setattr('app.export.CHUNK_SIZE', 1024)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(b'x' * 100_000)
+    items = [('big.bin', path, datetime(2024, 1, 1))]
+    for stream in (stream_zip(items), stream_tar(items)):
+        assert max(len(chunk) for chunk in stream) <= 16 * 1024
@@ -0,0 +1,196 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app.models import db, Blob, Dataset, Job, Usage, User
+from app import services
+from app.jobs import JobQueue
+
+
+def setup_user(app):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client
+
+
+def post_image(client, name='a.png'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    return client.post(
+        '/upload',
+        data={'image': (buf, name)},
+        content_type='multipart/form-data',
+        headers={'Accept': 'application/json'},
+    )
+
+
+def test_upload_returns_job_status(app, tmp_path):
+    client = setup_user(app)
+    resp = post_image(client)
+    assert resp.status_code == 202
+    job = resp.get_json()
+    status = client.get(job['url']).get_json()
+    assert status['status'] == 'done'
+    assert status['dataset_id'] is not None
+    assert not any((tmp_path / '.incoming').iterdir())
+
+
+def test_rejects_non_images(app, tmp_path):
+    client = setup_user(app)
+    resp = client.post(
+        '/upload',
+        data={'image': (BytesIO(b'not an image'), 'a.png')},
+        content_type='multipart/form-data',
+    )
+    assert resp.status_code == 400
+
+
+def test_queue_applies_admission_control(app, tmp_path, monkeypatch):
+    client = setup_user(app)
+    gate = threading.Event()
+
+    def slow(job):
+        gate.wait(5)
+        return services.process_upload(job)
+
+    queue = JobQueue(slow, workers=1, max_pending=1)
+    queue.init_app(app)
+    app.extensions['oneshot'].job_queue = queue
+    monkeypatch.setitem(app.config, 'JOBS_EAGER', False)
+
+    first = post_image(client, 'a.png').get_json()
+    deadline = time.time() + 5
+    while client.get(first['url']).get_json()['status'] != 'running' and time.time() < deadline:
+        time.sleep(0.01)
+    second = post_image(client, 'b.png')
+    assert second.status_code == 202
+    assert second.get_json()['status'] == 'queued'
+    third = post_image(client, 'c.png')
+    assert third.status_code == 429
+
+    gate.set()
+    deadline = time.time() + 5
+    while client.get(second.get_json()['url']).get_json()['status'] != 'done' and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.get(first['url']).get_json()['status'] == 'done'
+    assert client.get(second.get_json()['url']).get_json()['status'] == 'done'
+
+
+def test_external_queue_admits_up_to_max_pending(app, monkeypatch):
+    client = setup_user(app)
+    queue = JobQueue(lambda job: None, max_pending=1)
+    queue.init_app(app)
+    app.extensions['oneshot'].job_queue = queue
+    monkeypatch.setitem(app.config, 'JOBS_EAGER', False)
+    monkeypatch.setitem(app.config, 'JOBS_EXTERNAL', True)
+
+    assert post_image(client, 'a.png').status_code == 202
+    assert post_image(client, 'b.png').status_code == 429
+    with app.app_context():
+        assert [job.filename for job in Job.query] == ['a.png']
+        assert Usage.count(Usage.USER, User.query.filter_by(username='u').one().id) == 1
+
+
+def test_job_status_hidden_from_other_users(app, tmp_path):
+    client = setup_user(app)
+    job = post_image(client).get_json()
+    with app.app_context():
+        other = User(username='v', password_hash=generate_password_hash('b'))
+        db.session.add(other)
+        db.session.commit()
+    client.post('/login', data={'username': 'v', 'password': 'b'})
+    assert client.get(job['url']).status_code == 404
+
+
+def make_job(job_id, status, **fields):
+    user = User.query.filter_by(username='u').one()
+    job = Job(id=job_id, status=status, owner_id=user.id, filename='a.png', **fields)
+    db.session.add(job)
+    return job
+
+
+def test_recovery_requeues_jobs_of_exited_workers(app, monkeypatch):
+    setup_user(app)
+    queue = JobQueue(lambda job: None, on_failure=services.release_reservation, max_pending=1)
+    queue.init_app(app)
+    monkeypatch.setitem(app.config, 'JOBS_EAGER', False)
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    old = datetime.utcnow() - timedelta(hours=1)
+    with app.app_context():
+        user_id = User.query.filter_by(username='u').one().id
+        Usage.reserve(Usage.USER, user_id, 10)
+        make_job('exited', Job.RUNNING, worker=f'{queue.host}:{dead.pid}:x', attempts=1)
+        make_job('stale', Job.RUNNING, worker='elsewhere:1:x', attempts=1, updated_at=old)
+        make_job('alive', Job.RUNNING, worker=f'{queue.host}:{os.getpid()}:x', attempts=1)
+        make_job('retried', Job.RUNNING, worker='elsewhere:1:x', attempts=2, updated_at=old)
+        make_job('waiting1', Job.QUEUED, updated_at=old)
+        make_job('waiting2', Job.QUEUED, updated_at=old)
+        db.session.commit()
+        before = Usage.count(Usage.USER, user_id)
+        queue._recover()
+        status = {job.id: job.status for job in Job.query}
+        assert status['exited'] == status['stale'] == Job.QUEUED
+        assert status['alive'] == Job.RUNNING
+        assert status['retried'] == Job.FAILED
+        assert Usage.count(Usage.USER, user_id) == before - 1
+        # jobs that do not fit are fed on a later pass
+        queue._feed(10)
+        assert queue._queue.get_nowait() == 'waiting1'
+        queue._in_flight.clear()
+        db.session.get(Job, 'waiting1').status = Job.DONE
+        db.session.commit()
+        queue._feed(10)
+        assert queue._queue.get_nowait() == 'waiting2'
+
+
+def test_job_cancelled_while_running_stores_nothing(app, tmp_path, monkeypatch):
+    setup_user(app)
+    render = services.render_dataset
+
+    def cancel_then_render(*args, **kwargs):
+        with app.app_context():
+            services.cancel_jobs(Job.query)
+            db.session.commit()
+        return render(*args, **kwargs)
+
+    monkeypatch.setattr(services, 'render_dataset', cancel_then_render)
+    queue = JobQueue(services.process_upload, on_failure=services.release_reservation)
+    queue.init_app(app)
+    with app.app_context():
+        user_id = User.query.filter_by(username='u').one().id
+        assert Usage.reserve(Usage.USER, user_id, 10)
+        make_job('cancelled', Job.QUEUED)
+        db.session.commit()
+        Image.new('RGB', (10, 10)).save(services.services().incoming_dir() / 'cancelled', format='PNG')
+        queue.run('cancelled')
+        assert Dataset.query.count() == 0 and Job.query.count() == 0
+        assert Usage.count(Usage.USER, user_id) == 0
+        assert Blob.query.count() == 0
+
+
+def test_failed_job_whose_row_is_gone(app):
+    setup_user(app)
+
+    def fail(job):
+        Job.query.filter_by(id=job.id).delete()
+        db.session.commit()
+        raise RuntimeError('boom')
+
+    queue = JobQueue(fail)
+    queue.init_app(app)
+    with app.app_context():
+        make_job('gone', Job.QUEUED)
+        db.session.commit()
+        queue.run('gone')
+        assert db.session.get(Job, 'gone') is None
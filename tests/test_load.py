@@ -0,0 +1,37 @@
+import pytest
+from benchmarks.load import DEFAULT_MIX, Sample, count_lock_errors, parse_mix, summarize
+
+
+def test_parse_mix():
+    assert parse_mix('index=2,upload') == {'index': 2, 'preview': 0, 'download': 0, 'upload': 1}
+    assert sum(DEFAULT_MIX.values()) > 0
+    with pytest.raises(ValueError):
+        parse_mix('browse=1')
+    with pytest.raises(ValueError):
+        parse_mix('index=0')
+
+
+def test_count_lock_errors_counts_each_traceback_once():
+    log = '\n'.join([
+        'Traceback (most recent call last):',
+        'sqlite3.OperationalError: database is locked',
+        'The above exception was the direct cause of the following exception:',
+        'sqlalchemy.exc.OperationalError: (sqlite3.OperationalError) database is locked',
+        '[SQL: UPDATE archive_usage SET datasets=? WHERE archive_usage.id = ?]',
+        'GET / HTTP/1.1 200',
+    ])
+    assert count_lock_errors(log) == 1
+    assert count_lock_errors('no errors here') == 0
+
+
+def test_summarize_reports_errors_and_percentiles():
+    samples = [Sample('index', 200, 0.01 * i) for i in range(1, 11)]
+    samples += [Sample('upload', 202, 0.1), Sample('upload', 429, 0.2), Sample('upload', 0, 1.0)]
+    report = summarize(samples, elapsed=2.0)
+    assert set(report) == {'index', 'upload', 'total'}
+    assert report['index']['per_second'] == 5.0
+    assert report['index']['errors'] == 0
+    assert report['index']['seconds']['max'] == pytest.approx(0.1)
+    assert report['upload']['status'] == {'0': 1, '202': 1, '429': 1}
+    assert report['upload']['error_rate'] == pytest.approx(2 / 3)
+    assert report['total']['requests'] == 13
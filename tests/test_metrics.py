@@ -0,0 +1,137 @@
+import json
+import logging
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app.metrics import REQUEST_QUERIES, STAGE_SECONDS, Registry, registry
+from app.models import db, User
+
+
+def setup(app):
+    with app.app_context():
+        for name, admin in (('admin', True), ('u', False)):
+            db.session.add(User(username=name, password_hash=generate_password_hash('a'), is_admin=admin))
+        db.session.commit()
+    return app.test_client()
+
+
+def login(client, name):
+    client.post('/login', data={'username': name, 'password': 'a'})
+
+
+def upload(client):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    return client.post('/upload', data={'image': (buf, 'a.png')}, content_type='multipart/form-data')
+
+
+def histogram_count(name, **labels):
+    snap = registry.snapshot()
+    wanted = sorted(labels.items())
+    return sum(
+        count for n, l, _, _, count in snap['histograms']
+        if n == name and [tuple(p) for p in l] == wanted
+    )
+
+
+def test_metrics_cover_stages_routes_and_queries(app):
+    client = setup(app)
+    login(client, 'u')
+    encodes = histogram_count(STAGE_SECONDS, stage='encode')
+    pages = histogram_count(REQUEST_QUERIES, route='/')
+    assert upload(client).status_code == 302
+    assert client.get('/').status_code == 200
+    assert histogram_count(STAGE_SECONDS, stage='encode') == encodes + 14
+    assert histogram_count(REQUEST_QUERIES, route='/') == pages + 1
+
+    assert client.get('/admin/metrics').status_code == 403
+    login(client, 'admin')
+    resp = client.get('/admin/metrics')
+    assert resp.status_code == 200
+    assert resp.content_type.startswith('text/plain; version=0.0.4')
+    text = resp.get_data(as_text=True)
+    assert '# TYPE oneshot_request_seconds histogram' in text
+    assert 'oneshot_request_seconds_bucket{method="POST",route="/upload",status="302",le="+Inf"}' in text
+    for stage in ('decode', 'crop', 'encode', 'zip', 'write', 'upload.spool', 'job.commit'):
+        assert f'oneshot_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'oneshot_uploads_total{outcome="processed"}' in text
+
+
+def test_metrics_token_allows_scraping(tmp_path):
+    from tests.conftest import make_app
+
+    client = make_app(tmp_path, metrics_token='s3cret').test_client()
+    assert client.get('/admin/metrics').status_code == 403
+    assert client.get('/admin/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/admin/metrics', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+
+def test_upload_timings_are_logged(app, caplog):
+    app.config['LOG_UPLOAD_TIMINGS'] = True
+    client = setup(app)
+    login(client, 'u')
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        upload(client)
+        upload(client)
+    lines = [json.loads(r.getMessage()[len('upload '):]) for r in caplog.records if r.getMessage().startswith('upload {')]
+    assert [line['cached'] for line in lines] == [False, True]
+    assert {'job.hash', 'job.render', 'decode', 'encode', 'zip', 'job.commit'} <= set(lines[0]['stages_ms'])
+    assert 'job.render' not in lines[1]['stages_ms']
+
+
+def test_snapshots_of_processes_are_added_up(tmp_path):
+    first, second = Registry(), Registry()
+    first.directory = tmp_path
+    for reg in (first, second):
+        reg.define('jobs_total', 'counter', 'Jobs.')
+        reg.define('job_seconds', 'histogram', 'Job time.', (1, float('inf')))
+    first.inc('jobs_total', kind='a')
+    second.inc('jobs_total', 2, kind='a')
+    first.observe('job_seconds', 0.5)
+    second.observe('job_seconds', 3)
+    # what another server process left in the shared directory
+    (tmp_path / '1-1.json').write_text(json.dumps(second.snapshot()))
+    text = first.render()
+    assert 'jobs_total{kind="a"} 3' in text
+    assert 'job_seconds_bucket{le="1"} 1' in text
+    assert 'job_seconds_bucket{le="+Inf"} 2' in text
+    assert 'job_seconds_count 2' in text
+
+
+def test_snapshots_of_exited_processes_are_folded(tmp_path, monkeypatch):
+    import os
+    from app import metrics
+    registry = Registry()
+    registry.define('jobs_total', 'counter', 'Jobs.')
+    registry.define(STAGE_SECONDS, 'histogram', 'Stages.', metrics.TIME_BUCKETS)
+    registry.directory = tmp_path
+    dead = {'counters': [['jobs_total', [], 2]], 'histograms': [[STAGE_SECONDS, [['stage', 'x']], [1] + [0] * 15, 0.0005, 1]]}
+    for name in ('999999-1.json', '999999-2.json'):
+        (tmp_path / name).write_text(json.dumps(dead))
+    monkeypatch.setattr(metrics, '_alive', lambda pid: pid == os.getpid())
+    registry.inc('jobs_total')
+    registry.flush(force=True)
+
+    text = registry.render()
+    assert 'jobs_total 5' in text
+    assert 'oneshot_stage_seconds_count{stage="x"} 2' in text
+    assert {p.name for p in tmp_path.glob('*.json')} == {'aggregate.json', f'{os.getpid()}-{registry._started}.json'}
+    # a later process reusing the pid starts a file of its own
+    (tmp_path / '999999-3.json').write_text(json.dumps(dead))
+    assert 'jobs_total 7' in registry.render()
+    assert 'jobs_total 7' in registry.render()
+
+
+def test_requests_that_raise_are_recorded(app):
+    @app.route('/boom')
+    def boom():
+        raise RuntimeError('boom')
+
+    client = app.test_client()
+    before = histogram_count('oneshot_request_seconds', route='/boom', method='GET', status='500')
+    try:
+        client.get('/boom')
+    except RuntimeError:
+        pass
+    assert histogram_count('oneshot_request_seconds', route='/boom', method='GET', status='500') == before + 1
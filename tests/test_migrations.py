@@ -0,0 +1,69 @@
+import sys
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect, text
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import migrate_db
+
+
+OLD_SCHEMA = [
+    'CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL UNIQUE, '
+    'password_hash VARCHAR(128) NOT NULL, is_admin BOOLEAN)',
+    'CREATE TABLE team (id INTEGER PRIMARY KEY, name VARCHAR(120) NOT NULL, owner_id INTEGER NOT NULL)',
+    'CREATE TABLE team_member (id INTEGER PRIMARY KEY, team_id INTEGER NOT NULL, user_id INTEGER NOT NULL)',
+    'CREATE TABLE dataset (id INTEGER PRIMARY KEY, filename VARCHAR(120) NOT NULL, '
+    'timestamp DATETIME, owner_id INTEGER NOT NULL)',
+    'CREATE TABLE dataset_share (id INTEGER PRIMARY KEY, dataset_id INTEGER NOT NULL, user_id INTEGER NOT NULL)',
+    "INSERT INTO user (id, username, password_hash) VALUES (1, 'u', 'x')",
+    "INSERT INTO team (id, name, owner_id) VALUES (1, 't', 1)",
+    'INSERT INTO team_member (team_id, user_id) VALUES (1, 1)',
+    'INSERT INTO team_member (team_id, user_id) VALUES (1, 1)',
+    "INSERT INTO dataset (filename, owner_id) VALUES ('a.zip', 1)",
+]
+
+
+def test_migrates_old_database_in_place(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO dataset (filename, owner_id) VALUES (:f, 1)"),
+            [{'f': f'b{i}.zip'} for i in range(500)],
+        )
+
+    archive_dir = tmp_path / 'archives'
+    (archive_dir / 'user_1').mkdir(parents=True)
+    (archive_dir / 'user_1' / 'a.zip').write_bytes(b'x' * 123)
+
+    applied = migrate_db.migrate(engine, archive_dir)
+    assert applied == [version for version, _, _ in migrate_db.MIGRATIONS]
+
+    inspector = inspect(engine)
+    assert {'team_id', 'blob_key'} <= {c['name'] for c in inspector.get_columns('dataset')}
+    assert 'can_create_team' in {c['name'] for c in inspector.get_columns('user')}
+    dataset_indexes = {ix['name'] for ix in inspector.get_indexes('dataset')}
+    assert {'ix_dataset_filename', 'ix_dataset_owner_team', 'ix_dataset_team_id'} <= dataset_indexes
+    unique = [ix for ix in inspector.get_indexes('team_member') if ix['name'] == 'uq_team_member_team_user']
+    assert unique and unique[0]['unique']
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT COUNT(*) FROM team_member')).scalar() == 1
+        assert conn.execute(text("SELECT filename FROM dataset WHERE id = 1")).scalar() == 'a.zip'
+        assert conn.execute(text("SELECT size_bytes FROM dataset WHERE id = 1")).scalar() == 123
+        usage = text("SELECT bytes FROM archive_usage WHERE scope = 'user' AND owner_id = 1")
+        assert conn.execute(usage).scalar() == 123
+        plan = conn.execute(
+            text("EXPLAIN QUERY PLAN SELECT * FROM dataset WHERE filename = 'a.zip'")
+        ).fetchall()
+    assert 'ix_dataset_filename' in str(plan)
+
+    assert migrate_db.migrate(engine, archive_dir) == []
+
+
+def test_fresh_database_matches_models(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "new.db"}')
+    migrate_db.migrate(engine, tmp_path / 'archives')
+    indexes = {ix['name'] for ix in inspect(engine).get_indexes('team_member')}
+    assert 'uq_team_member_team_user' in indexes
+    assert migrate_db.applied_versions(engine) == {v for v, _, _ in migrate_db.MIGRATIONS}
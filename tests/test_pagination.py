@@ -0,0 +1,127 @@
+import re
+from datetime import datetime
+from sqlalchemy import text
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Team, TeamMember, Dataset
+from app.pagination import encode_cursor
+
+
+def setup(app, datasets=7):
+    app.config['PAGE_SIZE'] = 3
+    app.config['ADMIN_PAGE_SIZE'] = 2
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'), is_admin=True)
+        db.session.add(user)
+        db.session.commit()
+        team = Team(name='t', owner_id=user.id)
+        db.session.add(team)
+        db.session.commit()
+        db.session.add(TeamMember(team_id=team.id, user_id=user.id))
+        for i in range(datasets):
+            # several datasets share a timestamp so the id has to break ties
+            stamp = datetime(2024, 1, 1 + i // 3)
+            db.session.add(Dataset(filename=f'd{i}.zip', owner_id=user.id, team_id=team.id, timestamp=stamp))
+        db.session.commit()
+        team_id = team.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client, team_id
+
+
+def ids_in(html):
+    return [int(i) for i in re.findall(r'/d/(\d+)"', html)]
+
+
+def walk(client, url):
+    seen = []
+    while url:
+        resp = client.get(url + ('&' if '?' in url else '?') + 'fragment=1')
+        assert resp.status_code == 200
+        page = ids_in(resp.get_data(as_text=True))
+        assert len(page) <= 3
+        seen.extend(page)
+        url = resp.headers.get('X-Next-Page')
+    return seen
+
+
+def test_team_archive_pages_through_all_datasets(app, tmp_path):
+    client, team_id = setup(app)
+    first = client.get(f'/teams/{team_id}/archive').get_data(as_text=True)
+    assert len(ids_in(first)) == 3
+    assert 'Load more' in first
+    seen = walk(client, f'/teams/{team_id}/archive')
+    assert seen == [7, 6, 5, 4, 3, 2, 1]
+
+
+def test_index_pages_and_rejects_bad_cursor(app, tmp_path):
+    client, _ = setup(app, datasets=4)
+    assert walk(client, '/') == [4, 3, 2, 1]
+    assert client.get('/?cursor=garbage').status_code == 400
+    for values in ([123, 1], ['2024-01-01', 'x'], ['not a date', 1], [None, 1]):
+        cursor = encode_cursor(values)
+        assert client.get(f'/?cursor={cursor}').status_code == 400
+
+
+def test_admin_users_paged_by_id(app, tmp_path):
+    client, _ = setup(app)
+    with app.app_context():
+        for name in ('v', 'w', 'x'):
+            db.session.add(User(username=name, password_hash='x'))
+        db.session.commit()
+    names = []
+    url = '/admin/users'
+    while url:
+        resp = client.get(url + ('&' if '?' in url else '?') + 'fragment=1')
+        names.extend(re.findall(r'px-4 py-2">(\w)</td>', resp.get_data(as_text=True)))
+        url = resp.headers.get('X-Next-Page')
+    assert names == ['u', 'v', 'w', 'x']
+
+
+def test_team_page_query_uses_index(app, tmp_path):
+    setup(app, datasets=0)
+    with app.app_context():
+        plan = db.session.execute(
+            text(
+                'EXPLAIN QUERY PLAN SELECT id FROM dataset WHERE team_id = 1 '
+                "AND (timestamp < '2024-01-02' OR (timestamp = '2024-01-02' AND id < 5)) "
+                'ORDER BY timestamp DESC, id DESC LIMIT 4'
+            )
+        ).fetchall()
+    plan = str(plan)
+    assert 'ix_dataset_team_timestamp' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_index_merges_personal_and_team_archives(app, tmp_path):
+    client, team_id = setup(app, datasets=4)
+    with app.app_context():
+        user = User.query.filter_by(username='u').one()
+        other = Team(name='o', owner_id=user.id)
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(TeamMember(team_id=other.id, user_id=user.id))
+        # personal and second team datasets interleave with the first team's
+        for i in range(4):
+            db.session.add(Dataset(filename=f'p{i}.zip', owner_id=user.id, timestamp=datetime(2024, 1, 1 + i)))
+            db.session.add(Dataset(filename=f'o{i}.zip', owner_id=user.id, team_id=other.id,
+                                   timestamp=datetime(2024, 1, 1)))
+        db.session.commit()
+        expected = [
+            d.id for d in Dataset.query.order_by(Dataset.timestamp.desc(), Dataset.id.desc())
+        ]
+    assert walk(client, '/') == expected
+
+
+def test_personal_page_query_uses_index(app, tmp_path):
+    setup(app, datasets=0)
+    with app.app_context():
+        plan = db.session.execute(
+            text(
+                'EXPLAIN QUERY PLAN SELECT id FROM dataset WHERE owner_id = 1 AND team_id IS NULL '
+                "AND (timestamp < '2024-01-02' OR (timestamp = '2024-01-02' AND id < 5)) "
+                'ORDER BY timestamp DESC, id DESC LIMIT 4'
+            )
+        ).fetchall()
+    plan = str(plan)
+    assert 'ix_dataset_owner_timestamp' in plan
+    assert 'TEMP B-TREE' not in plan
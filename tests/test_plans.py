@@ -0,0 +1,186 @@
+import json
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from app.archive import MANIFEST_FILE
+from app.models import db, Dataset, User
+from app.plans import DEFAULT_SPEC, Plan, PlanError, bucket_size, default_plan, load_plans
+from app.processing import crop_and_flip, iter_variants
+from app.storage import dataset_paths, owner_folder
+from tests.conftest import make_app
+
+
+TRAINING = {
+    'bases': {'small': {'max_side': 40}},
+    'outputs': [
+        {'name': 'original', 'mirror': False},
+        {'name': 'tile', 'grid': [2, 2], 'source': 'small'},
+        {'name': 'middle', 'center': 0.5, 'source': 'small'},
+        {'name': 'square', 'resize': [16, 16]},
+    ],
+    'mirror': True,
+}
+
+
+def test_default_plan_is_the_original_recipe():
+    names = default_plan().output_names()
+    assert len(names) == 14
+    assert names[:2] == ['original', 'top_half'] and names[7] == 'original_flip'
+    graph = default_plan().compile((41, 31))
+    assert graph.nodes[graph.outputs[3][1]].args == (0, 0, 20, 15)
+    # every mirror reuses the crop it flips
+    assert sum(node.op == 'crop' for node in graph.nodes) == 6
+
+
+def test_compiled_graph_shares_intermediates():
+    plan = Plan('training', TRAINING)
+    graph = plan.compile((80, 60))
+    assert [name for name, _ in graph.outputs] == plan.output_names()
+    assert len(graph.outputs) == 1 + 4 + 1 + 1 + 4 + 1 + 1
+    # one downscaled base for the tiles and the center crop, one for the square
+    resizes = [node for node in graph.nodes if node.op == 'resize']
+    assert sorted(node.size for node in resizes) == [(21, 16), (40, 30)]
+    assert graph.nodes[dict(graph.outputs)['tile_r1c1']].size == (20, 15)
+    assert graph.nodes[dict(graph.outputs)['square_flip']].size == (16, 16)
+
+
+def test_plan_outputs_render_from_shared_base(monkeypatch):
+    img = Image.new('RGB', (80, 60))
+    img.putdata([(x * 3 % 256, y * 4 % 256, 0) for y in range(60) for x in range(80)])
+    resized = []
+    resize = Image.Image.resize
+    monkeypatch.setattr(Image.Image, 'resize', lambda self, *a, **k: resized.append(a[0]) or resize(self, *a, **k))
+    for parallel in (False, True):
+        resized.clear()
+        result = dict(crop_and_flip(img, 'x', 'png', parallel=parallel, plan=Plan('training', TRAINING)))
+        assert sorted(resized) == [(21, 16), (40, 30)]
+        assert len(result) == 13 and 'x_original_flip.png' not in result
+        small = img.resize((40, 30), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        tile = Image.open(result['x_tile_r0c1_flip.png'])
+        assert tile.tobytes() == small.crop((20, 0, 40, 15)).transpose(Image.FLIP_LEFT_RIGHT).tobytes()
+        assert Image.open(result['x_middle.png']).size == (20, 15)
+
+
+@pytest.mark.parametrize('spec, message', [
+    ({'outputs': []}, 'needs a list of outputs'),
+    ({'outputs': [{'name': 'a'}, {'name': 'a'}]}, 'several outputs a'),
+    ({'outputs': [{'name': 'a', 'source': 'nope'}]}, "unknown base 'nope'"),
+    ({'outputs': [{'name': 'a', 'box': [0, 0, 1, 1], 'scale': 0.5}]}, 'combines box and scale'),
+    ({'outputs': [{'name': 'a', 'box': [0.5, 0, 0.5, 1]}]}, 'not be empty'),
+    ({'outputs': [{'name': '../a'}]}, 'name must be'),
+    ({'outputs': [{'name': 'a', 'grid': [40, 40]}]}, 'at most 1000'),
+    ({'outputs': [{'name': 'a'}], 'buckets': []}, 'buckets must be'),
+    ({'outputs': [{'name': 'a'}], 'buckets': [512, 0]}, 'buckets must be'),
+    ({'outputs': [{'name': 'a'}], 'buckets': [512], 'bucket_step': 0}, 'bucket_step must be'),
+])
+def test_invalid_plans_are_rejected(spec, message):
+    with pytest.raises(PlanError, match=message):
+        Plan('bad', spec)
+
+
+def test_fingerprint_follows_the_outputs():
+    assert Plan('other', DEFAULT_SPEC).fingerprint == default_plan().fingerprint
+    assert Plan('training', TRAINING).fingerprint != default_plan().fingerprint
+    assert set(load_plans({'training': TRAINING})) == {'default', 'training'}
+    bucketed = Plan('default', dict(DEFAULT_SPEC, buckets=[512]))
+    assert bucketed.fingerprint != default_plan().fingerprint
+
+
+def test_default_plan_keeps_content_keys(tmp_path):
+    from app.cas import content_key
+    upload = tmp_path / 'a.png'
+    upload.write_bytes(b'image')
+    # keys stored before plans existed had no plan part
+    assert content_key(upload, 'a', 'png', default_plan().content_fingerprint) == content_key(upload, 'a', 'png')
+    assert Plan('other', DEFAULT_SPEC).content_fingerprint == ''
+    training = Plan('training', TRAINING)
+    assert training.content_fingerprint == training.fingerprint
+
+
+def test_bucket_size_picks_nearest_long_side():
+    assert bucket_size((4000, 3000), [512, 768, 1024]) == (1024, 768)
+    assert bucket_size((600, 1000), [512, 768, 1024]) == (640, 1024)
+    assert bucket_size((640, 100), [512, 768, 1024]) == (512, 64)
+    # ties go to the smaller bucket
+    assert bucket_size((640, 640), [512, 768], step=8) == (512, 512)
+
+
+def test_bucketed_outputs_share_resampling(monkeypatch):
+    img = Image.new('RGB', (400, 300))
+    img.putdata([(x % 256, y % 256, 0) for y in range(300) for x in range(400)])
+    plan = Plan('buckets', dict(DEFAULT_SPEC, buckets=[64, 128], bucket_step=16))
+    graph = plan.compile(img.size)
+    for name, index in graph.outputs:
+        assert graph.nodes[index].size == graph.buckets[name]
+    assert graph.buckets['original'] == (128, 96) and graph.buckets['top_left'] == (128, 96)
+    assert graph.buckets['top_half_flip'] == (128, 48)
+    # the original and halves share one pass, the quarters another
+    resized = []
+    resize = Image.Image.resize
+    monkeypatch.setattr(Image.Image, 'resize', lambda self, *a, **k: resized.append(a[0]) or resize(self, *a, **k))
+    variants = list(iter_variants(img, 'x', 'png', parallel=False, plan=plan))
+    assert sorted(resized) == [(128, 96), (256, 192)]
+    assert len(variants) == 14
+    for variant in variants:
+        assert list(Image.open(variant.buffer).size) == variant.info['bucket']
+
+
+def test_app_rejects_unknown_default_plan(tmp_path):
+    with pytest.raises(PlanError):
+        make_app(tmp_path, augmentation_plan='missing')
+
+
+def test_upload_with_chosen_plan(tmp_path):
+    app = make_app(tmp_path, augmentation_plans={'training': TRAINING})
+    with app.app_context():
+        db.session.add(User(username='u', password_hash=generate_password_hash('a')))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    assert b'plan-select' in client.get('/').data
+
+    def upload(plan):
+        buf = BytesIO()
+        Image.new('RGB', (80, 60), color='red').save(buf, format='PNG')
+        buf.seek(0)
+        data = {'image': (buf, 'a.png'), 'plan': plan}
+        return client.post('/upload', data=data, content_type='multipart/form-data')
+
+    assert upload('missing').status_code == 400
+    assert upload('training').status_code == 302
+    assert upload('').status_code == 302
+    with app.app_context():
+        trained, default = Dataset.query.order_by(Dataset.id).all()
+        # the same bytes under another plan are a different content entry
+        assert trained.blob_key != default.blob_key
+        meta = Path(tmp_path) / dataset_paths(owner_folder(trained.owner_id, None), trained.filename).meta
+    manifest = json.loads((meta / MANIFEST_FILE).read_text())
+    assert manifest['plan']['name'] == 'training'
+    assert len(manifest['files']) == 13
+    assert 'bucket' not in manifest['files'][0]
+
+
+def test_manifest_records_buckets(tmp_path):
+    plans = {'sized': dict(TRAINING, buckets=[32, 48], bucket_step=8)}
+    app = make_app(tmp_path, augmentation_plans=plans, augmentation_plan='sized')
+    with app.app_context():
+        db.session.add(User(username='u', password_hash=generate_password_hash('a')))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    buf = BytesIO()
+    Image.new('RGB', (80, 60), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    client.post('/upload', data={'image': (buf, 'a.png')}, content_type='multipart/form-data')
+    with app.app_context():
+        dataset = Dataset.query.one()
+        meta = Path(tmp_path) / dataset_paths(owner_folder(dataset.owner_id, None), dataset.filename).meta
+    manifest = json.loads((meta / MANIFEST_FILE).read_text())
+    assert manifest['plan']['buckets'] == [32, 48]
+    files = {entry['name']: entry for entry in manifest['files']}
+    assert files['a_original.png']['bucket'] == [48, 32]
+    assert files['a_square_flip.png']['bucket'] == [32, 32]
@@ -4,16 +4,8 @@ from io import BytesIO
 from PIL import Image
 from werkzeug.security import generate_password_hash
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
-from app import main
-
-
-def setup_env(tmp_path, monkeypatch):
-    monkeypatch.setattr(main, 'ARCHIVE_DIR', tmp_path)
-    main.app.config['TESTING'] = True
-    main.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    with main.app.app_context():
-        main.models_db.drop_all()
-        main.models_db.create_all()
+from app.models import db, User, Dataset, Team, TeamMember
+from app.storage import dataset_paths
 
 
 def create_image():
@@ -24,69 +16,105 @@ def create_image():
     return buf
 
 
-def test_preview_stored_on_upload(tmp_path, monkeypatch):
-    setup_env(tmp_path, monkeypatch)
-    with main.app.app_context():
-        user = main.User(username='u', password_hash=generate_password_hash('a'))
-        main.models_db.session.add(user)
-        main.models_db.session.commit()
+def test_preview_stored_on_upload(app, tmp_path):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
         uid = user.id
-    client = main.app.test_client()
+    client = app.test_client()
     client.post('/login', data={'username': 'u', 'password': 'a'})
     buf = create_image()
     resp = client.post('/upload', data={'image': (buf, 'a.png')}, content_type='multipart/form-data')
     assert resp.status_code == 302
-    with main.app.app_context():
-        ds = main.Dataset.query.filter_by(owner_id=uid).first()
-        preview = tmp_path / f'user_{uid}' / ds.filename[:-4]
+    with app.app_context():
+        ds = Dataset.query.filter_by(owner_id=uid).first()
+        preview = tmp_path / dataset_paths(f'user_{uid}', ds.filename).preview
         assert preview.exists()
         assert len(list(preview.iterdir())) == 14
 
 
-def test_team_preview_accessible(tmp_path, monkeypatch):
-    setup_env(tmp_path, monkeypatch)
-    with main.app.app_context():
-        owner = main.User(username='o', password_hash=generate_password_hash('x'))
-        member = main.User(username='m', password_hash=generate_password_hash('y'))
-        main.models_db.session.add_all([owner, member])
-        main.models_db.session.commit()
-        team = main.Team(name='t', owner_id=owner.id)
-        main.models_db.session.add(team)
-        main.models_db.session.commit()
-        main.models_db.session.add_all([
-            main.TeamMember(team_id=team.id, user_id=owner.id),
-            main.TeamMember(team_id=team.id, user_id=member.id),
+def test_team_preview_accessible(app):
+    with app.app_context():
+        owner = User(username='o', password_hash=generate_password_hash('x'))
+        member = User(username='m', password_hash=generate_password_hash('y'))
+        db.session.add_all([owner, member])
+        db.session.commit()
+        team = Team(name='t', owner_id=owner.id)
+        db.session.add(team)
+        db.session.commit()
+        db.session.add_all([
+            TeamMember(team_id=team.id, user_id=owner.id),
+            TeamMember(team_id=team.id, user_id=member.id),
         ])
-        main.models_db.session.commit()
+        db.session.commit()
         team_id = team.id
-    client = main.app.test_client()
+    client = app.test_client()
     client.post('/login', data={'username': 'o', 'password': 'x'})
     buf = create_image()
     client.post('/upload', data={'image': (buf, 'a.png'), 'team_id': team_id}, content_type='multipart/form-data')
-    with main.app.app_context():
-        ds = main.Dataset.query.filter_by(team_id=team_id).first()
+    with app.app_context():
+        ds = Dataset.query.filter_by(team_id=team_id).first()
         ds_id = ds.id
     client.post('/login', data={'username': 'm', 'password': 'y'})
     resp = client.get(f'/preview/{ds_id}')
     assert resp.status_code == 200
 
 
-def test_preview_removed_on_delete(tmp_path, monkeypatch):
-    setup_env(tmp_path, monkeypatch)
-    with main.app.app_context():
-        user = main.User(username='u', password_hash=generate_password_hash('a'))
-        main.models_db.session.add(user)
-        main.models_db.session.commit()
+def test_preview_removed_on_delete(app, tmp_path):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
         uid = user.id
-    client = main.app.test_client()
+    client = app.test_client()
     client.post('/login', data={'username': 'u', 'password': 'a'})
     buf = create_image()
     client.post('/upload', data={'image': (buf, 'a.png')}, content_type='multipart/form-data')
-    with main.app.app_context():
-        ds = main.Dataset.query.filter_by(owner_id=uid).first()
-        preview = tmp_path / f'user_{uid}' / ds.filename[:-4]
+    with app.app_context():
+        ds = Dataset.query.filter_by(owner_id=uid).first()
+        preview = tmp_path / dataset_paths(f'user_{uid}', ds.filename).preview
         assert preview.exists()
         did = ds.id
     resp = client.post(f'/delete/{did}')
     assert resp.status_code == 302
     assert not preview.exists()
+
+
+def test_preview_thumbnails_and_caching(app, tmp_path):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+        uid = user.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    client.post('/upload', data={'image': (create_image(), 'a.png')}, content_type='multipart/form-data')
+    with app.app_context():
+        ds = Dataset.query.filter_by(owner_id=uid).first()
+        ds_id = ds.id
+        meta = tmp_path / dataset_paths(f'user_{uid}', ds.filename).meta
+    assert len(list((meta / 'thumbs').iterdir())) == 14
+
+    page = client.get(f'/preview/{ds_id}')
+    assert b'thumb=1' in page.data
+
+    resp = client.get(f'/preview/{ds_id}?file=a_top_left.png')
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    assert not etag.startswith('W/')
+    # the bare URL may point to other content once the id is reused
+    assert resp.headers['Cache-Control'] in ('private, no-cache', 'no-cache, private')
+    resp = client.get(f'/preview/{ds_id}?file=a_top_left.png', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    version = etag.strip('"')
+    assert f'file=a_top_left.png&amp;v={version}'.encode() in page.data
+    resp = client.get(f'/preview/{ds_id}?file=a_top_left.png&v={version}')
+    directives = {d.strip() for d in resp.headers['Cache-Control'].split(',')}
+    assert directives == {'private', 'max-age=31536000', 'immutable'}
+
+    thumb = client.get(f'/preview/{ds_id}?file=a_top_left.png&thumb=1')
+    assert thumb.status_code == 200
+    assert thumb.headers['ETag'] != etag
+    assert client.get(f'/preview/{ds_id}?file=../../x').status_code == 404
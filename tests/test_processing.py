@@ -2,7 +2,19 @@ import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
-from app.processing import crop_and_flip
+from io import BytesIO
+import os
+
+import pytest
+from app.plans import Plan, default_plan
+from app.processing import (
+    bounded_peak,
+    crop_and_flip,
+    iter_crop_and_flip,
+    open_image,
+    MemoryBudget,
+    ImageTooLarge,
+)
 from PIL import Image
 
 
@@ -18,3 +30,80 @@ def test_crop_and_flip():
         buf.seek(0)
         loaded = Image.open(buf)
         loaded.verify()
+
+
+def test_crop_and_flip_derives_variants_from_source():
+    img = Image.new("RGB", (41, 31))
+    img.putdata([(x * 6 % 256, y * 8 % 256, (x + y) % 256) for y in range(31) for x in range(41)])
+    result = dict(crop_and_flip(img, 'src', 'png'))
+    assert list(result)[:2] == ['src_original.png', 'src_top_half.png']
+    assert list(result)[7] == 'src_original_flip.png'
+    top_left = Image.open(result['src_top_left.png'])
+    assert top_left.size == (20, 15)
+    assert top_left.tobytes() == img.crop((0, 0, 20, 15)).tobytes()
+    flipped = Image.open(result['src_bottom_right_flip.png'])
+    expected = img.crop((20, 15, 41, 31)).transpose(Image.FLIP_LEFT_RIGHT)
+    assert flipped.tobytes() == expected.tobytes()
+
+
+def test_parallel_encoding_matches_sequential_order():
+    img = Image.new("RGB", (64, 48), color="blue")
+    sequential = crop_and_flip(img, 'p', 'png', parallel=False)
+    parallel = crop_and_flip(img, 'p', 'png', parallel=True)
+    assert [n for n, _ in parallel] == [n for n, _ in sequential]
+    for (_, a), (_, b) in zip(sequential, parallel):
+        assert a.getvalue() == b.getvalue()
+
+
+def admitted_limit(size, plan=None):
+    return bounded_peak((plan or default_plan()).compile(size), size, 'RGB')
+
+
+@pytest.mark.parametrize("plan", [None, Plan('tiles', {'outputs': [{'name': 'tile', 'grid': [3, 2]}], 'mirror': True})])
+def test_bounded_path_stays_within_limit(plan):
+    src = BytesIO()
+    noise = Image.frombytes("RGB", (1600, 1200), os.urandom(1600 * 1200 * 3))
+    noise.save(src, format="PNG")
+    src.seek(0)
+    # exactly what open_image admits, with incompressible pixels
+    budget = MemoryBudget(admitted_limit((1600, 1200), plan))
+    img = open_image(src, budget, plan)
+    assert budget.source_size == img.size == (1600, 1200)
+    names = []
+    for name, buf in iter_crop_and_flip(img, 'big', 'png', budget=budget, plan=plan):
+        names.append(name)
+        del buf
+    assert len(names) == len((plan or default_plan()).output_names())
+    assert budget.current == _image_bytes_of(img)
+    assert 0 < budget.peak <= budget.limit
+
+
+def test_bounded_path_renders_mirrors_next_to_their_source():
+    img = Image.new("RGB", (64, 48))
+    names = [name for name, _ in iter_crop_and_flip(img, 'b', 'png', budget=MemoryBudget(10 ** 9))]
+    assert names[:4] == ['b_original.png', 'b_original_flip.png', 'b_top_half.png', 'b_top_half_flip.png']
+    # the source, one output and its mirror, each encoded, fit with room to spare
+    assert admitted_limit((1600, 1200)) < 3.5 * 1600 * 1200 * 3
+
+
+def _image_bytes_of(img):
+    return img.width * img.height * len(img.getbands())
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+def test_bounded_path_rejects_images_over_the_limit(fmt):
+    src = BytesIO()
+    Image.new("RGB", (200, 200)).save(src, format=fmt)
+    src.seek(0)
+    with pytest.raises(ImageTooLarge, match="200x200 pixels"):
+        open_image(src, MemoryBudget(admitted_limit((200, 200)) - 1))
+
+
+def test_budget_refuses_to_exceed_its_limit():
+    img = Image.new("RGB", (100, 100))
+    budget = MemoryBudget(2 * 100 * 100 * 3)
+    budget.hold(_image_bytes_of(img))
+    with pytest.raises(ImageTooLarge):
+        list(iter_crop_and_flip(img, 'big', 'png', budget=budget))
+    with pytest.raises(ImageTooLarge):
+        budget.hold(budget.limit)
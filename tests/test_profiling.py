@@ -0,0 +1,96 @@
+import time
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app.models import db, User
+
+
+def setup(app):
+    with app.app_context():
+        for name, admin in (('admin', True), ('u', False)):
+            db.session.add(User(username=name, password_hash=generate_password_hash('a'), is_admin=admin))
+        db.session.commit()
+    return app.test_client()
+
+
+def login(client, name):
+    client.post('/login', data={'username': name, 'password': 'a'})
+
+
+def upload(client, query=''):
+    buf = BytesIO()
+    Image.new('RGB', (40, 30), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    return client.post(
+        '/upload' + query,
+        data={'image': (buf, 'a.png')},
+        content_type='multipart/form-data',
+        headers={'Accept': 'application/json'},
+    )
+
+
+def profiles(app):
+    with app.app_context():
+        return app.extensions['oneshot'].profiles.list()
+
+
+def test_admin_profiles_request_on_demand(app):
+    client = setup(app)
+    login(client, 'admin')
+    assert 'X-Profile-Id' not in client.get('/').headers
+    resp = upload(client, '?profile=1')
+    profile_id = resp.headers['X-Profile-Id']
+
+    [meta] = profiles(app)
+    assert meta['id'] == profile_id
+    assert meta['kind'] == 'request' and meta['status'] == 202
+    # jobs run inline while testing, so the request covers the processing
+    assert meta['processing_seconds'] > 0
+    assert meta['sqlalchemy_seconds'] > 0
+    assert meta['queries'] > 0
+
+    page = client.get('/admin/profiles')
+    assert b'POST /upload?profile=1' in page.data
+    assert b'iter_variants' in client.get(f'/admin/profiles/{profile_id}').data
+    assert client.get(f'/admin/profiles/{profile_id}?sort=tottime').status_code == 200
+    assert client.get(f'/admin/profiles/{profile_id}?sort=bogus').status_code == 400
+    raw = client.get(f'/admin/profiles/{profile_id}/download')
+    assert raw.status_code == 200 and raw.data
+    assert client.get('/admin/profiles/../data.db/download').status_code == 404
+
+
+def test_users_cannot_profile_or_read_profiles(app):
+    client = setup(app)
+    login(client, 'u')
+    resp = client.get('/', headers={'X-Profile': '1'})
+    assert 'X-Profile-Id' not in resp.headers
+    assert profiles(app) == []
+    assert client.get('/admin/profiles').status_code == 403
+
+
+def test_sampled_uploads_are_profiled_and_buffer_is_bounded(app):
+    app.config['PROFILE_UPLOAD_SAMPLE'] = 100.0
+    app.extensions['oneshot'].profiles.limit = 2
+    client = setup(app)
+    login(client, 'u')
+    ids = [upload(client).headers['X-Profile-Id'] for _ in range(3)]
+    assert 'X-Profile-Id' not in client.get('/').headers
+    assert [p['id'] for p in profiles(app)] == ids[:0:-1]
+
+
+def test_profiled_upload_also_profiles_its_job_thread(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'JOBS_EAGER', False)
+    client = setup(app)
+    login(client, 'admin')
+    job = upload(client, '?profile=1').get_json()
+    deadline = time.time() + 10
+    while client.get(job['url']).get_json()['status'] != 'done' and time.time() < deadline:
+        time.sleep(0.02)
+    deadline = time.time() + 5
+    while len(profiles(app)) < 2 and time.time() < deadline:
+        time.sleep(0.02)
+    job_profile, request_profile = profiles(app)
+    assert request_profile['kind'] == 'request'
+    assert job_profile['kind'] == 'job' and job_profile['status'] == 'done'
+    assert job_profile['processing_seconds'] > 0
+    assert 'job.render' in job_profile['stages_ms']
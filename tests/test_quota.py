@@ -0,0 +1,108 @@
+from io import BytesIO
+from PIL import Image
+from werkzeug.security import generate_password_hash
+from app.models import db, Dataset, Job, Team, User
+from app.storage import dataset_paths
+from app.jobs import QueueFull
+from app.models import Usage
+
+
+def setup_user(app):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client, user_id
+
+
+def post_image(client, name='a.png'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    return client.post(
+        '/upload',
+        data={'image': (buf, name)},
+        content_type='multipart/form-data',
+        headers={'Accept': 'application/json'},
+    )
+
+
+def usage(app, user_id):
+    with app.app_context():
+        row = Usage.query.filter_by(scope=Usage.USER, owner_id=user_id).one()
+        return row.datasets, row.bytes
+
+
+def test_reservations_stop_at_limit(app, tmp_path):
+    client, user_id = setup_user(app)
+    with app.app_context():
+        assert Usage.reserve(Usage.USER, user_id, 2)
+        assert Usage.reserve(Usage.USER, user_id, 2)
+        assert not Usage.reserve(Usage.USER, user_id, 2)
+        Usage.release(Usage.USER, user_id)
+        db.session.commit()
+        assert Usage.count(Usage.USER, user_id) == 1
+
+
+def test_counters_follow_uploads_and_deletes(app, tmp_path):
+    client, user_id = setup_user(app)
+    assert post_image(client).status_code == 202
+    with app.app_context():
+        dataset = Dataset.query.one()
+        dataset_id, filename = dataset.id, dataset.filename
+    assert usage(app, user_id) == (1, (tmp_path / dataset_paths(f'user_{user_id}', filename).archive).stat().st_size)
+    client.post(f'/delete/{dataset_id}')
+    assert usage(app, user_id) == (0, 0)
+
+
+def test_byte_limit_blocks_uploads(app, tmp_path):
+    client, user_id = setup_user(app)
+    app.config['ARCHIVE_BYTES_LIMIT_USER'] = 1
+    assert post_image(client, 'a.png').status_code == 202
+    resp = post_image(client, 'b.png')
+    assert resp.status_code == 400
+    assert usage(app, user_id)[0] == 1
+
+
+def test_failed_submit_releases_reservation(app, tmp_path, monkeypatch):
+    client, user_id = setup_user(app)
+
+    def refuse(job_id):
+        Job.query.filter_by(id=job_id).delete()
+        raise QueueFull(job_id)
+
+    monkeypatch.setattr(app.extensions['oneshot'].job_queue, 'submit', refuse)
+    assert post_image(client).status_code == 429
+    assert usage(app, user_id) == (0, 0)
+    with app.app_context():
+        assert Job.query.count() == 0
+
+
+def test_deleting_users_and_teams_releases_pending_jobs(app, tmp_path):
+    client, user_id = setup_user(app)
+    with app.app_context():
+        admin = User(username='admin', password_hash=generate_password_hash('a'), is_admin=True)
+        db.session.add(admin)
+        db.session.flush()
+        team = Team(name='t', owner_id=admin.id)
+        db.session.add(team)
+        db.session.commit()
+        team_id = team.id
+        for job_id, owner in (('mine', user_id), ('theirs', admin.id)):
+            assert Usage.reserve(Usage.TEAM, team_id, 10)
+            db.session.add(Job(id=job_id, owner_id=owner, team_id=team_id, filename='a.png'))
+        db.session.commit()
+        (tmp_path / '.incoming').mkdir(exist_ok=True)
+        (tmp_path / '.incoming' / 'mine').write_bytes(b'x')
+    client.post('/login', data={'username': 'admin', 'password': 'a'})
+    client.post(f'/admin/users/{user_id}/delete')
+    with app.app_context():
+        assert Usage.count(Usage.TEAM, team_id) == 1
+        assert [job.id for job in Job.query] == ['theirs']
+    assert not (tmp_path / '.incoming' / 'mine').exists()
+    client.post(f'/teams/{team_id}/delete')
+    with app.app_context():
+        assert Job.query.count() == 0
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash
+import run
+from app import services
+from app.jobs import JobQueue
+from app.models import db, Job, User
+from app.priority import lower_thread_priority
+from run import server_options
+
+
+def setup_user(app):
+    with app.app_context():
+        db.session.add(User(username='u', password_hash=generate_password_hash('a')))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client
+
+
+def post_image(client, name='a.png'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    return client.post(
+        '/upload',
+        data={'image': (buf, name)},
+        content_type='multipart/form-data',
+        headers={'Accept': 'application/json'},
+    )
+
+
+def test_server_options_from_config():
+    options = server_options({
+        'port': 8000,
+        'server_workers': 3,
+        'server_threads': 4,
+        'server_timeout': 60,
+        'server_max_requests': 500,
+    })
+    assert options['bind'] == '0.0.0.0:8000'
+    assert options['worker_class'] == 'gthread'
+    assert (options['workers'], options['threads']) == (3, 4)
+    assert options['timeout'] == 60
+    assert options['max_requests'] == 500
+    assert options['graceful_timeout'] == 30
+
+
+def test_external_jobs_run_in_runner(app):
+    client = setup_user(app)
+    queue = JobQueue(services.process_upload, workers=1, max_pending=1, poll_interval=0.05)
+    queue.init_app(app)
+    app.extensions['oneshot'].job_queue = queue
+    app.config['JOBS_EAGER'] = False
+    app.config['JOBS_EXTERNAL'] = True
+
+    first = post_image(client, 'a.png')
+    assert first.status_code == 202
+    assert client.get(first.get_json()['url']).get_json()['status'] == 'queued'
+    assert post_image(client, 'b.png').status_code == 429
+    assert not queue._threads
+
+    stop = threading.Event()
+    runner = threading.Thread(target=queue.serve, args=(stop,), daemon=True)
+    runner.start()
+    deadline = time.time() + 5
+    while client.get(first.get_json()['url']).get_json()['status'] != 'done' and time.time() < deadline:
+        time.sleep(0.02)
+    stop.set()
+    runner.join(5)
+    assert not runner.is_alive()
+    with app.app_context():
+        assert Job.query.filter_by(status=Job.DONE).count() == 1
+
+
+def test_lower_thread_priority():
+    result = {}
+
+    def work():
+        before = os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+        lower_thread_priority(5)
+        result['delta'] = os.getpriority(os.PRIO_PROCESS, threading.get_native_id()) - before
+        result['before'] = before
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert result['delta'] == min(5, 19 - result['before'])
+    assert os.getpriority(os.PRIO_PROCESS, threading.get_native_id()) <= result['before']
+
+
+def test_runner_drains_and_survives_poll_errors(app, monkeypatch):
+    client = setup_user(app)
+    gate = threading.Event()
+    started = threading.Event()
+
+    def slow(job):
+        started.set()
+        gate.wait(5)
+        return services.process_upload(job)
+
+    queue = JobQueue(slow, workers=1, max_pending=2, poll_interval=0.02, graceful_timeout=0.1)
+    queue.init_app(app)
+    app.extensions['oneshot'].job_queue = queue
+    app.config['JOBS_EAGER'] = False
+    app.config['JOBS_EXTERNAL'] = True
+    job = post_image(client).get_json()
+
+    feed = queue._feed
+    failures = []
+
+    def flaky(*args, **kwargs):
+        if not failures:
+            failures.append(1)
+            raise OperationalError('SELECT', {}, Exception('database is locked'))
+        return feed(*args, **kwargs)
+
+    monkeypatch.setattr(queue, '_feed', flaky)
+    stop = threading.Event()
+    runner = threading.Thread(target=queue.serve, args=(stop,), daemon=True)
+    runner.start()
+    assert started.wait(5)
+    stop.set()
+    runner.join(5)
+    assert not runner.is_alive()
+    with app.app_context():
+        requeued = db.session.get(Job, job['id'])
+        assert (requeued.status, requeued.worker, requeued.attempts) == (Job.QUEUED, None, 0)
+    gate.set()
+
+
+def test_supervisor_restarts_exited_runner(monkeypatch):
+    started = []
+    stopping = threading.Event()
+
+    class Proc:
+        returncode = 1
+
+        def __init__(self, *args, **kwargs):
+            started.append(self)
+            if len(started) == 2:
+                stopping.set()
+
+        def poll(self):
+            return self.returncode
+
+    monkeypatch.setattr(run.subprocess, 'Popen', Proc)
+    monkeypatch.setattr(run.time, 'monotonic', lambda: 0.0)
+    warnings = []
+    log = type('Log', (), {'warning': lambda self, *a: warnings.append(a)})()
+    runner = []
+    thread = threading.Thread(
+        target=run.supervise_runner, args=(stopping, runner, threading.Lock(), log)
+    )
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(started) == 2 and runner == [started[1]]
+    assert warnings and warnings[0][1] == 1
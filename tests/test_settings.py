@@ -0,0 +1,58 @@
+from sqlalchemy import event, text
+from app.models import db, Setting
+
+
+def setup_env(monkeypatch):
+    Setting.invalidate_cache()
+    monkeypatch.setattr(Setting, 'cache_ttl', 60.0)
+
+
+def capture_statements(app):
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    return statements, lambda: event.remove(engine, 'before_cursor_execute', record)
+
+
+def test_page_renders_do_not_query_or_write_settings(app, monkeypatch):
+    setup_env(monkeypatch)
+    client = app.test_client()
+    client.get('/login')
+    statements, stop = capture_statements(app)
+    try:
+        for _ in range(3):
+            assert client.get('/login').status_code == 200
+    finally:
+        stop()
+    assert not [s for s in statements if 'setting' in s.lower()]
+    with app.app_context():
+        assert Setting.query.count() == 0
+
+
+def test_set_bool_is_visible_immediately(app, monkeypatch):
+    setup_env(monkeypatch)
+    client = app.test_client()
+    assert client.get('/register').status_code == 200
+    with app.app_context():
+        Setting.set_bool('registration_enabled', False)
+    assert client.get('/register').status_code == 403
+
+
+def test_other_workers_see_changes_through_version(app, monkeypatch):
+    setup_env(monkeypatch)
+    with app.app_context():
+        assert Setting.get_bool('registration_enabled') is True
+        # another process changes the flag and bumps the counter
+        db.session.execute(text(
+            "INSERT INTO setting (key, bool_value) VALUES ('registration_enabled', 0)"
+        ))
+        db.session.execute(text("INSERT INTO settings_version (id, version) VALUES (1, 1)"))
+        db.session.commit()
+        assert Setting.get_bool('registration_enabled') is True
+        monkeypatch.setattr(Setting, 'cache_ttl', 0.0)
+        assert Setting.get_bool('registration_enabled') is False
@@ -0,0 +1,140 @@
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from app.models import db, User, Dataset
+from app.cleanup import Cleaner
+from app.storage import LocalStorage, S3Storage, dataset_paths, move_to_sharded, shard_of
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import migrate_storage
+
+
+def setup_user(app):
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+    return client
+
+
+def upload(app, client, name='a.png'):
+    buf = BytesIO()
+    Image.new('RGB', (10, 10), color='red').save(buf, format='PNG')
+    buf.seek(0)
+    client.post('/upload', data={'image': (buf, name)}, content_type='multipart/form-data')
+    with app.app_context():
+        ds = Dataset.query.order_by(Dataset.id.desc()).first()
+        return ds.id, ds.filename
+
+
+def eager_cleaner(app):
+    cleaner = Cleaner()
+    cleaner.init_app(app)
+    return cleaner
+
+
+def test_sharded_layout():
+    paths = dataset_paths('team_3', 'u_1.zip')
+    assert paths.archive == f'team_3/{shard_of("u_1.zip")}/u_1.zip'
+    assert paths.preview.endswith('/u_1') and paths.meta.endswith('/u_1.meta')
+    assert dataset_paths('team_3', 'u_1.zip', sharded=False).archive == 'team_3/u_1.zip'
+
+
+def test_migrating_legacy_dataset_keeps_it_served(app, tmp_path):
+    client = setup_user(app)
+    ds_id, filename = upload(app, client)
+    storage = LocalStorage(tmp_path)
+    sharded = dataset_paths('user_1', filename)
+    legacy = dataset_paths('user_1', filename, sharded=False)
+    # put the dataset back into the flat layout used before sharding
+    for src, dst in zip(sharded, legacy):
+        (tmp_path / src).rename(tmp_path / dst)
+    before = client.get(f'/d/{ds_id}').data
+    assert before
+
+    with app.app_context():
+        assert migrate_storage.migrate(storage, eager_cleaner(app), batch=1) == 1
+        assert migrate_storage.migrate(storage, eager_cleaner(app)) == 0
+    assert not (tmp_path / legacy.archive).exists()
+    assert (tmp_path / sharded.archive).exists()
+    assert client.get(f'/d/{ds_id}').data == before
+    assert client.get(f'/preview/{ds_id}?file=a_top_left.png').status_code == 200
+
+
+@pytest.fixture
+def bucket():
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='archives')
+        yield S3Storage('archives', prefix='data', client=client)
+
+
+def test_s3_backend_roundtrip(app, tmp_path, bucket):
+    client = setup_user(app)
+    app.extensions['oneshot'].storage = bucket
+    ds_id, filename = upload(app, client)
+    paths = dataset_paths('user_1', filename)
+    assert bucket.exists(paths.archive)
+    assert len(bucket.list(paths.preview)) == 14
+    assert not (tmp_path / 'user_1').exists()
+
+    resp = client.get(f'/d/{ds_id}')
+    assert resp.status_code == 302
+    assert 'archives' in resp.headers['Location'] and 'data/user_1' in resp.headers['Location']
+    assert client.get(f'/preview/{ds_id}').status_code == 200
+    assert client.get(f'/preview/{ds_id}?file=a_top_left.png&thumb=1').status_code == 302
+
+    client.post(f'/delete/{ds_id}')
+    assert not bucket.exists(paths.archive)
+    assert bucket.list(paths.preview) == []
+
+
+def test_s3_move_to_sharded(app, bucket):
+    legacy = dataset_paths('team_1', 'x.zip', sharded=False)
+    for key in (legacy.archive, f'{legacy.preview}/a.png', f'{legacy.meta}/manifest.json'):
+        bucket.client.put_object(Bucket='archives', Key=bucket._key(key), Body=b'{"files": []}')
+    assert move_to_sharded(bucket, 'team_1', 'x.zip', eager_cleaner(app))
+    sharded = dataset_paths('team_1', 'x.zip')
+    assert bucket.locate('team_1', 'x.zip') == sharded
+    assert bucket.list(sharded.preview) == ['a.png']
+    assert bucket.read_manifest(sharded.meta) == {'files': []}
+    assert not bucket.exists(legacy.archive)
+
+
+def test_s3_backend_keeps_no_local_content(app, tmp_path, bucket, monkeypatch):
+    from app import services as services_module
+    renders = []
+    render = services_module.render_dataset
+    monkeypatch.setattr(services_module, 'render_dataset', lambda *args: renders.append(1) or render(*args))
+    client = setup_user(app)
+    app.extensions['oneshot'].storage = bucket
+    first_id, first = upload(app, client)
+    second_id, second = upload(app, client)
+    assert len(renders) == 1
+    assert not list((tmp_path / '.cas').rglob('*.zip'))
+    assert not list((tmp_path / '.incoming').iterdir())
+    # the repeated upload was copied within the bucket
+    copied = dataset_paths('user_1', second)
+    assert len(bucket.list(copied.preview)) == 14
+    with app.app_context():
+        sizes = {ds.size_bytes for ds in Dataset.query}
+    assert sizes == {bucket.size(copied.archive)}
+
+    client.post(f'/delete/{first_id}')
+    assert bucket.exists(copied.archive)
+    assert client.get(f'/preview/{second_id}?file=a_top_left.png').status_code == 302
+
+
+def test_storage_backends_implement_the_interface():
+    from app.storage import Storage
+    with pytest.raises(TypeError):
+        Storage()
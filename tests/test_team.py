@@ -31,34 +31,26 @@ def test_team_creation_and_dataset():
         assert Dataset.query.filter_by(team_id=team.id).first() is not None
 
 
-def test_team_member_can_download(tmp_path, monkeypatch):
+def test_team_member_can_download(app, tmp_path):
     from werkzeug.security import generate_password_hash
-    from app import main
 
-    monkeypatch.setattr(main, 'ARCHIVE_DIR', tmp_path)
-    main.app.config['TESTING'] = True
-    main.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-
-    with main.app.app_context():
-        main.models_db.drop_all()
-        main.models_db.create_all()
-
-        owner = main.User(username='owner', password_hash=generate_password_hash('a'))
-        member = main.User(username='member', password_hash=generate_password_hash('b'))
-        main.models_db.session.add_all([owner, member])
-        main.models_db.session.commit()
+    with app.app_context():
+        owner = User(username='owner', password_hash=generate_password_hash('a'))
+        member = User(username='member', password_hash=generate_password_hash('b'))
+        db.session.add_all([owner, member])
+        db.session.commit()
 
-        team = main.Team(name='t', owner_id=owner.id)
-        main.models_db.session.add(team)
-        main.models_db.session.commit()
+        team = Team(name='t', owner_id=owner.id)
+        db.session.add(team)
+        db.session.commit()
 
-        main.models_db.session.add_all([
-            main.TeamMember(team_id=team.id, user_id=owner.id),
-            main.TeamMember(team_id=team.id, user_id=member.id),
+        db.session.add_all([
+            TeamMember(team_id=team.id, user_id=owner.id),
+            TeamMember(team_id=team.id, user_id=member.id),
         ])
-        ds = main.Dataset(filename='x.zip', owner_id=owner.id, team_id=team.id)
-        main.models_db.session.add(ds)
-        main.models_db.session.commit()
+        ds = Dataset(filename='x.zip', owner_id=owner.id, team_id=team.id)
+        db.session.add(ds)
+        db.session.commit()
         team_id = team.id
         filename = ds.filename
         dataset_id = ds.id
@@ -67,7 +59,7 @@ def test_team_member_can_download(tmp_path, monkeypatch):
     team_dir.mkdir(parents=True, exist_ok=True)
     (team_dir / filename).write_bytes(b'data')
 
-    client = main.app.test_client()
+    client = app.test_client()
     client.post('/login', data={'username': 'member', 'password': 'b'})
     resp = client.get(f'/d/{dataset_id}')
     assert resp.status_code == 200
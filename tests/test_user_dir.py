@@ -1,26 +1,24 @@
 from io import BytesIO
+import zipfile
 from PIL import Image
 from werkzeug.security import generate_password_hash
-from app import main
-
-
-def setup_user(tmp_path, monkeypatch):
-    monkeypatch.setattr(main, 'ARCHIVE_DIR', tmp_path)
-    monkeypatch.setattr(main, 'ARCHIVE_LIMIT_USER', 1)
-    main.app.config['TESTING'] = True
-    main.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    with main.app.app_context():
-        main.models_db.drop_all()
-        main.models_db.create_all()
-        user = main.User(username='u', password_hash=generate_password_hash('a'))
-        main.models_db.session.add(user)
-        main.models_db.session.commit()
+from app import processing
+from app.models import db, User, Dataset, Job, Usage
+from app.storage import dataset_paths
+
+
+def setup_user(app):
+    app.config['ARCHIVE_LIMIT_USER'] = 1
+    with app.app_context():
+        user = User(username='u', password_hash=generate_password_hash('a'))
+        db.session.add(user)
+        db.session.commit()
         return user.id
 
 
-def test_user_directory_and_quota(tmp_path, monkeypatch):
-    user_id = setup_user(tmp_path, monkeypatch)
-    client = main.app.test_client()
+def test_user_directory_and_quota(app, tmp_path):
+    user_id = setup_user(app)
+    client = app.test_client()
     client.post('/login', data={'username': 'u', 'password': 'a'})
 
     img = Image.new('RGB', (10, 10), color='red')
@@ -37,3 +35,47 @@ def test_user_directory_and_quota(tmp_path, monkeypatch):
     assert resp2.status_code == 400
     user_dir = tmp_path / f'user_{user_id}'
     assert any(user_dir.iterdir())
+
+
+def test_large_upload_uses_bounded_path(app, tmp_path, monkeypatch):
+    user_id = setup_user(app)
+    monkeypatch.setattr(processing, 'large_image_pixels', lambda: 0)
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+
+    buf = BytesIO()
+    Image.new('RGB', (64, 48), color='red').save(buf, format='JPEG')
+    buf.seek(0)
+    resp = client.post('/upload', data={'image': (buf, 'big.jpg')}, content_type='multipart/form-data')
+    assert resp.status_code == 302
+    with app.app_context():
+        ds = Dataset.query.filter_by(owner_id=user_id).first()
+    archive = tmp_path / dataset_paths(f'user_{user_id}', ds.filename).archive
+    with zipfile.ZipFile(archive) as zf:
+        assert len(zf.namelist()) == 14
+    assert len(list((archive.parent / ds.filename[:-4]).iterdir())) == 14
+    with app.app_context():
+        job = Job.query.one()
+    status = client.get(f'/jobs/{job.id}').get_json()
+    assert status['memory']['limit'] == processing.memory_limit()
+    assert 0 < status['memory']['peak'] <= status['memory']['limit']
+
+
+def test_large_upload_over_the_memory_limit_fails(app, tmp_path, monkeypatch):
+    user_id = setup_user(app)
+    monkeypatch.setattr(processing, 'large_image_pixels', lambda: 0)
+    monkeypatch.setattr(processing, 'memory_limit', lambda: 64 * 48 * 3 * 2)
+    client = app.test_client()
+    client.post('/login', data={'username': 'u', 'password': 'a'})
+
+    buf = BytesIO()
+    Image.new('RGB', (64, 48), color='red').save(buf, format='JPEG')
+    buf.seek(0)
+    client.post('/upload', data={'image': (buf, 'big.jpg')}, content_type='multipart/form-data')
+    with app.app_context():
+        job = Job.query.one()
+        assert job.status == Job.FAILED
+        assert job.error.startswith('Image too large')
+        assert job.memory_limit == 64 * 48 * 3 * 2 < job.memory_peak
+        assert Dataset.query.count() == 0
+        assert Usage.count(Usage.USER, user_id) == 0